@@ -18,6 +18,8 @@ DROP TABLE IF EXISTS groups;
 DROP TABLE IF EXISTS grouptypes;
 
 DROP TABLE IF EXISTS marklog;
+DROP TABLE IF EXISTS markqueue;
+DROP TABLE IF EXISTS bgjobs;
 
 DROP TABLE IF EXISTS marks;
 DROP TABLE IF EXISTS guesses;
@@ -29,6 +31,7 @@ DROP TABLE IF EXISTS permissiondesc;
 DROP TABLE IF EXISTS questions;
 DROP TABLE IF EXISTS qattach;
 DROP TABLE IF EXISTS qtattach;
+DROP TABLE IF EXISTS attachdata;
 DROP TABLE IF EXISTS qtvariations;
 DROP TABLE IF EXISTS questionflags;
 DROP TABLE IF EXISTS questiontopics;
@@ -37,6 +40,9 @@ DROP TABLE IF EXISTS userexams;
 DROP TABLE IF EXISTS exams;
 DROP TABLE IF EXISTS courses;
 DROP TABLE IF EXISTS stats_prac_q_course;
+DROP TABLE IF EXISTS stats_q_course;
+DROP TABLE IF EXISTS stats_q_counted;
+DROP TABLE IF EXISTS stats_prac_daily;
 
 DROP TABLE IF EXISTS statsqtassesshourly;
 DROP TABLE IF EXISTS statsqtpracticehourly;
@@ -0,0 +1,141 @@
+--
+-- Make the changes needed to move from v3.9.4 to 3.9.5
+-- This is just the SQL changes, the application will need to run some logic
+-- too. Use the "oasisdb" tool to run this, do not try to run it directly.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+
+
+
+-- Put this into logic:  INSERT INTO users (uname, passwd, givenname, source, confirmed)
+--       VALUES ('admin', '-NOLOGIN-', 'Admin', 'local', TRUE);
+
+BEGIN;
+
+-- Attachment contents are stored once, by hash. Existing attachments are
+-- moved across as they're used, or all at once with "oasisdb dedupattach"
+CREATE TABLE attachdata (
+    "hash" character varying(64) PRIMARY KEY,
+    "size" integer,
+    "data" bytea
+);
+ALTER TABLE qattach ADD COLUMN "hash" character varying(64) REFERENCES attachdata("hash");
+ALTER TABLE qtattach ADD COLUMN "hash" character varying(64) REFERENCES attachdata("hash");
+
+-- Submitted assessments waiting to be marked.
+-- status: 0 = queued, 1 = being marked, 2 = marked, 3 = failed
+CREATE TABLE markqueue (
+    "job" SERIAL PRIMARY KEY,
+    "exam" integer REFERENCES exams("exam") NOT NULL,
+    "student" integer REFERENCES users("id") NOT NULL,
+    "status" integer NOT NULL DEFAULT 0,
+    "attempts" integer NOT NULL DEFAULT 0,
+    "created" timestamp NOT NULL DEFAULT NOW(),
+    "started" timestamp,
+    "finished" timestamp,
+    "error" text
+);
+CREATE INDEX markqueue_status_job ON markqueue USING btree (status, job);
+CREATE UNIQUE INDEX markqueue_waiting ON markqueue USING btree (exam, student) WHERE status < 2;
+
+-- Class statistics for each question template, per course and month,
+-- kept up to date as questions are marked. "oasisdb rebuildqstats" makes
+-- them again from scratch.
+CREATE TABLE stats_q_course (
+    "course" integer NOT NULL,
+    "qtemplate" integer NOT NULL,
+    "month" date NOT NULL,
+    "number" integer NOT NULL,
+    "total" numeric NOT NULL,
+    "totalsq" numeric NOT NULL,
+    "minscore" real,
+    "maxscore" real,
+    PRIMARY KEY ("course", "qtemplate", "month")
+);
+
+-- Which course rows of stats_q_course each question was counted in, and
+-- with what score, so it can be taken out again exactly.
+CREATE TABLE stats_q_counted (
+    "question" integer NOT NULL,
+    "course" integer NOT NULL,
+    "qtemplate" integer NOT NULL,
+    "month" date NOT NULL,
+    "score" real NOT NULL,
+    PRIMARY KEY ("question", "course")
+);
+CREATE INDEX stats_q_counted_course_qtemplate_month ON stats_q_counted USING btree (course, qtemplate, "month");
+
+-- Practice statistics are now counted incrementally, adding to the existing
+-- hourly rows, so there can only be one of each. The old daily job could
+-- leave duplicates if two ran at once.
+DELETE FROM stats_prac_q_course AS a
+    USING stats_prac_q_course AS b
+    WHERE a.ctid < b.ctid
+      AND a.qtemplate = b.qtemplate
+      AND a.year = b.year
+      AND a.month = b.month
+      AND a.day = b.day
+      AND a.hour = b.hour;
+CREATE UNIQUE INDEX stats_prac_q_course_hour_idx ON stats_prac_q_course USING btree (qtemplate, year, month, day, hour);
+CREATE INDEX question_marktime ON questions USING btree (marktime);
+
+-- Daily practice counts for each question template, and for the whole
+-- system as qtemplate 0, for the statistics graphs.
+CREATE TABLE stats_prac_daily (
+    "qtemplate" integer NOT NULL,
+    "day" date NOT NULL,
+    "number" integer NOT NULL,
+    PRIMARY KEY ("qtemplate", "day")
+);
+INSERT INTO stats_prac_daily ("qtemplate", "day", "number")
+    SELECT COALESCE(qtemplate, 0), make_date(year, month, day),
+           COALESCE(SUM("number"), 0)
+    FROM stats_prac_q_course
+    GROUP BY GROUPING SETS ((qtemplate, make_date(year, month, day)),
+                            (make_date(year, month, day)));
+
+-- Background jobs (eg. re-marking an assessment) and how far along they are.
+-- status: 0 = running, 1 = finished, 2 = failed
+CREATE TABLE bgjobs (
+    "job" SERIAL PRIMARY KEY,
+    "kind" character varying(20) NOT NULL,
+    "target" integer NOT NULL,
+    "status" integer NOT NULL DEFAULT 0,
+    "total" integer NOT NULL DEFAULT 0,
+    "done" integer NOT NULL DEFAULT 0,
+    "started" timestamp NOT NULL DEFAULT NOW(),
+    "updated" timestamp NOT NULL DEFAULT NOW(),
+    "finished" timestamp,
+    "error" text,
+    "info" text
+);
+CREATE INDEX bgjobs_kind_target_job ON bgjobs USING btree (kind, target, job);
+CREATE UNIQUE INDEX bgjobs_running ON bgjobs USING btree (kind, target) WHERE status = 0;
+
+-- Each student only gets one question in each position of an assessment.
+-- Keep the first if two were ever made at once.
+DELETE FROM examquestions AS a
+    USING examquestions AS b
+    WHERE a.id > b.id
+      AND a.exam = b.exam
+      AND a.student = b.student
+      AND a.position = b.position;
+CREATE UNIQUE INDEX examquestions_exam_student_position ON examquestions USING btree (exam, student, position);
+
+-- Each variation only gets one of each generated attachment. Keep the first
+-- if two were ever made at once.
+DELETE FROM qattach AS a
+    USING qattach AS b
+    WHERE a.qattach > b.qattach
+      AND a.qtemplate = b.qtemplate
+      AND a.version = b.version
+      AND a.variation = b.variation
+      AND a.name = b.name;
+CREATE UNIQUE INDEX qattach_qtemplate_version_variation_name ON qattach USING btree (qtemplate, version, variation, name);
+
+update config SET "value" = '3.9.5' WHERE "name" = 'dbversion';
+
+COMMIT;
\ No newline at end of file
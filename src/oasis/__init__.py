@@ -101,6 +101,19 @@ app.logger.setLevel(logging.DEBUG)
 
 
 
+@app.before_request
+def db_request_start():
+    """ Have all the database calls during the request share one connection.
+    """
+    DB.pin_connection()
+
+
+@app.teardown_request
+def db_request_end(exc):
+    """ Give the request's database connection back to the pool. """
+    DB.release_connection()
+
+
 @app.context_processor
 def template_context():
     """ Useful values for templates to always have access to"""
@@ -7,9 +7,11 @@
 """
 
 import re
+import os
+import threading
 
 from oasis.lib.OaExceptions import OaMarkerError
-from oasis.lib import DB, General, Exams, Courses
+from oasis.lib import DB, General, Exams, Courses, OaConfig
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -17,10 +19,122 @@ L = getLogger("oasisqe")
 DATEFORMAT = "%d %b %H:%M"
 
 
-def mark_exam(user_id, exam_id):
-    """ Submit the assessment and mark it.
+def mark_exam(user_id, exam_id, submittime=None):
+    """ Submit the assessment and mark it. submittime is when it was
+        submitted, if not now.
         Returns True if it went well, or False if a problem.
     """
+    # All or nothing, and only one commit for the whole lot.
+    try:
+        with DB.transaction():
+            if not _mark_exam(user_id, exam_id, submittime):
+                # Roll back the questions already marked
+                raise OaMarkerError("Unable to mark assessment")
+    except OaMarkerError:
+        return False
+    return True
+
+
+def submit_exam(user_id, exam_id):
+    """ Submit the assessment. It's put in the marking queue to be marked
+        in the background, or if there are no marking threads configured,
+        marked straight away.
+        Returns True if it went well, or False if a problem.
+    """
+    if OaConfig.mark_queue_workers <= 0:
+        return mark_exam(user_id, exam_id)
+    # Either it's submitted and queued, or neither.
+    try:
+        with DB.transaction():
+            # If it was submitted already it's being queued again, keep
+            # the original submit time.
+            if Exams.get_user_status(user_id, exam_id) < 4:
+                Exams.set_user_status(user_id, exam_id, 4)    # submitted, not marked
+                Exams.set_submit_time(user_id, exam_id)
+            if not Exams.queue_marking(exam_id, user_id):
+                raise OaMarkerError("Unable to queue assessment for marking")
+    except OaMarkerError:
+        return False
+    start_markers()
+    _MARK_WAKE.set()
+    return True
+
+
+# Queued assessments are marked by these threads, in whichever web server
+# process gets to them first.
+_MARKERS = []
+_MARKERS_PID = None
+_MARKERS_LOCK = threading.Lock()
+_MARK_WAKE = threading.Event()
+
+
+def start_markers():
+    """ Make sure the marking threads are running in this process. """
+    global _MARKERS_PID
+    with _MARKERS_LOCK:
+        if _MARKERS_PID == os.getpid():
+            return
+        _MARKERS_PID = os.getpid()   # threads don't survive a fork
+        del _MARKERS[:]
+        for num in range(OaConfig.mark_queue_workers):
+            thread = threading.Thread(target=_marker_loop,
+                                      name="marker-%d" % num)
+            thread.daemon = True
+            thread.start()
+            _MARKERS.append(thread)
+
+
+def _marker_loop():
+    """ Keep marking queued assessments. If there's nothing to do, wait
+        until something is submitted here, or check again in a while in
+        case it was submitted elsewhere.
+    """
+    while True:
+        try:
+            worked = run_marking_job()
+        except Exception as err:
+            L.error("Marking thread problem: %s" % err)
+            worked = False
+        if not worked:
+            _MARK_WAKE.wait(OaConfig.mark_queue_poll)
+            _MARK_WAKE.clear()
+
+
+def run_marking_job():
+    """ Mark the next assessment waiting in the marking queue, if any.
+        Returns False if there was nothing to do.
+    """
+    with DB.pinned_connection():
+        job = Exams.claim_marking_job(stale=OaConfig.mark_queue_stale)
+        if not job:
+            return False
+        (job_id, exam_id, user_id) = job
+        error = None
+        try:
+            if Exams.get_user_status(user_id, exam_id) < 5:
+                submittime = Exams.get_submit_time(exam_id, user_id)
+                if not mark_exam(user_id, exam_id, submittime):
+                    error = "There was a problem marking the assessment"
+        except Exception as err:
+            L.error("Problem marking exam %s for %s: %s" % (exam_id, user_id, err))
+            error = "%s" % err
+        Exams.finish_marking_job(job_id, error)
+    return True
+
+
+def run_marking_queue():
+    """ Mark everything waiting in the marking queue, here and now.
+        Returns how many were done.
+    """
+    done = 0
+    while run_marking_job():
+        done += 1
+    return done
+
+
+def _mark_exam(user_id, exam_id, submittime=None):
+    """ Does the work for mark_exam(), should be called inside a transaction.
+    """
     numquestions = Exams.get_num_questions(exam_id)
     status = Exams.get_user_status(user_id, exam_id)
     L.info("Marking assessment %s for %s, status is %s" % (exam_id, user_id, status))
@@ -35,6 +149,7 @@ def mark_exam(user_id, exam_id):
         # First, mark the question
         try:
             marks = General.mark_q(q_id, answers)
+            DB.remove_q_stats(q_id)    # in case it was marked before
             DB.set_q_status(q_id, 3)    # 3 = marked
             DB.set_q_marktime(q_id)
         except OaMarkerError:
@@ -54,11 +169,12 @@ def mark_exam(user_id, exam_id):
             except (KeyError, ValueError):
                 mark = 0
             total += mark
-            DB.update_q_score(q_id, total)
+        DB.update_q_score(q_id, total)
+        DB.add_q_stats(q_id)
         examtotal += total
 
     Exams.set_user_status(user_id, exam_id, 5)
-    Exams.set_submit_time(user_id, exam_id)
+    Exams.set_submit_time(user_id, exam_id, submittime)
     Exams.save_score(exam_id, user_id, examtotal)
     Exams.touchuserexam(exam_id, user_id)
 
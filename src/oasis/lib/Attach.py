@@ -24,22 +24,33 @@ def is_restricted(fname):
     return False
 
 
-def q_att_details(qtid, version, variation, name):
-    """ Find a question attachment and return its details. """
+def q_att_ref(qtid, version, variation, name):
+    """ Find a question attachment and return (mimetype, content hash). """
     # for the two biggies we hit the question first,
     # otherwise check the question template first
     if name == "image.gif" or name == "qtemplate.html":
-        fname = DB.get_q_att_fname(qtid, name, variation, version)
-        if fname:
-            return DB.get_q_att_mimetype(qtid, name, variation, version), fname
-        fname = DB.get_qt_att_fname(qtid, name, version)
-        if fname:
-            return DB.get_qt_att_mimetype(qtid, name, version), fname
+        hashval = DB.get_q_att_hash(qtid, name, variation, version)
+        if hashval:
+            return DB.get_q_att_mimetype(qtid, name, variation, version), hashval
+        hashval = DB.get_qt_att_hash(qtid, name, version)
+        if hashval:
+            return DB.get_qt_att_mimetype(qtid, name, version), hashval
     else:
-        fname = DB.get_qt_att_fname(qtid, name, version)
-        if fname:
-            return DB.get_qt_att_mimetype(qtid, name, version), fname
-        fname = DB.get_q_att_fname(qtid, name, variation, version)
-        if fname:
-            return DB.get_q_att_mimetype(qtid, name, variation, version), fname
+        hashval = DB.get_qt_att_hash(qtid, name, version)
+        if hashval:
+            return DB.get_qt_att_mimetype(qtid, name, version), hashval
+        hashval = DB.get_q_att_hash(qtid, name, variation, version)
+        if hashval:
+            return DB.get_q_att_mimetype(qtid, name, variation, version), hashval
     return None, None
+
+
+def q_att_details(qtid, version, variation, name):
+    """ Find a question attachment and return its details. """
+    (mtype, hashval) = q_att_ref(qtid, version, variation, name)
+    if not mtype:
+        return None, None
+    fname = DB.get_attach_fname(hashval)
+    if not fname:
+        return None, None
+    return mtype, fname
@@ -314,8 +314,6 @@ def get_topics_all(course, archived=2, numq=True):
                            'archived': row[4]}
             if info[count]['position'] is None or info[count]['position'] is "None":
                 info[count]['position'] = 0
-            if numq:
-                info[count]['numquestions'] = Topics.get_num_qs(int(row[0]))
             count += 1
     else:  # we probably don't have the archived flag in the Db yet
         ret = run_sql(
@@ -332,9 +330,11 @@ def get_topics_all(course, archived=2, numq=True):
                                'visibility': row[3]}
                 if info[count]['position'] is None or info[count]['position'] is "None":
                     info[count]['position'] = 0
-                if numq:
-                    info[count]['numquestions'] = Topics.get_num_qs(int(row[0]))
                 count += 1
+    if numq and info:
+        nums = Topics.get_num_qs_multi([topic['id'] for topic in info.values()])
+        for topic in info.values():
+            topic['numquestions'] = nums[topic['id']]
     return info
 
 
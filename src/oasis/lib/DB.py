@@ -14,6 +14,9 @@ import psycopg2
 import cPickle
 import datetime
 import json
+import hashlib
+import threading
+from contextlib import contextmanager
 
 IntegrityError = psycopg2.IntegrityError
 
@@ -25,27 +28,178 @@ from logging import getLogger
 L = getLogger("oasisqe")
 
 
-# 3 connections. Lets us keep going if one is slow but
+# A few connections. Lets us keep going if one is slow but
 # doesn't overload the server if there're a lot of us
-dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring, 9)
+dbpool = Pool.DbPool(OaConfig.oasisdbconnectstring,
+                     OaConfig.dbpool_size,
+                     maxsize=OaConfig.dbpool_max,
+                     overflow=OaConfig.dbpool_overflow,
+                     timeout=OaConfig.dbpool_timeout,
+                     recheck=OaConfig.dbpool_recheck)
 
 # Cache stuff on local drives to save our poor database
-fileCache = Pool.FileCache(OaConfig.cachedir)
+fileCache = Pool.FileCache(OaConfig.cachedir,
+                           maxbytes=OaConfig.cachedir_maxbytes,
+                           rescan=OaConfig.cachedir_rescan)
 
-from Pool import MCPool
+from Pool import MCPool, LocalCache
+
+# Keep a copy of the quieter things in this process too. Needs memcached,
+# which is how other processes tell us when something has changed.
+if OaConfig.enableMemcache and OaConfig.localcache_entries > 0:
+    localcache = LocalCache(OaConfig.localcache_entries,
+                            OaConfig.localcache_bytes,
+                            OaConfig.localcache_ttl)
+else:
+    localcache = None
 
 # Get a pool of memcache connections to use
-MC = MCPool('127.0.0.1:11211', 9)
+MC = MCPool('127.0.0.1:11211', 9,
+            local=localcache,
+            namespaces=OaConfig.localcache_namespaces,
+            version_check=OaConfig.localcache_version_check)
+
+
+# A connection can be "pinned" to the current thread (eg. for the duration of
+# a web request) so that all the run_sql calls it makes share one connection
+# rather than going back to the pool each time.
+_pinned = threading.local()
 
 
 def run_sql(sql, params=None, quiet=False):
     """ Execute SQL commands using the dbpool"""
+    if getattr(_pinned, 'active', False):
+        if not _pinned.conn:
+            _pinned.conn = dbpool.start()
+        return _pinned.conn.run_sql(sql, params, quiet=quiet)
     conn = dbpool.start()
-    res = conn.run_sql(sql, params, quiet=quiet)
-    dbpool.finish(conn)
+    try:
+        res = conn.run_sql(sql, params, quiet=quiet)
+    finally:
+        dbpool.finish(conn)
     return res
 
 
+def iter_sql(sql, params=None, batchsize=1000):
+    """ Like run_sql for a SELECT, but generates the rows a batch at a time
+        rather than fetching them all first, for big results that are
+        streamed out. It has a connection of its own (not the pinned one)
+        until it's finished or closed.
+    """
+    conn = dbpool.start()
+    try:
+        for row in conn.iter_sql(sql, params, batchsize):
+            yield row
+    finally:
+        dbpool.finish(conn)
+
+
+def pin_connection():
+    """ Use a single database connection for all run_sql calls made by this
+        thread until release_connection() is called. The connection isn't
+        taken from the pool until it's first needed.
+        Returns False if a connection was already pinned.
+    """
+    if getattr(_pinned, 'active', False):
+        return False
+    _pinned.active = True
+    _pinned.conn = None
+    _pinned.transdepth = 0
+    _pinned.qinstances = {}
+    _pinned.forget = set()
+    return True
+
+
+def release_connection():
+    """ Hand the pinned connection (if any) back to the pool. Any transaction
+        left open is rolled back.
+    """
+    if not getattr(_pinned, 'active', False):
+        return
+    conn = _pinned.conn
+    _pinned.active = False
+    _pinned.conn = None
+    _pinned.qinstances = {}
+    if _pinned.transdepth:
+        L.error("Connection released with a transaction still open, "
+                "rolling back.")
+        _pinned.transdepth = 0
+        _pinned.forget = set()
+        if conn:
+            conn.rollback()
+    if conn:
+        dbpool.finish(conn)
+
+
+@contextmanager
+def pinned_connection():
+    """ Context manager to pin one connection for the duration of the block.
+
+        with DB.pinned_connection():
+            ... lots of run_sql ...
+    """
+    mine = pin_connection()
+    try:
+        yield
+    finally:
+        if mine:
+            release_connection()
+
+
+@contextmanager
+def connection_released():
+    """ Hand the pinned connection (if any) back to the pool for the duration
+        of the block, eg. while waiting on something slow. Another is taken
+        when it's next needed. If a transaction is open the connection is
+        kept, since it can't be handed back part way through.
+    """
+    if getattr(_pinned, 'active', False) and _pinned.conn \
+            and not _pinned.transdepth:
+        conn = _pinned.conn
+        _pinned.conn = None
+        dbpool.finish(conn)
+    yield
+
+
+@contextmanager
+def transaction():
+    """ Run everything inside the block as a single database transaction.
+        It's committed when the block finishes, or rolled back if an exception
+        escapes. Nested transaction() blocks become part of the outermost one.
+
+        with DB.transaction():
+            run_sql("UPDATE ...")
+            run_sql("INSERT ...")
+
+        Note that a failing statement (even with quiet=True) aborts the
+        whole transaction.
+    """
+    mine = pin_connection()
+    try:
+        if not _pinned.conn:
+            _pinned.conn = dbpool.start()
+        if _pinned.transdepth == 0:
+            _pinned.conn.begin()
+        _pinned.transdepth += 1
+        try:
+            yield
+        except BaseException:
+            _pinned.transdepth -= 1
+            if _pinned.transdepth == 0:
+                _pinned.forget = set()    # nothing changed after all
+                _pinned.conn.rollback()
+            raise
+        _pinned.transdepth -= 1
+        if _pinned.transdepth == 0:
+            try:
+                _pinned.conn.commit()
+            finally:
+                _forget_pending()
+    finally:
+        if mine:
+            release_connection()
+
+
 def set_logger(logger):
     """ Set the logger used by the DB Layer
     """
@@ -63,6 +217,7 @@ def set_q_viewtime(question):
     run_sql("""UPDATE questions
                SET firstview=NOW()
                WHERE question=%s;""", (question,))
+    _forget_q_instance(question)
 
 
 def set_q_marktime(question):
@@ -74,6 +229,7 @@ def set_q_marktime(question):
     run_sql("""UPDATE questions
                SET marktime=NOW()
                WHERE question=%s;""", (question,))
+    _forget_q_instance(question)
 
 
 def get_q_viewtime(question):
@@ -159,6 +315,7 @@ def update_q_score(q_id, score):
         return
     run_sql("""UPDATE questions SET score=%s WHERE question=%s;""",
             ("%.1f" % sc, q_id))
+    _forget_q_instance(q_id)
 
 
 def set_q_status(q_id, status):
@@ -166,32 +323,108 @@ def set_q_status(q_id, status):
     assert isinstance(q_id, int)
     assert isinstance(status, int)
     run_sql("UPDATE questions SET status=%s WHERE question=%s;", (status, q_id))
+    _forget_q_instance(q_id)
+
+
+class QuestionInstance(object):
+    """ The row from the questions table for one generated question.
+        Load with get_q_instance() rather than creating directly.
+    """
+
+    FIELDS = ('id', 'qtemplate', 'status', 'name', 'student', 'score',
+              'firstview', 'marktime', 'variation', 'version', 'exam')
+
+    def __init__(self, row):
+        """ row is the columns from the database, in the order of FIELDS """
+        for field, value in zip(self.FIELDS, row):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return "<QuestionInstance %s of qt %s, var %s, ver %s>" % (
+            self.id, self.qtemplate, self.variation, self.version)
+
+
+def _forget_q_instance(q_id):
+    """ The question row has changed, drop any copies we're holding.
+        Inside a transaction the cached copy is dropped once it commits,
+        otherwise someone could cache the old row again in between.
+    """
+    if getattr(_pinned, 'active', False):
+        _pinned.qinstances.pop(q_id, None)
+        if _pinned.transdepth:
+            _pinned.forget.add(q_id)
+            return
+    MC.delete("question-%d-instance" % q_id)
+
+
+def _forget_pending():
+    """ The transaction has finished, drop the cached copies of the
+        questions it changed.
+    """
+    for q_id in _pinned.forget:
+        MC.delete("question-%d-instance" % q_id)
+    _pinned.forget = set()
+
+
+def get_q_instance(q_id):
+    """ Return a QuestionInstance with all the details of the question,
+        or None if it doesn't exist.
+        Remembered for the rest of the request, and cached for a while.
+    """
+    assert isinstance(q_id, int)
+    memo = None
+    changing = False   # by our transaction, so not for the cache yet
+    if getattr(_pinned, 'active', False):
+        memo = _pinned.qinstances
+        if q_id in memo:
+            return memo[q_id]
+        changing = q_id in _pinned.forget
+
+    key = "question-%d-instance" % q_id
+    row = None
+    if not changing:
+        row = MC.get(key)
+    if not row:
+        ret = run_sql("""SELECT question, qtemplate, status, name, student,
+                                score, firstview, marktime, variation,
+                                version, exam
+                         FROM questions
+                         WHERE question=%s;""", (q_id,))
+        if not ret:
+            return None
+        row = tuple(ret[0])
+        if not changing:
+            MC.set(key, row, 300)  # 5 minutes
+    qinst = QuestionInstance(row)
+    if memo is not None:
+        memo[q_id] = qinst
+    return qinst
 
 
 def get_q_version(q_id):
     """ Return the template version this question was generated from """
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT version FROM questions WHERE question=%s;", (q_id,))
-    if ret:
-        return int(ret[0][0])
+    qinst = get_q_instance(q_id)
+    if qinst and qinst.version is not None:
+        return int(qinst.version)
     return None
 
 
 def get_q_variation(q_id):
     """ Return the template variation this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT variation FROM questions WHERE question=%s;", (q_id,))
-    if ret:
-        return int(ret[0][0])
+    qinst = get_q_instance(q_id)
+    if qinst and qinst.variation is not None:
+        return int(qinst.variation)
     return None
 
 
 def get_q_parent(q_id):
     """ Return the template this question was generated from"""
     assert isinstance(q_id, int)
-    ret = run_sql("SELECT qtemplate FROM questions WHERE question=%s;", (q_id,))
-    if ret:
-        return int(ret[0][0])
+    qinst = get_q_instance(q_id)
+    if qinst and qinst.qtemplate is not None:
+        return int(qinst.qtemplate)
     L.error("No parent found for question %s!" % q_id)
     return None
 
@@ -207,6 +440,25 @@ def save_guess(q_id, part, value):
                    VALUES (%s, NOW(), %s, %s);""", (q_id, part, value))
 
 
+def save_guesses(q_id, guesses):
+    """ Store several guesses for a question in the database at once.
+        guesses is a dict of  {part: value}
+    """
+    assert isinstance(q_id, int)
+    assert isinstance(guesses, dict)
+    values = []
+    params = []
+    for part in sorted(guesses.keys()):
+        value = guesses[part]
+        assert isinstance(part, int)
+        assert isinstance(value, unicode)
+        values.append("(%s, NOW(), %s, %s)")
+        params.extend((q_id, part, value))
+    if values:
+        run_sql("""INSERT INTO guesses (question, created, part, guess)
+                   VALUES %s;""" % ", ".join(values), params)
+
+
 def get_q_guesses(q_id):
     """ Return a dictionary of the recent guesses in a question."""
     assert isinstance(q_id, int)
@@ -244,6 +496,79 @@ def get_q_guesses_before_time(q_id, lasttime):
     return guesses
 
 
+def get_exam_q_instances(exam_id, students=None):
+    """ Return QuestionInstances for all the questions generated for the
+        exam, or just those of the given students.
+    """
+    assert isinstance(exam_id, int)
+    sql = """SELECT question, qtemplate, status, name, student,
+                    score, firstview, marktime, variation,
+                    version, exam
+             FROM questions
+             WHERE exam=%s"""
+    params = [exam_id]
+    if students is not None:
+        sql += " AND student = ANY(%s)"
+        params.append(list(students))
+    ret = run_sql(sql + " ORDER BY student, question;", params)
+    if not ret:
+        return []
+    return [QuestionInstance(tuple(row)) for row in ret]
+
+
+def get_exam_guesses_before_marktime(exam_id, students=None):
+    """ Return the guesses in all the exam's questions, or just those of the
+        given students, made before the student's assessment was marked, as
+        get_q_guesses_before_time would give for each question.
+        Returns {q_id: {"G1": guess, ...}}
+    """
+    assert isinstance(exam_id, int)
+    only = ""
+    params = [exam_id, exam_id]
+    if students is not None:
+        only = "AND q.student = ANY(%s)"
+        params.append(list(students))
+    ret = run_sql("""SELECT g.question, g.part, g.guess
+                     FROM guesses AS g,
+                          questions AS q,
+                          (SELECT student, MAX(marktime) AS endtime
+                           FROM questions
+                           WHERE exam=%%s
+                           GROUP BY student) AS m
+                     WHERE q.exam=%%s
+                       AND g.question=q.question
+                       AND m.student=q.student
+                       AND g.created < m.endtime
+                       %s
+                     ORDER BY g.created DESC;""" % only, params)
+    guesses = {}
+    if not ret:
+        return guesses
+    for row in ret:
+        qguesses = guesses.setdefault(int(row[0]), {})
+        if not "G%d" % (int(row[1])) in qguesses:
+            qguesses["G%d" % (int(row[1]))] = row[2]
+    return guesses
+
+
+def update_q_scores(scores, batch=500):
+    """ Set the score of many questions, {q_id: score}, a batch at a time."""
+    assert isinstance(scores, dict)
+    q_ids = scores.keys()
+    for pos in range(0, len(q_ids), batch):
+        chunk = q_ids[pos:pos + batch]
+        params = []
+        for q_id in chunk:
+            params.extend((q_id, "%.1f" % float(scores[q_id])))
+        run_sql("""UPDATE questions SET score=v.score
+                   FROM (VALUES %s) AS v(question, score)
+                   WHERE questions.question=v.question;""" %
+                ", ".join(["(%s, CAST(%s AS REAL))"] * len(chunk)),
+                params)
+        for q_id in chunk:
+            _forget_q_instance(q_id)
+
+
 def get_qt_by_embedid(embed_id):
     """ Find the question template with the given embed_id,
         or raise KeyError if not found.
@@ -310,7 +635,9 @@ def update_qt_embedid(qt_id, embed_id):
         embed_id = None
     sql = "UPDATE qtemplates SET embed_id=%s WHERE qtemplate=%s"
     params = (embed_id, qt_id)
-    if run_sql(sql, params) is False:  # could be [], which is success
+    result = run_sql(sql, params)
+    MC.delete("qtemplate-%d-embedid" % qt_id)
+    if result is False:  # could be [], which is success
         return False
     return True
 
@@ -325,17 +652,24 @@ def incr_qt_version(qt_id):
     run_sql("""UPDATE qtemplates
                SET version=%s
                WHERE qtemplate=%s;""", (version, qt_id))
+    MC.delete("qtemplate-%d-version" % qt_id)
     return version
 
 
 def get_qt_version(qt_id):
     """ Fetch the version of a question template."""
     assert isinstance(qt_id, int)
+    key = "qtemplate-%d-version" % qt_id
+    obj = MC.get(key)
+    if obj is not None and obj is not False:  # False if memcache had trouble
+        return obj
     ret = run_sql("""SELECT version
                      FROM qtemplates
                      WHERE qtemplate=%s;""", (qt_id,))
     if ret:
-        return int(ret[0][0])
+        version = int(ret[0][0])
+        MC.set(key, version)
+        return version
     raise KeyError("Question Template version %s not found" % qt_id)
 
 
@@ -396,6 +730,10 @@ def get_qt_name(qt_id):
 def get_qt_embedid(qt_id):
     """ Fetch the embed_id of a question template."""
     assert isinstance(qt_id, int)
+    key = "qtemplate-%d-embedid" % qt_id
+    obj = MC.get(key)
+    if obj is not None and obj is not False:
+        return obj
     ret = run_sql("""SELECT embed_id
                      FROM qtemplates
                      WHERE qtemplate=%s;""", (qt_id,))
@@ -403,6 +741,7 @@ def get_qt_embedid(qt_id):
         embed_id = ret[0][0]
         if not embed_id:
             embed_id = ""
+        MC.set(key, embed_id)
         return embed_id
     L.warn("Request for unknown question template %s." % qt_id)
 
@@ -491,11 +830,93 @@ def get_qt_att_mimetype(qt_id, name, version=1000000000):
     return value
 
 
-def get_q_att_fname(qt_id, name, variation, version=1000000000):
-    """ Fetch the on-disk filename where the attachment is stored.
-        This may have to fetch it from the database.
-        The intent is to save time by passing around a filename rather than the
-        entire attachment.
+def attach_hash(data):
+    """ The content hash attachment data is stored under."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def store_attach_data(data):
+    """ Store the contents of an attachment, unless we already have an
+        identical copy, and return the hash to refer to it by.
+    """
+    assert isinstance(data, str)
+    hashval = attach_hash(data)
+    ret = run_sql("SELECT 1 FROM attachdata WHERE hash=%s;", (hashval,))
+    if not ret:
+        try:
+            run_sql("""INSERT INTO attachdata (hash, size, data)
+                       VALUES (%s, %s, %s);""",
+                    (hashval, len(data), psycopg2.Binary(data)))
+        except IntegrityError:
+            # Someone else stored the same thing at the same moment.
+            pass
+    return hashval
+
+
+def get_attach_data(hashval):
+    """ Fetch the attachment contents with the given hash."""
+    key = "attachdata/%s" % hashval
+    (value, found) = fileCache.get(key)
+    if found:
+        return value
+    ret = run_sql("SELECT data FROM attachdata WHERE hash=%s;", (hashval,))
+    if not ret:
+        L.error("Attachment data %s is missing!" % hashval)
+        return False
+    data = str(ret[0][0])
+    fileCache.set(key, data)
+    return data
+
+
+def get_attach_fname(hashval):
+    """ Fetch the on-disk filename of the attachment contents with the
+        given hash.
+    """
+    key = "attachdata/%s" % hashval
+    (filename, found) = fileCache.get_filename(key)
+    if found:
+        return filename
+    if get_attach_data(hashval) is False:
+        return False
+    (filename, found) = fileCache.get_filename(key)
+    if found:
+        return filename
+    return False
+
+
+def _adopt_attach_data(table, att_id, data):
+    """ An attachment from before attachdata existed still has its
+        contents in the row. Move them across and return the hash.
+    """
+    assert table in ("qattach", "qtattach")
+    hashval = store_attach_data(data)
+    run_sql("""UPDATE %s SET hash=%%s, data=NULL WHERE %s=%%s;""" %
+            (table, table), (hashval, att_id))
+    return hashval
+
+
+def dedup_attach_data(batch=200):
+    """ Move the contents of any attachments from before attachdata existed
+        across, so identical ones are only stored once.
+        Returns the number of attachments moved.
+    """
+    moved = 0
+    for table in ("qattach", "qtattach"):
+        while True:
+            ret = run_sql("""SELECT %s, data FROM %s
+                             WHERE hash IS NULL AND data IS NOT NULL
+                             LIMIT %d;""" % (table, table, batch))
+            if not ret:
+                break
+            for row in ret:
+                _adopt_attach_data(table, row[0], str(row[1]))
+                moved += 1
+    return moved
+
+
+def get_q_att_hash(qt_id, name, variation, version=1000000000):
+    """ Return the content hash of the question attachment, or False if
+        there isn't one.
     """
     assert isinstance(qt_id, int)
     assert isinstance(version, int)
@@ -503,25 +924,74 @@ def get_q_att_fname(qt_id, name, variation, version=1000000000):
     assert isinstance(name, str) or isinstance(name, unicode)
     if version == 1000000000:
         version = get_qt_version(qt_id)
-    key = "questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
-    (filename, found) = fileCache.get_filename(key)
-    if not found:
-        ret = run_sql("""SELECT qtemplate, data
-                            FROM qattach
-                            WHERE qtemplate=%s
-                            AND name=%s
-                            AND variation=%s
-                            AND version=%s;""",
-                      (qt_id, name, variation, version))
-        if ret:
-            data = str(ret[0][1])
-            fileCache.set(key, data)
-            (filename, found) = fileCache.get_filename(key)
-            if found:
-                return filename
-        fileCache.set(key, False)
+    key = "questionattach/%d/%s/%d/%d/hash" % (qt_id, name, variation, version)
+    (hashval, found) = fileCache.get(key)
+    if found and hashval:
+        return hashval
+    ret = run_sql("""SELECT qattach, hash, CASE WHEN hash IS NULL THEN data END
+                        FROM qattach
+                        WHERE qtemplate=%s
+                        AND name=%s
+                        AND variation=%s
+                        AND version=%s;""",
+                  (qt_id, name, variation, version))
+    if not ret:
+        return False
+    hashval = ret[0][1]
+    if not hashval:
+        if ret[0][2] is None:
+            return False
+        hashval = _adopt_attach_data("qattach", ret[0][0], str(ret[0][2]))
+    fileCache.set(key, hashval)
+    return hashval
+
+
+def get_qt_att_hash(qt_id, name, version=1000000000):
+    """ Return the content hash of the question template attachment, or
+        False if there isn't one.
+        If version is set to 0, will fetch the newest.
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    assert isinstance(name, str) or isinstance(name, unicode)
+    if version == 1000000000:
+        version = get_qt_version(qt_id)
+    key = "qtemplateattach/%d/%s/%d/hash" % (qt_id, name, version)
+    (hashval, found) = fileCache.get(key)
+    if found and hashval:
+        return hashval
+    ret = run_sql("""SELECT qtattach, hash, CASE WHEN hash IS NULL THEN data END
+                     FROM qtattach
+                     WHERE qtemplate = %s
+                       AND name = %s
+                       AND version =
+                         (SELECT MAX(version)
+                          FROM qtattach
+                          WHERE qtemplate=%s
+                            AND version <= %s
+                            AND name=%s);""",
+                  (qt_id, name, qt_id, version, name))
+    if not ret:
+        return False
+    hashval = ret[0][1]
+    if not hashval:
+        if ret[0][2] is None:
+            return False
+        hashval = _adopt_attach_data("qtattach", ret[0][0], str(ret[0][2]))
+    fileCache.set(key, hashval)
+    return hashval
+
+
+def get_q_att_fname(qt_id, name, variation, version=1000000000):
+    """ Fetch the on-disk filename where the attachment is stored.
+        This may have to fetch it from the database.
+        The intent is to save time by passing around a filename rather than the
+        entire attachment.
+    """
+    hashval = get_q_att_hash(qt_id, name, variation, version)
+    if not hashval:
         return False
-    return filename
+    return get_attach_fname(hashval)
 
 
 def get_q_att(qt_id, name, variation, version=1000000000):
@@ -536,89 +1006,30 @@ def get_q_att(qt_id, name, variation, version=1000000000):
         L.warn("Request for unknown qt version. get_qt_att(%s, %s, %s, %s)" %
             (qt_id, name, variation, version))
         return None
-    key = "questionattach/%d/%s/%d/%d" % (qt_id, name, variation, version)
-    (value, found) = fileCache.get(key)
-    if not found:
-        ret = run_sql("""SELECT qtemplate, data
-                            FROM qattach
-                            WHERE qtemplate=%s
-                            AND name=%s
-                            AND variation=%s
-                            AND version=%s;""",
-                      (qt_id, name, variation, version))
-        if ret:
-            data = str(ret[0][1])
-            fileCache.set(key, data)
-            return data
-        fileCache.set(key, False)
+    hashval = get_q_att_hash(qt_id, name, variation, version)
+    if not hashval:
         return get_qt_att(qt_id, name, version)
-    return value
+    return get_attach_data(hashval)
 
 
 def get_qt_att_fname(qt_id, name, version=1000000000):
     """ Fetch a filename for the attachment in the question template.
         If version is set to 0, will fetch the newest.
     """
-    assert isinstance(qt_id, int)
-    assert isinstance(version, int)
-    assert isinstance(name, str) or isinstance(name, unicode)
-    if version == 1000000000:
-        version = get_qt_version(qt_id)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
-    (filename, found) = fileCache.get_filename(key)
-    if (not found) or version == 1000000000:
-        ret = run_sql("""SELECT data
-                         FROM qtattach
-                         WHERE qtemplate = %s
-                           AND name = %s
-                           AND version =
-                             (SELECT MAX(version)
-                              FROM qtattach
-                              WHERE qtemplate=%s
-                                AND version <= %s
-                                AND name=%s);""",
-                      (qt_id, name, qt_id, version, name))
-        if ret:
-            data = str(ret[0][0])
-            fileCache.set(key, data)
-            (filename, found) = fileCache.get_filename(key)
-            if found:
-                return filename
-        fileCache.set(key, False)
+    hashval = get_qt_att_hash(qt_id, name, version)
+    if not hashval:
         return False
-    return filename
+    return get_attach_fname(hashval)
 
 
 def get_qt_att(qt_id, name, version=1000000000):
     """ Fetch an attachment for the question template.
         If version is set to 0, will fetch the newest.
     """
-    assert isinstance(qt_id, int)
-    assert isinstance(version, int)
-    assert isinstance(name, str) or isinstance(name, unicode)
-    if version == 1000000000:
-        version = get_qt_version(qt_id)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
-    (value, found) = fileCache.get(key)
-    if (not found) or version == 1000000000:
-        ret = run_sql("""SELECT data
-                         FROM qtattach
-                         WHERE qtemplate = %s
-                           AND name = %s
-                           AND version =
-                             (SELECT MAX(version)
-                              FROM qtattach
-                              WHERE qtemplate=%s
-                                AND version <= %s
-                                AND name=%s);""",
-                      (qt_id, name, qt_id, version, name))
-        if ret:
-            data = str(ret[0][0])
-            fileCache.set(key, data)
-            return data
-        fileCache.set(key, False)
+    hashval = get_qt_att_hash(qt_id, name, version)
+    if not hashval:
         return False
-    return value
+    return get_attach_data(hashval)
 
 
 def get_exam_qts_in_pos(exam_id, position):
@@ -771,6 +1182,25 @@ def get_qt_num_variations(qt_id, version=1000000000):
     return num
 
 
+def get_q_att_variations(qt_id, names, version):
+    """ Return a dict of which variations of the qtemplate version already
+        have each of the named attachments generated.
+        { name: set(variation, ...) }
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(version, int)
+    found = dict((name, set()) for name in names)
+    ret = run_sql("""SELECT name, variation
+                     FROM qattach
+                     WHERE qtemplate=%s
+                       AND version=%s
+                       AND name = ANY(%s);""", (qt_id, version, list(names)))
+    if ret:
+        for row in ret:
+            found[row[0]].add(int(row[1]))
+    return found
+
+
 def create_q_att(qt_id, variation, name, mimetype, data, version):
     """ Create a new Question Attachment using given data."""
     assert isinstance(qt_id, int)
@@ -782,10 +1212,14 @@ def create_q_att(qt_id, variation, name, mimetype, data, version):
     if not name and not data:
         L.warn("Refusing to create empty attachment for question %s" % qt_id)
         return
-    safedata = psycopg2.Binary(data)
-    run_sql("""INSERT INTO qattach (qtemplate, variation, mimetype, name, data, version)
-               VALUES (%s, %s, %s, %s, %s, %s);""",
-               (qt_id, variation, mimetype, name, safedata, version))
+    if isinstance(data, unicode):
+        data = data.encode("utf8")
+    hashval = store_attach_data(data)
+    # Someone else may have generated the same one at the same time
+    run_sql("""INSERT INTO qattach (qtemplate, variation, mimetype, name, hash, version)
+               VALUES (%s, %s, %s, %s, %s, %s)
+               ON CONFLICT (qtemplate, version, variation, name) DO NOTHING;""",
+               (qt_id, variation, mimetype, name, hashval, version))
 
 
 def create_qt_att(qt_id, name, mimetype, data, version):
@@ -795,19 +1229,31 @@ def create_qt_att(qt_id, name, mimetype, data, version):
     assert isinstance(mimetype, str) or isinstance(mimetype, unicode)
     assert isinstance(data, str) or isinstance(data, unicode)
     assert isinstance(version, int)
-    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
-    MC.delete(key)
     if not data:
         data = ""
     if isinstance(data, unicode):
         data = data.encode("utf8")
-    safedata = psycopg2.Binary(data)
-    run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, data, version)
-               VALUES (%s, %s, %s, %s, %s);""",
-            (qt_id, mimetype, name, safedata, version))
+    hashval = store_attach_data(data)
+    create_qt_att_ref(qt_id, name, mimetype, hashval, version)
     return None
 
 
+def create_qt_att_ref(qt_id, name, mimetype, hashval, version):
+    """ Create a new Question Template Attachment with contents that
+        have already been stored (eg. copied from another attachment).
+    """
+    assert isinstance(qt_id, int)
+    assert isinstance(name, str) or isinstance(name, unicode)
+    assert isinstance(mimetype, str) or isinstance(mimetype, unicode)
+    assert isinstance(version, int)
+    key = "qtemplateattach/%d/%s/%d" % (qt_id, name, version)
+    MC.delete(key)
+    fileCache.set("%s/hash" % key, False)
+    run_sql("""INSERT INTO qtattach (qtemplate, mimetype, name, hash, version)
+               VALUES (%s, %s, %s, %s, %s);""",
+            (qt_id, mimetype, name, hashval, version))
+
+
 def create_q(qt_id, name, student, status, variation, version, exam):
     """ Add a question (instance) to the database."""
     assert isinstance(qt_id, int)
@@ -972,11 +1418,15 @@ def copy_qt_all(qt_id):
     attachments = get_qt_atts(qt_id)
     newversion = get_qt_version(newid)
     for name in attachments:
-        create_qt_att(newid,
-                      name,
-                      get_qt_att_mimetype(qt_id, name),
-                      get_qt_att(qt_id, name),
-                      newversion)
+        # Same contents, so no need to fetch and store them again
+        hashval = get_qt_att_hash(qt_id, name)
+        if not hashval:
+            continue
+        create_qt_att_ref(newid,
+                          name,
+                          get_qt_att_mimetype(qt_id, name),
+                          hashval,
+                          newversion)
     try:
         variations = get_qt_variations(qt_id)
         for variation in variations.keys():
@@ -1119,24 +1569,79 @@ def get_course_exam_all(course_id, prev_years=False):
 
 def add_exam_q(user, exam, question, position):
     """Record that the student was assigned the given question for assessment.
+       If they already have a question in that position it's kept instead.
+       Returns the question they have in that position.
     """
     assert isinstance(user, int)
     assert isinstance(exam, int)
     assert isinstance(question, int)
     assert isinstance(position, int)
-    sql = """SELECT id FROM examquestions
-              WHERE exam = %s
-              AND student = %s
-              AND position = %s
-              AND question = %s;"""
-    params = (exam, user, position, question)
-    ret = run_sql(sql, params)
-    if ret:  # already exists
-        return
-    run_sql("INSERT INTO examquestions (exam, student, position, question) "
-            "VALUES (%s, %s, %s, %s);",
-            (exam, user, position, question))
+    ret = run_sql("""INSERT INTO examquestions (exam, student, position, question)
+                     VALUES (%s, %s, %s, %s)
+                     ON CONFLICT (exam, student, position) DO NOTHING
+                     RETURNING question;""",
+                  (exam, user, position, question))
+    if not ret:  # already had one
+        return get_exam_q_by_pos_student(exam, position, user)
     touch_user_exam(exam, user)
+    return question
+
+
+def get_exam_assigned(exam_id):
+    """ Return a set of (student, position) for the questions already
+        assigned in the assessment.
+    """
+    assert isinstance(exam_id, int)
+    ret = run_sql("""SELECT student, position FROM examquestions
+                     WHERE exam=%s;""", (exam_id,))
+    if not ret:
+        return set()
+    return set([(int(row[0]), int(row[1])) for row in ret])
+
+
+def create_exam_qs(exam_id, assignments, batch=500):
+    """ Create lots of assessment questions at once, eg. to have them ready
+        before it starts. assignments is a list of
+            (student, position, qt_id, name, variation, version)
+        Anything the student already has in that position is left alone.
+        Returns the number of questions assigned.
+    """
+    assert isinstance(exam_id, int)
+    if not assignments:
+        return 0
+    ret = run_sql("""SELECT nextval('questions_question_seq')
+                     FROM generate_series(1, %s);""", (len(assignments),))
+    q_ids = [int(row[0]) for row in ret]
+    created = 0
+    for pos in range(0, len(assignments), batch):
+        chunk = zip(q_ids[pos:pos + batch], assignments[pos:pos + batch])
+        params = []
+        for (q_id, (student, position, qt_id, name, variation, version)) in chunk:
+            params.extend((q_id, qt_id, name, student, variation, version, exam_id))
+        run_sql("""INSERT INTO questions (question, qtemplate, name, student,
+                                          status, variation, version, exam)
+                   VALUES %s;""" %
+                ", ".join(["(%s, %s, %s, %s, 1, %s, %s, %s)"] * len(chunk)),
+                params)
+        params = []
+        for (q_id, (student, position, qt_id, name, variation, version)) in chunk:
+            params.extend((exam_id, student, position, q_id))
+        ret = run_sql("""INSERT INTO examquestions (exam, student, position, question)
+                         VALUES %s
+                         ON CONFLICT (exam, student, position) DO NOTHING
+                         RETURNING question;""" %
+                      ", ".join(["(%s, %s, %s, %s)"] * len(chunk)),
+                      params)
+        used = set([int(row[0]) for row in ret or []])
+        created += len(used)
+        unused = [q_id for (q_id, assignment) in chunk if q_id not in used]
+        if unused:   # someone got there first
+            run_sql("DELETE FROM questions WHERE question = ANY(%s);",
+                    (unused,))
+    students = list(set([assignment[0] for assignment in assignments]))
+    run_sql("""UPDATE userexams SET lastchange=NOW()
+               WHERE exam=%s AND student = ANY(%s);""", (exam_id, students))
+    return created
 
 
 def get_student_q_practice_num(user_id, qt_id):
@@ -1199,6 +1704,23 @@ def get_prac_stats_user_qt(user_id, qt_id):
     return None
 
 
+def _practice_age(age):
+    """ Turn the seconds since a practice was marked into
+        (human readable age, seconds).
+    """
+    ageseconds = 10000000000  # could be from before we tracked it.
+    try:
+        age = int(age)
+        ageseconds = age
+        if age > 63000000:    # more than two years
+            age = "more than 2 years"
+        else:
+            age = secs_to_human(age)
+    except (TypeError, ValueError):
+        age = "more than 2 years"
+    return age, ageseconds
+
+
 def get_student_q_practice_stats(user_id, qt_id, num=3):
     """Return data on the scores obtained while practicing the given question
        the last 'num' times. Exclude assessed scores. If num is not provided,
@@ -1230,17 +1752,7 @@ def get_student_q_practice_stats(user_id, qt_id, num=3):
     stats = []
     if ret:
         for row in ret:
-            ageseconds = 10000000000  # could be from before we tracked it.
-            age = row[2]
-            try:
-                age = int(age)
-                ageseconds = age
-                if age > 63000000:    # more than two years
-                    age = "more than 2 years"
-                else:
-                    age = secs_to_human(age)
-            except (TypeError, ValueError):
-                age = "more than 2 years"
+            age, ageseconds = _practice_age(row[2])
             stats.append({
                 'score': float(row[0]),
                 'question': int(row[1]),
@@ -1252,26 +1764,188 @@ def get_student_q_practice_stats(user_id, qt_id, num=3):
     return None
 
 
+# Which marked questions count towards the class statistics. Anything
+# done in under 20 seconds or over 2 hours isn't a real attempt. Only those
+# with a score can be added into the sums.
+_Q_STATS_WHERE = """q.score IS NOT NULL
+                 AND q.marktime <= NOW()
+                 AND (q.marktime - q.firstview) > '00:00:20'
+                 AND (q.marktime - q.firstview) < '02:00:01'"""
+
+# COUNT, AVG, STDDEV, MAX, MIN from the sums kept in stats_q_course
+_Q_STATS_COLUMNS = """SUM("number"),
+                    SUM(total) / SUM("number"),
+                    SQRT(GREATEST(0, (SUM(totalsq) - SUM(total) * SUM(total) / SUM("number"))
+                                     / NULLIF(SUM("number") - 1, 0))),
+                    MAX(maxscore),
+                    MIN(minscore)"""
+
+
+def _q_ids(q_ids):
+    """ add_q_stats and remove_q_stats take one question or a list of them """
+    if isinstance(q_ids, (int, long)):
+        return [q_ids]
+    return [int(q_id) for q_id in q_ids]
+
+
+def add_q_stats(q_ids):
+    """ Count the (just marked) question, or list of questions, in the class
+        statistics of each course the student is in. Which course rows
+        each is counted in is kept in stats_q_counted, for remove_q_stats.
+        Does nothing for those that don't qualify or are already counted.
+    """
+    q_ids = _q_ids(q_ids)
+    if not q_ids:
+        return
+    run_sql("""WITH counted AS (
+                   INSERT INTO stats_q_counted
+                       (question, course, qtemplate, "month", score)
+                   SELECT DISTINCT q.question, gc.course, q.qtemplate,
+                          CAST(date_trunc('month', q.marktime) AS date),
+                          q.score
+                   FROM questions AS q
+                   JOIN usergroups AS ug ON ug.userid = q.student
+                   JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                   WHERE q.question = ANY(%s)
+                     AND """ + _Q_STATS_WHERE + """
+                   ON CONFLICT (question, course) DO NOTHING
+                   RETURNING course, qtemplate, "month", score
+               )
+               INSERT INTO stats_q_course
+                   (course, qtemplate, "month", "number",
+                    total, totalsq, minscore, maxscore)
+               SELECT course, qtemplate, "month", COUNT(*),
+                      SUM(CAST(score AS numeric)),
+                      SUM(CAST(score AS numeric) * CAST(score AS numeric)),
+                      MIN(score), MAX(score)
+               FROM counted
+               GROUP BY 1, 2, 3
+               ON CONFLICT (course, qtemplate, "month") DO UPDATE
+               SET "number" = stats_q_course."number" + EXCLUDED."number",
+                   total = stats_q_course.total + EXCLUDED.total,
+                   totalsq = stats_q_course.totalsq + EXCLUDED.totalsq,
+                   minscore = LEAST(stats_q_course.minscore, EXCLUDED.minscore),
+                   maxscore = GREATEST(stats_q_course.maxscore, EXCLUDED.maxscore);""",
+            (q_ids,))
+
+
+def remove_q_stats(q_ids):
+    """ Take the question, or list of questions, back out of the class
+        statistics, before the score or mark time is changed. Call
+        add_q_stats() again afterwards. They come out of the same course rows
+        they went into, even if the student has changed groups since.
+        If one held the lowest or highest score of the month, those are
+        found again from the others.
+    """
+    q_ids = _q_ids(q_ids)
+    if not q_ids:
+        return
+    ret = run_sql("""WITH removed AS (
+                         DELETE FROM stats_q_counted
+                         WHERE question = ANY(%s)
+                         RETURNING course, qtemplate, "month", score
+                     ), old AS (
+                         SELECT course, qtemplate, "month",
+                                COUNT(*) AS "number",
+                                SUM(CAST(score AS numeric)) AS total,
+                                SUM(CAST(score AS numeric) * CAST(score AS numeric)) AS totalsq,
+                                MIN(score) AS minscore, MAX(score) AS maxscore
+                         FROM removed
+                         GROUP BY 1, 2, 3
+                     )
+                     UPDATE stats_q_course AS s
+                     SET "number" = s."number" - old."number",
+                         total = s.total - old.total,
+                         totalsq = s.totalsq - old.totalsq
+                     FROM old
+                     WHERE s.course = old.course
+                       AND s.qtemplate = old.qtemplate
+                       AND s."month" = old."month"
+                     RETURNING s.course, s.qtemplate, s."month", s."number",
+                               old.minscore <= s.minscore OR old.maxscore >= s.maxscore;""",
+                  (q_ids,))
+    if not ret:
+        return
+    for course, qt_id, month, number, edge in ret:
+        if number < 1:
+            run_sql("""DELETE FROM stats_q_course
+                       WHERE course = %s AND qtemplate = %s AND "month" = %s;""",
+                    (course, qt_id, month))
+        elif edge:
+            run_sql("""UPDATE stats_q_course
+                       SET minscore = m.minscore, maxscore = m.maxscore
+                       FROM (SELECT MIN(score) AS minscore,
+                                    MAX(score) AS maxscore
+                             FROM stats_q_counted
+                             WHERE course = %s
+                               AND qtemplate = %s
+                               AND "month" = %s
+                            ) AS m
+                       WHERE course = %s AND qtemplate = %s AND "month" = %s;""",
+                    (course, qt_id, month, course, qt_id, month))
+
+
+def rebuild_q_stats(course=None, qt_ids=None):
+    """ Work out the class statistics again from the questions table, for
+        one course and/or some question templates, or everything if neither
+        is given. Done in one transaction.
+        Returns how many stats_q_course rows were made.
+    """
+    where = []
+    params = []
+    if course is not None:
+        assert isinstance(course, int)
+        where.append("course = %s")
+        params.append(course)
+    if qt_ids is not None:
+        qt_ids = [int(qt_id) for qt_id in qt_ids]
+        if not qt_ids:
+            return 0
+        where.append("qtemplate = ANY(%s)")
+        params.append(qt_ids)
+    where = " AND ".join(where) or "TRUE"
+    with transaction():
+        run_sql("DELETE FROM stats_q_counted WHERE %s;" % where, params)
+        run_sql("""INSERT INTO stats_q_counted
+                       (question, course, qtemplate, "month", score)
+                   SELECT q.question, m.course, q.qtemplate,
+                          CAST(date_trunc('month', q.marktime) AS date),
+                          q.score
+                   FROM questions AS q
+                   JOIN (SELECT DISTINCT ug.userid, gc.course
+                         FROM usergroups AS ug
+                         JOIN groupcourses AS gc ON gc.groupid = ug.groupid
+                        ) AS m ON m.userid = q.student
+                   WHERE """ + _Q_STATS_WHERE + """
+                     AND %s;""" % where, params)
+        run_sql("DELETE FROM stats_q_course WHERE %s;" % where, params)
+        ret = run_sql("""WITH made AS (
+                             INSERT INTO stats_q_course
+                                 (course, qtemplate, "month", "number",
+                                  total, totalsq, minscore, maxscore)
+                             SELECT course, qtemplate, "month", COUNT(*),
+                                    SUM(CAST(score AS numeric)),
+                                    SUM(CAST(score AS numeric) * CAST(score AS numeric)),
+                                    MIN(score), MAX(score)
+                             FROM stats_q_counted
+                             WHERE %s
+                             GROUP BY 1, 2, 3
+                             RETURNING 1
+                         )
+                         SELECT COUNT(*) FROM made;""" % where, params)
+    return int(ret[0][0])
+
+
 def get_q_stats_class(course, qt_id):
     """Fetch a bunch of statistics about the given question for the class
+       (from stats_q_course, kept up to date as questions are marked)
     """
     assert isinstance(course, int)
     assert isinstance(qt_id, int)
-    sql = """SELECT COUNT(question),
-                    AVG(score),
-                    STDDEV(score),
-                    MAX(score),
-                    MIN(score)
-             FROM questions
+    sql = """SELECT """ + _Q_STATS_COLUMNS + """
+             FROM stats_q_course
              WHERE qtemplate = %s
-             AND marktime < NOW()
-             AND (marktime - firstview) > '00:00:20'
-             AND (marktime - firstview) < '02:00:01'
-             AND student IN
-                (SELECT userid FROM usergroups WHERE groupid IN
-                  (SELECT groupid FROM groupcourses WHERE course = %s)
-             );
-          """
+               AND course = %s;"""
     params = (qt_id, course)
     ret = run_sql(sql, params)
     if ret:
@@ -1292,6 +1966,118 @@ def get_q_stats_class(course, qt_id):
             return stats
 
 
+def get_topic_stats_user(user_id, qt_ids, num=3):
+    """ The practice statistics of one student for a set of question
+        templates (usually all of a topic), in a single query.
+        Returns {qt_id: {'num':, 'max':, 'min':, 'avg':, 'recent': [...]}}
+        where the aggregates are as get_prac_stats_user_qt and 'recent' is
+        as get_student_q_practice_stats(user_id, qt_id, num).
+        Templates the student hasn't done are left out.
+    """
+    assert isinstance(user_id, int)
+    assert isinstance(num, int)
+    qt_ids = [int(qt_id) for qt_id in qt_ids]
+    if not qt_ids:
+        return {}
+    sql = """WITH mine AS (
+                 SELECT qtemplate, question, score, status, exam,
+                        marktime, firstview
+                 FROM questions
+                 WHERE student = %s AND qtemplate = ANY(%s)
+             ), recent AS (
+                 SELECT qtemplate, score, question, marktime,
+                        EXTRACT(epoch FROM (NOW() - marktime)) AS age,
+                        ROW_NUMBER() OVER (PARTITION BY qtemplate
+                                           ORDER BY marktime DESC) AS pos
+                 FROM mine
+                 WHERE status > 1
+                   AND exam < 1
+                   AND marktime > '2005-07-16 00:00:00.00'
+                   AND (marktime - firstview) > '00:00:20.00'
+                   AND (marktime - firstview) < '02:00:01.00'
+             )
+             SELECT a.qtemplate, a.num, a.max, a.min, a.avg,
+                    r.score, r.question, r.age
+             FROM (SELECT qtemplate, COUNT(question) AS num,
+                          MAX(score) AS max, MIN(score) AS min,
+                          AVG(score) AS avg
+                   FROM mine
+                   GROUP BY qtemplate) AS a
+             LEFT JOIN recent AS r
+                 ON r.qtemplate = a.qtemplate AND (%s = 0 OR r.pos <= %s)
+             ORDER BY a.qtemplate, r.marktime;"""
+    ret = run_sql(sql, (user_id, qt_ids, num, num))
+    stats = {}
+    if not ret:
+        return stats
+    for row in ret:
+        qt_id = int(row[0])
+        if qt_id not in stats:
+            stats[qt_id] = {'num': int(row[1]),
+                            'max': float(row[2] or 0),
+                            'min': float(row[3] or 0),
+                            'avg': float(row[4] or 0),
+                            'recent': []}
+        if row[6] is not None:
+            age, ageseconds = _practice_age(row[7])
+            stats[qt_id]['recent'].append({
+                'score': float(row[5]),
+                'question': int(row[6]),
+                'age': age,
+                'ageseconds': ageseconds
+            })
+    return stats
+
+
+def get_topic_stats_class(course, qt_ids):
+    """ Class statistics (as get_q_stats_class) and maximum score for a
+        set of question templates, in a single query.
+        Returns {qt_id: {'maxscore':, 'count':, 'avg':, 'stddev':,
+                         'max':, 'min':}}
+        with only 'maxscore' set (the rest None) if nobody in the class has
+        a suitable attempt.
+    """
+    assert isinstance(course, int)
+    qt_ids = [int(qt_id) for qt_id in qt_ids]
+    if not qt_ids:
+        return {}
+    sql = """WITH attempts (qtemplate, num, average, stddev, highest, lowest) AS (
+                 SELECT qtemplate, """ + _Q_STATS_COLUMNS + """
+                 FROM stats_q_course
+                 WHERE course = %s
+                   AND qtemplate = ANY(%s)
+                 GROUP BY qtemplate
+             )
+             SELECT qt.qtemplate, qt.scoremax,
+                    a.num, a.average, a.stddev, a.highest, a.lowest
+             FROM qtemplates AS qt
+             LEFT JOIN attempts AS a ON a.qtemplate = qt.qtemplate
+             WHERE qt.qtemplate = ANY(%s);"""
+    ret = run_sql(sql, (course, qt_ids, qt_ids))
+    stats = {}
+    if not ret:
+        return stats
+    for row in ret:
+        try:
+            maxscore = float(row[1])
+        except (ValueError, TypeError):
+            maxscore = 0.0
+        stat = {'maxscore': maxscore,
+                'count': None,
+                'avg': None,
+                'stddev': None,
+                'max': None,
+                'min': None}
+        if row[3] is not None:
+            stat['count'] = int(row[2])
+            stat['avg'] = float(row[3])
+            stat['stddev'] = float(row[4] or 0.0)  # empty from only 1 count
+            stat['max'] = float(row[5])
+            stat['min'] = float(row[6])
+        stats[int(row[0])] = stat
+    return stats
+
+
 def set_message(name, message):
     """Store a message
     """
@@ -1407,3 +2193,86 @@ def get_db_size():
         sizes.append([row[0], row[1]])
 
     return sizes
+
+
+# Background jobs, eg. re-marking an assessment, and how far along they are.
+# Kept in the database so every web server process sees the same thing.
+# Job status values:
+#   0 = running, 1 = finished, 2 = failed
+def start_bg_job(kind, target, stale=3600):
+    """ Record that a background job of the given kind (eg. "remark") is
+        starting on the target (eg. an exam id). Only one of each kind can
+        be running on a target at once. A running one that hasn't reported
+        in for stale seconds is assumed to have been lost, and fails.
+        Returns the job id, or None if one is already running.
+    """
+    assert isinstance(target, int)
+    run_sql("""UPDATE bgjobs
+               SET status=2, finished=NOW(), error='Stopped responding'
+               WHERE kind=%s AND target=%s AND status=0
+                 AND updated < NOW() - %s * INTERVAL '1 second';""",
+            (kind, target, stale))
+    ret = run_sql("""INSERT INTO bgjobs (kind, target)
+                     VALUES (%s, %s)
+                     ON CONFLICT (kind, target) WHERE status = 0 DO NOTHING
+                     RETURNING job;""", (kind, target))
+    if not ret:
+        return None
+    return int(ret[0][0])
+
+
+def update_bg_job(job, total=None, done=None, info=None):
+    """ Record how far along the background job is. Anything left as None
+        isn't changed. info is a dict of anything else worth knowing.
+    """
+    assert isinstance(job, int)
+    if info is not None:
+        info = json.dumps(info)
+    run_sql("""UPDATE bgjobs
+               SET total=COALESCE(%s, total),
+                   done=COALESCE(%s, done),
+                   info=COALESCE(%s, info),
+                   updated=NOW()
+               WHERE job=%s;""", (total, done, info, job))
+
+
+def finish_bg_job(job, error=None, info=None):
+    """ Record that the background job is done, or failed with the given
+        error.
+    """
+    assert isinstance(job, int)
+    if error:
+        status = 2
+    else:
+        status = 1
+    if info is not None:
+        info = json.dumps(info)
+    run_sql("""UPDATE bgjobs
+               SET status=%s, error=%s, info=COALESCE(%s, info),
+                   updated=NOW(), finished=NOW()
+               WHERE job=%s;""", (status, error, info, job))
+
+
+def get_bg_job(kind, target):
+    """ Return the latest background job of the kind on the target, or None.
+        {'job': int, 'total': int, 'done': int, 'finished': bool,
+         'error': string or None, 'info': dict }
+    """
+    assert isinstance(target, int)
+    ret = run_sql("""SELECT job, status, total, done, error, info
+                     FROM bgjobs
+                     WHERE kind=%s AND target=%s
+                     ORDER BY job DESC
+                     LIMIT 1;""", (kind, target))
+    if not ret:
+        return None
+    row = ret[0]
+    info = {}
+    if row[5]:
+        info = json.loads(row[5])
+    return {'job': int(row[0]),
+            'total': int(row[2]),
+            'done': int(row[3]),
+            'finished': int(row[1]) != 0,
+            'error': row[4],
+            'info': info}
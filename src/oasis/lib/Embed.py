@@ -34,6 +34,7 @@ def mark_q(user_id, qtid, request):
 
     out = u""
     answers = {}
+    guesses = {}
     for i in request.form.keys():
         part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
         if part:
@@ -42,7 +43,10 @@ def mark_q(user_id, qtid, request):
 
             value = request.form[i]
             answers["G%d" % part] = value
-            DB.save_guess(newqid, part, value)
+            guesses.setdefault(newqid, {})[part] = value
+
+    for newqid, parts in guesses.items():
+        DB.save_guesses(newqid, parts)
 
     if qid:
         try:
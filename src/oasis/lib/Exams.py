@@ -272,7 +272,15 @@ def get_num_questions(exam_id):
 def get_exams_done(user):
     """ Return a list of assessments done by the user."""
     assert isinstance(user, int)
-    ret = run_sql("SELECT exam FROM examquestions WHERE student = %s GROUP BY exam", (user,))
+    # Questions can be created before the assessment starts, only count
+    # the ones they've seen.
+    ret = run_sql("""SELECT eq.exam
+                     FROM examquestions AS eq, questions AS q
+                     WHERE eq.student=%s
+                       AND q.question=eq.question
+                       AND (q.firstview IS NOT NULL
+                            OR q.marktime IS NOT NULL)
+                     GROUP BY eq.exam;""", (user,))
     if not ret:
         return []
     exams = [int(row[0]) for row in ret]
@@ -291,6 +299,109 @@ def set_submit_time(student, exam, submittime=None):
     touchuserexam(exam, student)
 
 
+# The marking queue. Job status values:
+#   0 = queued, 1 = being marked, 2 = marked, 3 = failed
+def queue_marking(exam_id, student):
+    """ Put the student's assessment in the queue to be marked, unless it's
+        already waiting. Returns the job id.
+    """
+    assert isinstance(exam_id, int)
+    assert isinstance(student, int)
+    # Only one waiting per assessment (markqueue_waiting index), so if they
+    # manage to submit twice at once the second insert does nothing and we
+    # pick up the existing job instead. This is safe inside a transaction.
+    ret = run_sql("""INSERT INTO markqueue (exam, student)
+                     VALUES (%s, %s)
+                     ON CONFLICT (exam, student) WHERE status < 2 DO NOTHING
+                     RETURNING job;""",
+                  (exam_id, student))
+    if ret:
+        return int(ret[0][0])
+    ret = run_sql("""SELECT job FROM markqueue
+                     WHERE exam=%s AND student=%s AND status < 2;""",
+                  (exam_id, student))
+    if ret:
+        return int(ret[0][0])
+    L.error("Unable to queue exam %s for marking for student %s" % (exam_id, student))
+    return None
+
+
+def claim_marking_job(stale=600, attempts=3):
+    """ Take the oldest waiting job off the marking queue. Several processes
+        can do this at once, each gets a different job.
+        Jobs that were started more than stale seconds ago are assumed to
+        have been lost and are handed out again, up to attempts times.
+        Returns (job, exam, student), or None if there's nothing to do.
+    """
+    run_sql("""UPDATE markqueue
+               SET status=3, finished=NOW(), error='Gave up'
+               WHERE status=1
+                 AND attempts >= %s
+                 AND started < NOW() - %s * INTERVAL '1 second';""",
+            (attempts, stale))
+    ret = run_sql("""UPDATE markqueue
+                     SET status=1, started=NOW(), attempts=attempts + 1
+                     WHERE job = (SELECT job FROM markqueue
+                                  WHERE (status=0
+                                         OR (status=1
+                                             AND started < NOW() - %s * INTERVAL '1 second'))
+                                    AND attempts < %s
+                                  ORDER BY job
+                                  LIMIT 1
+                                  FOR UPDATE SKIP LOCKED)
+                     RETURNING job, exam, student;""", (stale, attempts))
+    if not ret:
+        return None
+    return int(ret[0][0]), int(ret[0][1]), int(ret[0][2])
+
+
+def finish_marking_job(job, error=None):
+    """ Record that the marking job is done, or failed with the given error. """
+    assert isinstance(job, int)
+    if error:
+        status = 3
+    else:
+        status = 2
+    run_sql("""UPDATE markqueue SET status=%s, finished=NOW(), error=%s
+               WHERE job=%s;""", (status, error, job))
+
+
+def get_marking_job(exam_id, student):
+    """ Return the latest marking job for the student's assessment, or None.
+        {'job': int, 'status': int, 'error': string or None,
+         'ahead': int   number of jobs queued in front of it }
+    """
+    assert isinstance(exam_id, int)
+    assert isinstance(student, int)
+    ret = run_sql("""SELECT job, status, error FROM markqueue
+                     WHERE exam=%s AND student=%s
+                     ORDER BY job DESC
+                     LIMIT 1;""", (exam_id, student))
+    if not ret:
+        return None
+    job = {'job': int(ret[0][0]),
+           'status': int(ret[0][1]),
+           'error': ret[0][2],
+           'ahead': 0}
+    if job['status'] == 0:
+        ret = run_sql("""SELECT COUNT(*) FROM markqueue
+                         WHERE status=0 AND job < %s;""", (job['job'],))
+        if ret:
+            job['ahead'] = int(ret[0][0])
+    return job
+
+
+def cancel_marking(exam_id, student):
+    """ Take the student's assessment out of the marking queue, if it's
+        still waiting.
+    """
+    assert isinstance(exam_id, int)
+    assert isinstance(student, int)
+    run_sql("""DELETE FROM markqueue
+               WHERE exam=%s AND student=%s AND status=0;""",
+            (exam_id, student))
+
+
 # FIXME: watch for memcache issues.
 def reset_end_time(exam, user):
     """ Reset the Exam timer for the student. This should let them resit the exam. """
@@ -400,6 +511,7 @@ def unsubmit(exam, student):
     """ Undo the submission of an exam and reset the timer. """
     assert isinstance(exam, int)
     assert isinstance(student, int)
+    cancel_marking(exam, student)
     reset_mark(exam, student)
     reset_end_time(exam, student)
     reset_submit_time(exam, student)
@@ -522,7 +634,8 @@ def get_marks(group, exam_id):
         WHERE u.id = ug.userid
           AND ug.groupid = %s
           AND u.id = q.student
-          AND q.exam = %s;
+          AND q.exam = %s
+          AND (q.firstview IS NOT NULL OR q.marktime IS NOT NULL);
     """
     params = (group.id, exam_id)
     ret = DB.run_sql(sql, params)
@@ -539,3 +652,26 @@ def get_marks(group, exam_id):
         }
 
     return results
+
+
+def get_marks_with_users(group, exam_id):
+    """ Fetch the same marks as get_marks(), along with the students'
+        details, in one query. Sorted by family name, for exporting.
+        Returns an iterator over the rows, which are fetched in batches as
+        they're needed:
+          (user_id, uname, student_id, familyname, givenname, email,
+           qtemplate, score)
+    """
+    sql = """
+        SELECT u.id, u.uname, u.student_id, u.familyname, u.givenname,
+               u.email, q.qtemplate, q.score
+        FROM usergroups AS ug
+        JOIN users AS u ON u.id = ug.userid
+        JOIN questions AS q ON q.student = u.id
+        WHERE ug.groupid = %s
+          AND q.exam = %s
+          AND (q.firstview IS NOT NULL OR q.marktime IS NOT NULL)
+        ORDER BY u.familyname, u.id;
+    """
+    params = (group.id, exam_id)
+    return DB.iter_sql(sql, params)
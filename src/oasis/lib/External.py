@@ -6,7 +6,7 @@
     (except to OASIS database or memcache servers) should come through here.
 """
 
-from oasis.lib import OaConfig, Groups, Feeds, DB, Users2, UFeeds, Users, Topics, QEditor
+from oasis.lib import OaConfig, Groups, Feeds, DB, Users2, UFeeds, Users, Topics, QEditor, General
 import os
 import subprocess
 import tempfile
@@ -354,6 +354,7 @@ def import_qts_from_zip(data, topicid):
                     print "generating variations..."
                     for row in range(0, len(qvars)):
                         DB.add_qt_variation(newid, row + 1, qvars[row], 1)
+            General.prerender_qt(newid, 1)
 
     Topics.flush_num_qs(topicid)
     return 0
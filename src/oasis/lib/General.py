@@ -14,15 +14,25 @@ import re
 import random
 from StringIO import StringIO
 import math
+import os
 import sys
+import Queue
 import traceback
 import datetime
 import time
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import jinja2
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from oasis.lib.OaExceptions import OaMarkerError
+from oasis.lib.OaExceptions import OaMarkerError, OaWorkerError
 from . import Courses, Exams
-from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs
+from oasis.lib import OaConfig, DB, Topics, script_funcs, OqeSmartmarkFuncs, Pool, \
+    Groups
 from logging import getLogger
 
 L = getLogger("oasisqe")
@@ -45,15 +55,19 @@ def get_topic_list(cid, numq=True):
     """     # TODO: magic numbers!
     tlist = []
     topics = Courses.get_topics(int(cid))
+    records = Topics.get_topic_multi(topics)
+    if numq:
+        nums = Topics.get_num_qs_multi(topics)
+    else:
+        nums = {}
     for topic in topics:
-        if numq:
-            num = Topics.get_num_qs(topic)
-        else:
-            num = None
+        if topic not in records:
+            L.warn("Topic %s in course %s not found." % (topic, cid))
+            continue
         tlist.append({'tid': topic,
-                      'name': Topics.get_name(topic),
-                      'num': num,
-                      'visibility': Topics.get_vis(topic)})
+                      'name': records[topic]['title'],
+                      'num': nums.get(topic),
+                      'visibility': records[topic]['visibility']})
     return tlist
 
 
@@ -86,9 +100,13 @@ def get_q_att_fname(qid, name):
     """ Return (mimetype, filename) with the relevant filename.
         If it's not found in question, look in questiontemplate.
     """
-    qtid = DB.get_q_parent(qid)
-    variation = DB.get_q_variation(qid)
-    version = DB.get_q_version(qid)
+    qinst = DB.get_q_instance(qid)
+    if not qinst:
+        L.warn("Attachment %s requested for unknown question %s" % (name, qid))
+        return None, None
+    qtid = qinst.qtemplate
+    variation = qinst.variation
+    version = qinst.version
     # for the two biggies we hit the question first,
     # otherwise check the question template first
     if name == "image.gif" or name == "qtemplate.html":
@@ -113,9 +131,13 @@ def get_q_att(qid, name):
     """ Return (mimetype, data) with the relevant attachment.
         If it's not found in question, look in questiontemplate.
     """
-    qtid = DB.get_q_parent(qid)
-    variation = DB.get_q_variation(qid)
-    version = DB.get_q_version(qid)
+    qinst = DB.get_q_instance(qid)
+    if not qinst:
+        L.warn("Attachment %s requested for unknown question %s" % (name, qid))
+        return None, None
+    qtid = qinst.qtemplate
+    variation = qinst.variation
+    version = qinst.version
     # for the two biggies we hit the question first,
     # otherwise check the question template first
     if name == "image.gif" or name == "qtemplate.html":
@@ -193,11 +215,12 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
         qvars['Oasis_qid'] = q_id
         image = DB.get_qt_att(qt_id, "image.gif", version)
         if image:
-            newimage = gen_q_image(qvars, image)
+            newimage = draw_q_image(get_base_q_image(qt_id, version, image),
+                                    qvars)
             DB.create_q_att(qt_id,
                             variation,
                             "image.gif",
-                            "image/gif",
+                            QIMAGE_MIMETYPE,
                             newimage,
                             version)
     htmlexists = DB.get_q_att_mimetype(qt_id,
@@ -210,7 +233,7 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
         html = DB.get_qt_att(qt_id, "qtemplate.html", version)
         if html:
             qvars['Oasis_qid'] = q_id
-            newhtml = gen_q_html(qvars, html)
+            newhtml = get_compiled_q_html(qt_id, version, html).render(qvars)
             L.info("generating new qattach qtemplate.html for %s" % q_id)
             DB.create_q_att(qt_id,
                             variation,
@@ -225,103 +248,457 @@ def gen_q_from_var(qt_id, student, exam, position, version, variation):
         L.error("generateQuestionFromVar(%s,%s), can't find qid %s? " %
                    (qt_id, student, q_id))
     if exam >= 1:
-        DB.add_exam_q(student, exam, q_id, position)
+        # Someone else (eg. preparing the assessment) may have got there first
+        q_id = DB.add_exam_q(student, exam, q_id, position)
     return q_id
 
 
+def render_variation(qt_id, version, variation, qvars, html, image):
+    """ Generate the instance html and image for one variation of a qtemplate.
+        Doesn't touch the database, so it can be run in a worker process.
+        Returns (variation, html, image), html or image will be None if
+        they weren't asked for or couldn't be generated.
+    """
+    newhtml = None
+    newimage = None
+    try:
+        if image:
+            newimage = draw_q_image(get_base_q_image(qt_id, version, image),
+                                    qvars)
+        if html:
+            newhtml = get_compiled_q_html(qt_id, version, html).render(qvars)
+    except Exception as err:
+        L.warn("Unable to pre-generate variation %s of qtemplate %s "
+               "version %s: %s" % (variation, qt_id, version, err))
+    return variation, newhtml, newimage
+
+
+# The worker processes that render_variations shares between everything in
+# this process, started when first needed.
+_render_pool = None
+_render_pool_pid = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool():
+    """ Return the shared pool of prerender_workers worker processes. """
+    global _render_pool, _render_pool_pid
+    with _render_pool_lock:
+        if _render_pool_pid != os.getpid():   # processes don't survive a fork
+            _render_pool = multiprocessing.Pool(OaConfig.prerender_workers)
+            _render_pool_pid = os.getpid()
+        return _render_pool
+
+
+def _render_variation_jobs(chunk):
+    """ Worker processes need a plain function to call. Each chunk of jobs
+        brings the template and image along, they (and the font) are only
+        set up the first time a worker needs them.
+    """
+    (qt_id, version, html, image, jobs) = chunk
+    return [render_variation(qt_id, version, variation, qvars,
+                             html if needhtml else None,
+                             image if needimage else None)
+            for (variation, qvars, needhtml, needimage) in jobs]
+
+
+def render_variations(qt_id, version, html, image, jobs, workers=None):
+    """ Generate many variations of a qtemplate at once, spread over a pool of
+        worker processes. jobs is a list of (variation, qvars, needhtml,
+        needimage). Yields (variation, html, image) as each is finished,
+        not necessarily in order.
+        workers defaults to the shared pool of prerender_workers processes,
+        0 does them all in this process.
+    """
+    shared = workers is None
+    if shared:
+        workers = OaConfig.prerender_workers
+    if min(workers, len(jobs)) < 1:
+        for (variation, qvars, needhtml, needimage) in jobs:
+            yield render_variation(qt_id, version, variation, qvars,
+                                   html if needhtml else None,
+                                   image if needimage else None)
+        return
+    size = max(1, len(jobs) / (workers * 4))
+    chunks = [(qt_id, version, html, image, jobs[pos:pos + size])
+              for pos in range(0, len(jobs), size)]
+    if shared:
+        pool = _get_render_pool()
+    else:
+        pool = multiprocessing.Pool(workers)
+    try:
+        for results in pool.imap_unordered(_render_variation_jobs, chunks):
+            for result in results:
+                yield result
+    finally:
+        if not shared:
+            pool.terminate()
+            pool.join()
+
+
+# Qtemplates waiting to be pre-generated. One thread in each process works
+# through them, so however many are saved or imported at once, only the
+# shared worker pool is busy. If the queue fills up, the rest are left to be
+# generated as students ask for them.
+PRERENDER_QUEUE_SIZE = 500
+_prerender_queue = Queue.Queue(PRERENDER_QUEUE_SIZE)
+_prerender_waiting = set()
+_prerender_pid = None
+_prerender_lock = threading.Lock()
+
+
+def prerender_qt(qt_id, version=None):
+    """ Queue the qtemplate to have the html and image for every variation
+        generated in the background, so they're already there when students
+        start asking for them. Check on it with get_prerender_progress()
+        Returns False if the queue is full.
+    """
+    assert isinstance(qt_id, int)
+    if version is None:
+        version = DB.get_qt_version(qt_id)
+    assert isinstance(version, int)
+    _start_prerenderer()
+    with _prerender_lock:
+        if (qt_id, version) in _prerender_waiting:
+            return True
+        try:
+            _prerender_queue.put_nowait((qt_id, version))
+        except Queue.Full:
+            L.warn("Pre-generate queue is full, not doing qtemplate %s "
+                   "version %s" % (qt_id, version))
+            return False
+        _prerender_waiting.add((qt_id, version))
+    return True
+
+
+def _start_prerenderer():
+    """ Make sure the pre-generating thread is running in this process. """
+    global _prerender_pid
+    with _prerender_lock:
+        if _prerender_pid == os.getpid():
+            return
+        _prerender_pid = os.getpid()   # threads don't survive a fork
+        thread = threading.Thread(target=_prerender_loop, name="prerender")
+        thread.daemon = True
+        thread.start()
+
+
+def _prerender_loop():
+    """ Pre-generate queued qtemplates, one at a time. """
+    while True:
+        (qt_id, version) = _prerender_queue.get()
+        with _prerender_lock:
+            _prerender_waiting.discard((qt_id, version))
+        try:
+            _prerender_qt(qt_id, version)
+        except Exception as err:
+            L.error("Pre-generate thread problem: %s" % err)
+
+
+def get_prerender_progress(qt_id):
+    """ How far along pre-generating the qtemplate's variations is, or how
+        it went last time.
+        Returns None if it's never been done, or a dict:
+          { version: int    qtemplate version being generated
+            total: int      number of variations
+            done: int       how many are finished
+            finished: bool  True once all done (or given up)
+            error: string   why it gave up, or None
+          }
+    """
+    assert isinstance(qt_id, int)
+    job = DB.get_bg_job("prerender", qt_id)
+    if not job:
+        return None
+    return {'version': job['info'].get('version', 0),
+            'total': job['total'],
+            'done': job['done'],
+            'finished': job['finished'],
+            'error': job['error']}
+
+
+def _prerender_qt(qt_id, version, wanted=None):
+    """ Does the work for prerender_qt. The database work happens here, only
+        the drawing and html generation is given to render_variations.
+        wanted can be a list of variations, to only do those. Progress is
+        only recorded when doing them all.
+    """
+    job = None
+    error = None
+    total = done = 0
+    started = time.time()
+    try:
+        with DB.pinned_connection():
+            if wanted is None:
+                job = DB.start_bg_job("prerender", qt_id)
+                if job is None:
+                    running = DB.get_bg_job("prerender", qt_id)
+                    if running and \
+                            running['info'].get('version') == version:
+                        L.info("Already pre-generating qtemplate %s "
+                               "version %s" % (qt_id, version))
+                        return
+                    # An older version is still going, do this one anyway
+                else:
+                    DB.update_bg_job(job, info={'version': version})
+            variations = DB.get_qt_variations(qt_id, version)
+            html = DB.get_qt_att(qt_id, "qtemplate.html", version)
+            image = DB.get_qt_att(qt_id, "image.gif", version)
+            if not variations or not (html or image):
+                return
+            if wanted is not None:
+                variations = dict((variation, qvars)
+                                  for (variation, qvars) in variations.items()
+                                  if variation in wanted)
+            total = len(variations)
+
+            have = DB.get_q_att_variations(
+                qt_id, ("qtemplate.html", "image.gif"), version)
+            jobs = []
+            for variation, qvars in variations.items():
+                needhtml = html and variation not in have["qtemplate.html"]
+                needimage = image and variation not in have["image.gif"]
+                if needhtml or needimage:
+                    jobs.append((variation, qvars, needhtml, needimage))
+            done = total - len(jobs)
+            if job:
+                DB.update_bg_job(job, total=total, done=done)
+            results = render_variations(qt_id, version, html, image, jobs)
+            for variation, newhtml, newimage in results:
+                if newimage:
+                    DB.create_q_att(qt_id, variation, "image.gif",
+                                    QIMAGE_MIMETYPE, newimage, version)
+                if newhtml:
+                    DB.create_q_att(qt_id, variation, "qtemplate.html",
+                                    "application/oasis-html", newhtml, version)
+                done += 1
+                if job and done % 20 == 0:
+                    DB.update_bg_job(job, done=done)
+    except Exception as err:
+        error = "%s" % err
+        L.error("Pre-generating qtemplate %s version %s failed: %s" %
+                (qt_id, version, err))
+    finally:
+        if job:
+            try:
+                DB.update_bg_job(job, total=total, done=done)
+                DB.finish_bg_job(job, error)
+            except Exception as err:
+                L.error("Couldn't record pre-generating qtemplate %s: %s" %
+                        (qt_id, err))
+    L.info("Pre-generated %s of %s variations of qtemplate %s version %s "
+           "in %.1fs" % (done, total, qt_id, version, time.time() - started))
+
+
+# Everything in a qtemplate.html that gets replaced when generating an instance
+QHTML_TAG_RE = re.compile(
+    r'<IMG SRC>'
+    r'|<ANSWER([0-9]+) ([0-9]+)>'
+    r'|<ANSWER([0-9]+)>'
+    r'|<ANSWER([0-9]+) TEXT>'
+    r'|<ANSWER([0-9]+) (MULTIF|MULTIV|MULTI|SELECT) ([^>]*)>'
+    r'|<(VAL|IMG SRC|ATT SRC) ([^<>]*)>')
+
+
+class CompiledQHTML(object):
+    """ A qtemplate.html that has been scanned once and broken into pieces,
+        so instances can be generated from it without searching the whole
+        text again for every variable.
+
+        self.parts is a list of plain strings and (kind, ...) tuples for
+        the bits that depend on the variables.
+    """
+
+    def __init__(self, html):
+        self.parts = []
+        literal = []
+        pos = 0
+        for match in QHTML_TAG_RE.finditer(html):
+            literal.append(html[pos:match.start()])
+            pos = match.end()
+            groups = match.groups()
+            if groups[0]:    # <ANSWERn size>
+                literal.append(
+                    """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' SIZE='%s' VALUE="VAL_%s"/>""" %
+                    (groups[0], groups[1], groups[0]))
+            elif groups[2]:  # <ANSWERn>
+                literal.append(
+                    """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' VALUE="VAL_%s"/>""" %
+                    (groups[2], groups[2]))
+            elif groups[3]:  # <ANSWERn TEXT>
+                literal.append(
+                    """<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
+                    (groups[3], groups[3]))
+            elif groups[4]:  # <ANSWERn MULTI a,b,c>  and friends
+                self._add(literal)
+                self.parts.append((groups[5], int(groups[4]),
+                                   groups[6].split(',')))
+            elif groups[7]:  # <VAL name>  <IMG SRC name>  <ATT SRC name>
+                self._add(literal)
+                self.parts.append((groups[7], groups[8], match.group(0)))
+            else:            # <IMG SRC>
+                literal.append('<IMG SRC="$IMAGES$image.gif" />')
+        literal.append(html[pos:])
+        self._add(literal)
+
+    def _add(self, literal):
+        """ Add the plain text collected so far. """
+        text = "".join(literal)
+        if text:
+            self.parts.append(text)
+        del literal[:]
+
+    def render(self, qvars):
+        """ Generate the instance html using the given variables. """
+        out = []
+        for part in self.parts:
+            if isinstance(part, basestring):
+                out.append(part)
+                continue
+            kind = part[0]
+            if kind == "VAL" or kind == "IMG SRC" or kind == "ATT SRC":
+                name = part[1]
+                if name not in qvars:
+                    out.append(part[2])
+                elif kind == "VAL":
+                    out.append('%s' % (qvars[name]))
+                elif kind == "IMG SRC":
+                    out.append('<IMG SRC="$STATIC$%s" />' % (qvars[name]))
+                else:
+                    out.append('<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' % (qvars[name], qvars[name]))
+            elif kind == "MULTIF":
+                out.append(multi_f_html(part[1], part[2], qvars))
+            elif kind == "MULTIV":
+                out.append(multi_v_html(part[1], part[2], qvars))
+            elif kind == "MULTI":
+                out.append(multi_html(part[1], part[2], qvars))
+            else:  # SELECT
+                out.append(listbox_html(part[1], part[2], qvars))
+        return "".join(out)
+
+
+# Compiled templates we've seen recently, {(qt_id, version): (html, compiled)}
+_COMPILED_QHTML = {}
+_COMPILED_QHTML_MAX = 200
+
+
+def get_compiled_q_html(qt_id, version, html):
+    """ Return a CompiledQHTML for the template, reusing the last one we made
+        for this qtemplate version if the html hasn't changed.
+    """
+    key = (qt_id, version)
+    cached = _COMPILED_QHTML.get(key)
+    if cached and cached[0] == html:
+        return cached[1]
+    compiled = CompiledQHTML(html)
+    if len(_COMPILED_QHTML) >= _COMPILED_QHTML_MAX:
+        _COMPILED_QHTML.clear()
+    _COMPILED_QHTML[key] = (html, compiled)
+    return compiled
+
+
 def gen_q_html(qvars, html):
     """ Create an instance of the HTML """
-    html = html.replace("<IMG SRC>", '<IMG SRC="$IMAGES$image.gif" />')
-    # replace <ANSWERn size> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+) ([0-9]+)>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' SIZE='%s' VALUE="VAL_%s"/>""" %
-                   (x.group(1), x.group(2), x.group(1))), html)
-    # replace <ANSWERn> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+)>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' VALUE="VAL_%s"/>""" %
-                   (x.group(1), x.group(1))), html)
-    # replace <ANSWERn TEXT> with the correct HTML
-    rx_answern = re.compile(r'<ANSWER([0-9]+) TEXT>')
-    html = re.sub(rx_answern,
-                  (lambda x:
-                   """<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
-                   (x.group(1), x.group(1))), html)
-    # Do multiple choice
-    # TODO: need to replace with regex at some point
-    #  '<ANSWER(.+?)\s+(.+?)\s+(.*?)>'
-    for i in range(1, 49):
-        (match, repl) = handle_multi_f(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for i in range(1, 49):
-        (match, repl) = handle_multi(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for i in range(1, 49):
-        (match, repl) = handle_multi_v(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-        # Do listbox
-    # TODO: need to replace with regex at some point
-    #  '<ANSWER(.+?)\s+(.+?)\s+(.*?)>'
-    for i in range(1, 49):
-        (match, repl) = handle_listbox(html, i, qvars)
-        if match:
-            html = html.replace(match, repl)
-    for v in qvars.keys():
-        html = html.replace("<VAL %s>" % (v,),
-                            '%s' % (qvars[v]))
-        html = html.replace("<IMG SRC %s>" % (v,),
-                            '<IMG SRC="$STATIC$%s" />' % (qvars[v]))
-        html = html.replace("<ATT SRC %s>" % (v,),
-                            '<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' % (qvars[v], qvars[v]))
-    return html
-
-
-def gen_q_image(qvars, image):
-    """ Draw values onto the image provided. """
+    return CompiledQHTML(html).render(qvars)
+
+
+# Instance images are stored as "image.gif" whatever format they're in, the
+# mimetype says what they really are.
+QIMAGE_MIMETYPES = {"GIF": "image/gif", "PNG": "image/png"}
+QIMAGE_FORMAT = OaConfig.question_image_format.strip().upper()
+if QIMAGE_FORMAT not in QIMAGE_MIMETYPES:
+    L.warn("Unknown question_image_format '%s', using GIF" % QIMAGE_FORMAT)
+    QIMAGE_FORMAT = "GIF"
+QIMAGE_MIMETYPE = QIMAGE_MIMETYPES[QIMAGE_FORMAT]
+
+# Fonts we've loaded, {(filename, size): font}
+_FONTS = {}
+
+# Decoded qtemplate images, {(qt_id, version): (data, image)}
+_BASE_IMAGES = {}
+_BASE_IMAGES_MAX = 50
+
+
+def get_font(size=14, fname="Courier_New.ttf"):
+    """ Return the (cached) font for drawing on question images. """
+    key = (fname, size)
+    font = _FONTS.get(key)
+    if not font:
+        font = ImageFont.truetype("%s/fonts/%s" % (OaConfig.homedir, fname), size)
+        _FONTS[key] = font
+    return font
+
+
+def get_base_q_image(qt_id, version, image):
+    """ Return the qtemplate image decoded and ready to draw on, reusing the
+        last one we decoded for this qtemplate version if it hasn't changed.
+        Don't draw on it directly, make a copy.
+    """
+    key = (qt_id, version)
+    cached = _BASE_IMAGES.get(key)
+    if cached and cached[0] == image:
+        return cached[1]
     img = Image.open(StringIO(image)).convert("RGBA")
+    if len(_BASE_IMAGES) >= _BASE_IMAGES_MAX:
+        _BASE_IMAGES.clear()
+    _BASE_IMAGES[key] = (image, img)
+    return img
+
+
+def draw_q_image(base, qvars, imgformat=None):
+    """ Draw values onto a copy of the decoded image provided, return the
+        encoded result.
+        Values are given in the qvars as Xn, Yn (position) and Zn (text)
+    """
+    img = base.copy()
     imgdraw = ImageDraw.Draw(img)
-    font = ImageFont.truetype("%s/fonts/Courier_New.ttf" % OaConfig.homedir, 14)
+    font = get_font()
     coords = [int(name[1:])
               for name in qvars.keys()
-              if re.search("^X([0-9]+)$", name) > 0]
+              if name[:1] == "X" and name[1:].isdigit()]
     for coord in coords:
         (xcoord, ycoord, value) = (qvars["X%d" % coord],
                                    qvars["Y%d" % coord],
                                    qvars["Z%d" % coord])
         if (xcoord > -1) and (ycoord > -1):
-            value = unicode(value, "utf-8")    # convert to unicode
+            if isinstance(value, str):
+                value = unicode(value, "utf-8")    # convert to unicode
             try:
                 imgdraw.text((int(xcoord), int(ycoord)), value, font=font, fill="black")
             except UnicodeEncodeError as err:
                 L.warn(u"Unicode error generating image: %s [%s]." % (err, value))
     data = StringIO("")
-    img.save(data, "GIF")
+    img.save(data, imgformat or QIMAGE_FORMAT)
     return data.getvalue()
 
 
-def handle_multi_f(html, answer, qvars):
-    """ Convert MULTIF answer tags into appropriate HTML. (radio buttons)
-        Keeps the original order (doesn't shuffle the options)
+def gen_q_image(qvars, image, imgformat=None):
+    """ Draw values onto the image provided. """
+    base = Image.open(StringIO(image)).convert("RGBA")
+    return draw_q_image(base, qvars, imgformat)
 
-        Expects something like <ANSWERn MULTIF a,b,c,d,e>
+
+def _find_answer_tag(html, answer, kind):
+    """ Find the first <ANSWERn KIND params> tag in the html.
+        Returns (the whole tag, list of params) or (None, None)
     """
+    prefix = "<ANSWER%d %s " % (answer, kind)
     try:
-        start = html.index("<ANSWER%d MULTIF " % answer)
+        start = html.index(prefix)
     except ValueError:
         return None, None
     try:
         end = html.index(">", start) + 1
     except ValueError:
         return None, None
-    params = html[start + len("<ANSWER%d MULTIF " % answer):end - 1]
-    match = html[start:end]
-    paramlist = params.split(',')
+    params = html[start + len(prefix):end - 1]
+    return html[start:end], params.split(',')
+
+
+def multi_f_html(answer, paramlist, qvars):
+    """ HTML for a MULTIF answer (radio buttons), keeping the original
+        order (doesn't shuffle the options)
+    """
     pout = ["", ]
     if paramlist:
         pout = ["", ]
@@ -338,26 +715,25 @@ def handle_multi_f(html, answer, qvars):
     ret = "<table border=0><tr><td>Please choose one:</td>"
     ret += ''.join(pout)
     ret += "</tr></table><br />\n"
-    return match, ret
+    return ret
 
 
-def handle_multi_v(html, answer, qvars):
-    """ Convert MULTIV answer tags into appropriate HTML. (radio buttons)
+def handle_multi_f(html, answer, qvars):
+    """ Convert MULTIF answer tags into appropriate HTML. (radio buttons)
         Keeps the original order (doesn't shuffle the options)
 
-        Expects something like  <ANSWERn MULTIV a,b,c,d>
+        Expects something like <ANSWERn MULTIF a,b,c,d,e>
     """
-    try:
-        start = html.index("<ANSWER%d MULTIV " % answer)
-    except ValueError:
-        return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
+    (match, paramlist) = _find_answer_tag(html, answer, "MULTIF")
+    if not match:
         return None, None
-    params = html[start + len("<ANSWER%d MULTIV " % answer):end - 1]
-    match = html[start:end]
-    paramlist = params.split(',')
+    return match, multi_f_html(answer, paramlist, qvars)
+
+
+def multi_v_html(answer, paramlist, qvars):
+    """ HTML for a MULTIV answer (radio buttons, listed vertically), keeping
+        the original order (doesn't shuffle the options)
+    """
     pout = ["", ]
     if paramlist:
         pout = ["", ]
@@ -376,23 +752,24 @@ def handle_multi_v(html, answer, qvars):
     ret = "<table border=0><tr><th>Please choose one:</th></tr>"
     ret += ''.join(pout)
     ret += "</table><br />\n"
-    return match, ret
+    return ret
 
 
-def handle_multi(html, answer, qvars, shuffle=True):
-    """ Convert MULTI answer tags into appropriate HTML. (radio buttons)
+def handle_multi_v(html, answer, qvars):
+    """ Convert MULTIV answer tags into appropriate HTML. (radio buttons)
+        Keeps the original order (doesn't shuffle the options)
+
+        Expects something like  <ANSWERn MULTIV a,b,c,d>
     """
-    try:
-        start = html.index("<ANSWER%d MULTI " % answer)
-    except ValueError:
+    (match, paramlist) = _find_answer_tag(html, answer, "MULTIV")
+    if not match:
         return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
-        return None, None
-    params = html[start + len("<ANSWER%d MULTI " % answer):end - 1]
-    match = html[start:end]
-    paramlist = params.split(',')
+    return match, multi_v_html(answer, paramlist, qvars)
+
+
+def multi_html(answer, paramlist, qvars, shuffle=True):
+    """ HTML for a MULTI answer (radio buttons)
+    """
     pout = ["", ]
     if paramlist:
         pout = ["", ]
@@ -412,26 +789,21 @@ def handle_multi(html, answer, qvars, shuffle=True):
     ret = "<table border=0><tr><th>Please choose one:</th>"
     ret += ''.join(pout)
     ret += "</tr></table><br />\n"
-    return match, ret
+    return ret
 
 
-def handle_listbox(html, answer, qvars, shuffle=True):
-    """ Convert SELECT answer tags into appropriate HTML (SELECT box)
-
-        We expect    <ANSWERn SELECT a,b,c,d,e>
-        with 2+ parameters (a,b,c,d,...)
+def handle_multi(html, answer, qvars, shuffle=True):
+    """ Convert MULTI answer tags into appropriate HTML. (radio buttons)
     """
-    try:
-        start = html.index("<ANSWER%d SELECT " % answer)
-    except ValueError:
-        return None, None
-    try:
-        end = html.index(">", start) + 1
-    except ValueError:
+    (match, paramlist) = _find_answer_tag(html, answer, "MULTI")
+    if not match:
         return None, None
-    params = html[start + len("<ANSWER%d SELECT " % answer):end - 1]
-    match = html[start:end]
-    paramlist = params.split(',')
+    return match, multi_html(answer, paramlist, qvars, shuffle)
+
+
+def listbox_html(answer, paramlist, qvars, shuffle=True):
+    """ HTML for a SELECT answer (SELECT box)
+    """
     pout = ["", ]
     if paramlist:
         pout = ["", ]
@@ -450,7 +822,19 @@ def handle_listbox(html, answer, qvars, shuffle=True):
     ret += """<OPTION VALUE='None'>--Choose--</OPTION>"""
     ret += ''.join(pout)
     ret += "</SELECT>\n"
-    return match, ret
+    return ret
+
+
+def handle_listbox(html, answer, qvars, shuffle=True):
+    """ Convert SELECT answer tags into appropriate HTML (SELECT box)
+
+        We expect    <ANSWERn SELECT a,b,c,d,e>
+        with 2+ parameters (a,b,c,d,...)
+    """
+    (match, paramlist) = _find_answer_tag(html, answer, "SELECT")
+    if not match:
+        return None, None
+    return match, listbox_html(answer, paramlist, qvars, shuffle)
 
 
 def render_q_html(q_id, readonly=False):
@@ -461,14 +845,18 @@ def render_q_html(q_id, readonly=False):
         assert q_id > 0
     except (ValueError, TypeError, AssertionError):
         L.warn("renderQuestionHTML(%s,%s) called with bad qid?" % (q_id, readonly))
-    qt_id = DB.get_q_parent(q_id)
+    qinst = DB.get_q_instance(q_id)
+    if not qinst:
+        L.warn("renderQuestionHTML(%s,%s), question not found? " % (q_id, readonly))
+        return "QuestionError"
+    qt_id = qinst.qtemplate
     try:
         qt_id = int(qt_id)
         assert qt_id > 0
     except (ValueError, TypeError, AssertionError):
         L.warn("renderQuestionHTML(%s,%s), getparent failed? " % (q_id, readonly))
-    variation = DB.get_q_variation(q_id)
-    version = DB.get_q_version(q_id)
+    variation = qinst.variation
+    version = qinst.version
     data = DB.get_q_att(qt_id, "qtemplate.html", variation, version)
     if not data:
         L.warn("Unable to retrieve qtemplate for q_id: %s" % q_id)
@@ -498,33 +886,45 @@ def render_q_html(q_id, readonly=False):
         out = out.replace("<INPUT ", "<INPUT READONLY ")
         out = out.replace("<SELECT ", "<SELECT DISABLED=DISABLED STYLE='color: black;'")
     guesses = DB.get_q_guesses(q_id)
-    for guess in guesses.keys():
+    return fill_q_guesses(out, guesses)
+
+
+# The form placeholders left in instance html by gen_q_html
+QGUESS_TAG_RE = re.compile(r'VAL_([0-9]+)|Oa_(SEL|CHK)_([0-9]+)_([0-9]+)')
+
+
+def fill_q_guesses(html, guesses):
+    """ Fill in the student's previous guesses in the instance html:
+          VAL_n        ->  the guess for part n
+          Oa_SEL_n_m   ->  "SELECTED" if option m was chosen for part n
+          Oa_CHK_n_m   ->  "CHECKED"  if option m was chosen for part n
+        anything without a matching guess is removed. Done in a single pass
+        so it doesn't matter how many parts or options there are.
+    """
+    answers = {}
+    for guess, value in guesses.items():
         # noinspection PyComparisonWithNone
-        if guesses[guess] == None:  # If it's 0 we want to leave it alone
-            guesses[guess] = ""
-        if guesses[guess] == "None":
-            guesses[guess] = ""
-            # for each question
-    if guesses:
-        for ques in range(25, 0, -1):
-            if ("G%d" % ques) in guesses:
-                out = out.replace("VAL_%d" % ques, htmlesc(guesses["G%d" % ques]))
-                for part in range(50, 0, -1):
-                    if guesses["G%d" % ques] == "%s.0" % part or guesses["G%d" % ques] == "%s" % part:
-                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
-                                          "SELECTED")
-                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
-                                          "CHECKED")
-                    else:
-                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
-                                          "")
-                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
-                                          "")
-            else:
-                out = out.replace("VAL_%d" % (ques,), "")
-    for ques in range(25, 0, -1):
-        out = out.replace("VAL_%d" % (ques,), "")
-    return out
+        if value == None or value == "None":  # If it's 0 we want to leave it alone
+            value = ""
+        answers[guess] = value
+
+    def repl(match):
+        """ Replacement for one placeholder """
+        part = match.group(1)
+        if part:
+            value = answers.get("G%s" % part)
+            if value is None:
+                return ""
+            return htmlesc(value)
+        value = answers.get("G%s" % match.group(3))
+        option = match.group(4)
+        if value == option or value == "%s.0" % option:
+            if match.group(2) == "SEL":
+                return "SELECTED"
+            return "CHECKED"
+        return ""
+
+    return QGUESS_TAG_RE.sub(repl, html)
 
 
 # parseExpo interprets an input like "1.602 x 10^19" and returns
@@ -564,6 +964,89 @@ def parseexpo(scifmt):
     return news, f
 
 
+def _standard_parts(qvars):
+    """ The parts of a standard marked question (An variables). """
+    return [var[1:]
+            for var in qvars.keys()
+            if re.search("^A([0-9]+$)", var) > 0]
+
+
+def _standard_inputs(qvars, answers, part, marks):
+    """ Fetch the guess, correct answer and tolerance for a part, recording
+        them in marks.
+    """
+    try:
+        guess = answers["G%s" % (part,)]
+    except KeyError:
+        L.info("null guess %s" % part)
+        guess = "None"
+    # noinspection PyComparisonWithNone
+    if guess == None:   # If it's 0 we want to leave it alone
+        guess = "None"
+    if guess == "":
+        guess = "None"
+    correct = qvars["A%s" % part]
+    # noinspection PyComparisonWithNone
+    if correct == None:  # If it's 0 we want to leave it alone
+        correct = "None"
+    if correct == "":
+        correct = "None"
+    marks["G%s" % part] = guess
+    marks["A%s" % part] = correct
+    tkey = "T%s" % part
+    tolerance = 0
+    if tkey in qvars:
+        try:
+            tolerance = float(qvars[tkey])
+        except ValueError:
+            pass
+    marks[tkey] = tolerance
+    return guess, correct, tolerance
+
+
+def _standard_compare(guess, correct):
+    """ Work out how the guess should be compared with the correct answer.
+        Returns (gtype, guess, correct), gtype is "float" or "string", and
+        guess/correct are converted to numbers if that's how to compare them.
+    """
+    try:   # See if we can convert it to numeric form
+        correct = float(correct)
+        if "NaN" in guess or "inf" in guess:
+            guess = ""
+        guess = float(guess)
+        gtype = "float"
+    except (KeyError, ValueError, TypeError):  # Guess not
+        try:  # How about exponential?
+            (st, flt) = parseexpo(guess)
+            if flt:
+                guess = flt
+                gtype = "float"
+            else:
+                gtype = "string"
+        except (KeyError, ValueError, TypeError):  # no, treat it as string
+            gtype = "string"
+    if gtype == "string":   # Occasionally people use , instead of .
+                            # which is ok in Europe.
+        guess = guess.replace(",", ".")
+        try:   # See if we can convert it to numeric form
+            guess = float(guess)
+            correct = float(correct)
+            gtype = "float"
+        except (ValueError, TypeError):  # Guess not
+            pass
+    return gtype, guess, correct
+
+
+def _standard_mark(marks, part, right):
+    """ Record the mark for a part """
+    if right:
+        marks["M%s" % (part,)] = 1.0
+        marks["C%s" % (part,)] = "Correct"
+    else:
+        marks["M%s" % (part,)] = 0
+        marks["C%s" % (part,)] = "Incorrect"
+
+
 def mark_q_standard(qvars, answers):
     """ Mark the question using the standard method
         if numerical answer is within tolerance% of the answer, it gets 1 mark.
@@ -571,80 +1054,184 @@ def mark_q_standard(qvars, answers):
     if not qvars:
         L.warn("error: No qvars provided!")
         qvars = {}
-    parts = [var[1:]
-             for var in qvars.keys()
-             if re.search("^A([0-9]+$)", var) > 0]
     marks = {}
-    for part in parts:
-        try:
-            guess = answers["G%s" % (part,)]
-        except KeyError:
-            L.info("null guess %s" % part)
-            guess = "None"
-        # noinspection PyComparisonWithNone
-        if guess == None:   # If it's 0 we want to leave it alone
-            guess = "None"
-        if guess == "":
-            guess = "None"
-        correct = qvars["A%s" % part]
-        # noinspection PyComparisonWithNone
-        if correct == None:  # If it's 0 we want to leave it alone
-            correct = "None"
-        if correct == "":
-            correct = "None"
-        marks["G%s" % part] = guess
-        marks["A%s" % part] = correct
-        try:
-            tolerance = float(qvars["T%s" % part])
-        except (KeyError, ValueError):
-            tolerance = 0
-        marks["T%s" % part] = tolerance
-        try:   # See if we can convert it to numeric form
-            correct = float(correct)
-            if "NaN" in guess or "inf" in guess:
-                guess = ""
-            guess = float(guess)
-            gtype = "float"
-        except (KeyError, ValueError, TypeError):  # Guess not
-            try:  # How about exponential?
-                (st, flt) = parseexpo(guess)
-                if flt:
-                    guess = flt
-                    gtype = "float"
-                else:
-                    gtype = "string"
-            except (KeyError, ValueError, TypeError):  # no, treat it as string
-                gtype = "string"
-        if gtype == "string":   # Occasionally people use , instead of .
-                                # which is ok in Europe.
-            guess = guess.replace(",", ".")
-            try:   # See if we can convert it to numeric form
-                guess = float(guess)
-                correct = float(correct)
-                gtype = "float"
-            except (ValueError, TypeError):  # Guess not
-                pass
+    for part in _standard_parts(qvars):
+        (guess, correct, tolerance) = _standard_inputs(qvars, answers, part, marks)
+        (gtype, guess, correct) = _standard_compare(guess, correct)
         if gtype == "float":
-            if script_funcs.within_tolerance(guess, correct, tolerance):
-                marks["M%s" % (part,)] = 1.0
-                marks["C%s" % (part,)] = "Correct"
-            else:
-                marks["M%s" % (part,)] = 0
-                marks["C%s" % (part,)] = "Incorrect"
-        if gtype == "string":
-            if str(guess).lower() == str(correct).lower():
-                marks["M%s" % (part,)] = 1.0
-                marks["C%s" % (part,)] = "Correct"
-            else:
-                marks["M%s" % (part,)] = 0
-                marks["C%s" % (part,)] = "Incorrect"
+            right = script_funcs.within_tolerance(guess, correct, tolerance)
+        else:
+            right = str(guess).lower() == str(correct).lower()
+        _standard_mark(marks, part, right)
     return marks
 
 
-def mark_q_script(qvars, script, answer):
-    """ Use the given script to mark the question.
+def within_tolerance_many(guesses, corrects, tolerances):
+    """ script_funcs.within_tolerance() for lists of numbers at once, using
+        numpy if it's available. Returns a list of True/False.
+    """
+    if numpy is None:
+        return [script_funcs.within_tolerance(guess, correct, tolerance)
+                for (guess, correct, tolerance)
+                in zip(guesses, corrects, tolerances)]
+    guess = numpy.array(guesses, dtype=numpy.float64)
+    correct = numpy.array(corrects, dtype=numpy.float64)
+    tolerance = numpy.array(tolerances, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        lower = correct - (numpy.abs(correct) * (tolerance / 100))
+        upper = correct + (numpy.abs(correct) * (tolerance / 100))
+        swap = upper < lower
+        (lower, upper) = (numpy.where(swap, upper, lower),
+                          numpy.where(swap, lower, upper))
+        return ((lower <= guess) & (guess <= upper)).tolist()
+
+
+def mark_q_standard_batch(items):
+    """ Mark many questions using the standard method at once, eg. all the
+        instances of a qtemplate in an exam.
+        items is a list of (qvars, answers) and a list of marks is returned
+        in the same order, exactly as mark_q_standard would give for each.
+        Guesses are only parsed once for each (guess, answer) pair seen, and
+        the tolerance checks are done together.
+    """
+    results = []
+    partlists = {}   # variations of the same qtemplate have the same parts
+    compared = {}
+    numeric = []     # (marks, part, guess, correct, tolerance)
+    for (qvars, answers) in items:
+        if not qvars:
+            L.warn("error: No qvars provided!")
+            qvars = {}
+        marks = {}
+        names = frozenset(qvars)
+        parts = partlists.get(names)
+        if parts is None:
+            parts = _standard_parts(qvars)
+            partlists[names] = parts
+        for part in parts:
+            (guess, correct, tolerance) = _standard_inputs(qvars, answers, part, marks)
+            try:
+                (gtype, cguess, ccorrect) = compared[(guess, correct)]
+            except KeyError:
+                (gtype, cguess, ccorrect) = _standard_compare(guess, correct)
+                compared[(guess, correct)] = (gtype, cguess, ccorrect)
+            except TypeError:   # can't be a dict key
+                (gtype, cguess, ccorrect) = _standard_compare(guess, correct)
+            if gtype == "float" and isinstance(cguess, float) \
+                    and isinstance(ccorrect, float):
+                numeric.append((marks, part, cguess, ccorrect, tolerance))
+            elif gtype == "float":
+                _standard_mark(marks, part,
+                               script_funcs.within_tolerance(cguess, ccorrect, tolerance))
+            else:
+                _standard_mark(marks, part,
+                               str(cguess).lower() == str(ccorrect).lower())
+        results.append(marks)
+    if numeric:
+        rights = within_tolerance_many([num[2] for num in numeric],
+                                       [num[3] for num in numeric],
+                                       [num[4] for num in numeric])
+        for (num, right) in zip(numeric, rights):
+            _standard_mark(num[0], num[1], right)
+    return results
+
+
+# Compiled marker and results scripts, {(qt_id, version, hash): code}
+_SCRIPT_CODE = {}
+_SCRIPT_CODE_MAX = 200
+
+# How long the scripts take, {(qt_id, name): {...}}
+_SCRIPT_TIMES = {}
+_SCRIPT_TIMES_LOCK = threading.Lock()
+
+# Scripts taking longer than this (seconds) to run get logged
+SLOW_SCRIPT = 2.0
+
+
+def get_qt_script(qt_id, name, version=None):
+    """ Fetch a script attachment (eg. __marker.py) for the qtemplate, ready
+        to exec(). Compiled scripts are kept, keyed by the attachment content,
+        so a new attachment is picked up as soon as it's saved.
+        Returns None if there's no such attachment. If it won't compile, the
+        source is returned so exec() can report the error as usual.
+    """
+    assert isinstance(qt_id, int)
+    if version is None:
+        version = DB.get_qt_version(qt_id)
+    hashval = DB.get_qt_att_hash(qt_id, name, version)
+    if not hashval:
+        return None
+    key = (qt_id, version, hashval)
+    code = _SCRIPT_CODE.get(key)
+    if code:
+        return code
+    script = DB.get_attach_data(hashval)
+    if not script:
+        return None
+    start = time.time()
+    try:
+        code = compile(script, name, "exec")
+    except (SyntaxError, TypeError, ValueError):
+        return script
+    record_script_time(qt_id, name, "compile", time.time() - start)
+    if len(_SCRIPT_CODE) >= _SCRIPT_CODE_MAX:
+        _SCRIPT_CODE.clear()
+    _SCRIPT_CODE[key] = code
+    return code
+
+
+def record_script_time(qt_id, name, what, elapsed):
+    """ Keep track of how long it took to "compile" or "run" a script. """
+    with _SCRIPT_TIMES_LOCK:
+        times = _SCRIPT_TIMES.get((qt_id, name))
+        if not times:
+            times = {'qtid': qt_id, 'name': name,
+                     'compiles': 0, 'compiletime': 0.0,
+                     'runs': 0, 'runtime': 0.0, 'maxruntime': 0.0}
+            _SCRIPT_TIMES[(qt_id, name)] = times
+        if what == "compile":
+            times['compiles'] += 1
+            times['compiletime'] += elapsed
+        else:
+            times['runs'] += 1
+            times['runtime'] += elapsed
+            times['maxruntime'] = max(times['maxruntime'], elapsed)
+    if what == "run" and elapsed > SLOW_SCRIPT:
+        L.warn("Slow %s for qtemplate %s, took %.2fs" % (name, qt_id, elapsed))
+
+
+def get_script_timings(num=10):
+    """ Return timings for the slowest (on average) scripts run by this
+        process, slowest first:
+          [{qtid, name, compiles, compiletime, runs, runtime, maxruntime,
+            avgruntime}, ...]
+    """
+    with _SCRIPT_TIMES_LOCK:
+        timings = [dict(times) for times in _SCRIPT_TIMES.values()]
+    for times in timings:
+        times['avgruntime'] = times['runtime'] / max(1, times['runs'])
+    timings.sort(key=lambda t: t['avgruntime'], reverse=True)
+    return timings[:num]
+
+
+def run_marker_script(qvars, script, answer):
+    """ Run the marker script, returns (marks, error, logged). error is None,
+        or a description of what went wrong if the script raised an exception.
+        logged is a list of (qid, priority, message) the script log()'ed, for
+        the caller to record with script_funcs.q_log.
+        Doesn't touch the database, so can be run in a worker process.
     """
     marks = {}
+    logged = []
+
+    def marker_log_fn(qid):
+        """ Like script_funcs.marker_log_fn, but just keeps the messages. """
+        def real_markerlog(priority, mesg):
+            """__marker.py has log() 'ed an error"""
+            logged.append((qid, priority, mesg))
+
+        return real_markerlog
+
     for name in qvars:
         try:   # See if we can convert it to numeric form
             if "NaN" in qvars[name] or "inf" in qvars[name]:
@@ -662,7 +1249,7 @@ def mark_q_script(qvars, script, answer):
                              'round': round,
                              'float': float,
                              'abs': abs,
-                             'log': script_funcs.marker_log_fn,
+                             'log': marker_log_fn,
                              'None': None,
                              'True': True,
                              'False': False}
@@ -698,19 +1285,12 @@ def mark_q_script(qvars, script, answer):
             qvars['G%d' % part] = "None"
         if qvars['G%d' % part] == "":
             qvars['G%d' % part] = "None"
-    try:
-        qid = qvars['OaQID']
-    except KeyError:
-        qid = -1
+    error = None
     try:
         exec (script, qvars)
     except BaseException:
         (etype, value, tb) = sys.exc_info()
-        script_funcs.q_log(qid,
-                           "error",
-                           "__marker.py",
-                           "Falling back to standard marker __marker.py: %s" % (
-                               traceback.format_exception(etype, value, tb)[-2:]))
+        error = "%s" % (traceback.format_exception(etype, value, tb)[-2:],)
     try:
         qid = qvars['OaQID']
     except KeyError:
@@ -739,6 +1319,58 @@ def mark_q_script(qvars, script, answer):
         if not part == 0:
             marks["G%d" % part] = qvars["G%d" % part]
             marks["T%d" % part] = qvars["T%d" % part]
+    return marks, error, logged
+
+
+# Marker scripts are run in these, out of the way of the web server threads
+MARKER_POOL = None
+if OaConfig.marker_workers > 0:
+    MARKER_POOL = Pool.WorkerPool(run_marker_script,
+                                  OaConfig.marker_workers,
+                                  timeout=OaConfig.marker_timeout,
+                                  cputime=OaConfig.marker_cpu_limit,
+                                  memory=OaConfig.marker_memory_mb * 1024 * 1024)
+
+
+def mark_q_script(qvars, script, answer, qtid=None):
+    """ Use the given script to mark the question. script can be the source
+        or already compiled (see get_qt_script).
+        Returns None if the script took too long or broke its worker
+        process, use the standard marker instead.
+    """
+    try:
+        qid = qvars['OaQID']
+    except KeyError:
+        qid = -1
+    marks = None
+    logged = []
+    start = time.time()
+    if MARKER_POOL:
+        try:
+            # Don't hold a database connection while we wait
+            with DB.connection_released():
+                (marks, error, logged) = MARKER_POOL.call(qvars, script, answer)
+        except ValueError:  # Something in there can't be sent, do it here
+            pass
+        except OaWorkerError as err:
+            if qtid:
+                record_script_time(qtid, "__marker.py", "run", time.time() - start)
+            script_funcs.q_log(qid,
+                               "error",
+                               "__marker.py",
+                               "Falling back to standard marker: %s" % err)
+            return None
+    if marks is None:
+        (marks, error, logged) = run_marker_script(qvars, script, answer)
+    if qtid:
+        record_script_time(qtid, "__marker.py", "run", time.time() - start)
+    for (log_qid, priority, mesg) in logged:
+        script_funcs.q_log(log_qid, priority, "__marker.py", mesg)
+    if error:
+        script_funcs.q_log(qid,
+                           "error",
+                           "__marker.py",
+                           "Falling back to standard marker __marker.py: %s" % error)
     return marks
 
 
@@ -776,9 +1408,8 @@ def render_mark_results_script(qtid, qid, marks, script):
     """Run the provided script to show the marking for the
        question.
     """
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
-    qvars = DB.get_qt_variation(qtid, variation, version)
+    qinst = DB.get_q_instance(qid)
+    qvars = DB.get_qt_variation(qtid, qinst.variation, qinst.version)
     questionhtml = render_q_html(qid, readonly=True)
     reshtml = ""
     qvars["__builtins__"] = {'MyFuncs': OqeSmartmarkFuncs,
@@ -828,6 +1459,7 @@ def render_mark_results_script(qtid, qid, marks, script):
         qvars['comments'][comment] = marks['C%d' % comment]
     qvars['numparts'] = len(answers)
     qvars['parts'] = range(1, len(answers) + 1)
+    start = time.time()
     try:
         exec (script, qvars)
     except BaseException:
@@ -837,6 +1469,7 @@ def render_mark_results_script(qtid, qid, marks, script):
                            "__results.py",
                            "Reverting to standard display: __results.py: %s" % (
                            traceback.format_exception(etype, value, tb)[-2:]))
+    record_script_time(qtid, "__results.py", "run", time.time() - start)
     if 'resultsHTML' in qvars:
         if len(qvars['resultsHTML']) > 2:
             reshtml = qvars['resultsHTML']
@@ -861,7 +1494,7 @@ def render_mark_results(qid, marks):
        in an HTML page.
     """
     qtid = DB.get_q_parent(qid)
-    renderscript = DB.get_qt_att(qtid, "__results.py")
+    renderscript = get_qt_script(qtid, "__results.py")
     if not renderscript:
         resultshtml = render_mark_results_standard(qid, marks)
     else:
@@ -875,10 +1508,9 @@ def mark_q(qid, answers):
         input:    {"A1":"0.345", "A2":"fred", "A3":"-26" }
         return:   {"M1": Mark One, "C1": Comment One, "M2": Mark Two..... }
     """
-    qtid = DB.get_q_parent(qid)
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
-    qvars = DB.get_qt_variation(qtid, variation, version)
+    qinst = DB.get_q_instance(qid)
+    qtid = qinst.qtemplate
+    qvars = DB.get_qt_variation(qtid, qinst.variation, qinst.version)
     if not qvars:
         qvars = {}
         L.warn("markQuestion(%s, %s) unable to retrieve variables." %
@@ -888,19 +1520,106 @@ def mark_q(qid, answers):
     if marktype == 1:    # standard
         marks = mark_q_standard(qvars, answers)
     else:
-        # We want the latest version of the marker, so no version given
-        markerscript = DB.get_qt_att(qtid, "__marker.py")
-        if not markerscript:
-            markerscript = DB.get_qt_att(qtid, "marker.py")
-            L.info("'marker.py' should now be called '__marker.py' (qtid=%s)" % qtid)
+        markerscript = _get_marker_script(qtid)
         if not markerscript:
-            L.info("Unable to retrieve marker script for smart marker question (qtid=%s)!" % qtid)
             marks = mark_q_standard(qvars, answers)
         else:
-            marks = mark_q_script(qvars, markerscript, answers)
+            marks = mark_q_script(qvars, markerscript, answers, qtid)
+            if marks is None:
+                marks = mark_q_standard(qvars, answers)
     return marks
 
 
+def _get_marker_script(qtid):
+    """ The marker script for a smart marked qtemplate, or None if it
+        hasn't got one.
+    """
+    # We want the latest version of the marker, so no version given
+    markerscript = get_qt_script(qtid, "__marker.py")
+    if not markerscript:
+        markerscript = get_qt_script(qtid, "marker.py")
+        L.info("'marker.py' should now be called '__marker.py' (qtid=%s)" % qtid)
+    if not markerscript:
+        L.info("Unable to retrieve marker script for smart marker question (qtid=%s)!" % qtid)
+    return markerscript
+
+
+def mark_q_instances(qinsts, answers, done=None):
+    """ Mark lots of questions at once, eg. everyone's in an assessment, the
+        same as mark_q would for each.
+        qinsts is a list of DB.QuestionInstance, and answers the guesses
+        for them { q_id: {"G1": guess, ...} }. done(num) is called as they
+        get marked.
+        Standard marked questions are done together, scripts are run in the
+        marker worker processes several at a time.
+        Returns { q_id: marks }
+    """
+    variations = {}
+    markers = {}
+    standard = []
+    scripted = []
+    for qinst in qinsts:
+        qtid = qinst.qtemplate
+        vkey = (qtid, qinst.variation, qinst.version)
+        if vkey not in variations:
+            variations[vkey] = DB.get_qt_variation(qtid, qinst.variation,
+                                                   qinst.version)
+        qvars = variations[vkey]
+        if qvars:
+            qvars = dict(qvars)
+        else:
+            qvars = {}
+            L.warn("mark_q_instances unable to retrieve variables for %s" %
+                   qinst.id)
+        qvars['OaQID'] = int(qinst.id)
+        if qtid not in markers:
+            markers[qtid] = None
+            if not DB.get_qt_marker(qtid) == 1:
+                markers[qtid] = _get_marker_script(qtid)
+        guesses = answers.get(qinst.id, {})
+        if markers[qtid]:
+            scripted.append((qinst.id, qtid, qvars, guesses))
+        else:
+            standard.append((qinst.id, qvars, guesses))
+
+    results = {}
+    if standard:
+        marked = mark_q_standard_batch([(qvars, guesses)
+                                        for (q_id, qvars, guesses)
+                                        in standard])
+        for (item, marks) in zip(standard, marked):
+            results[item[0]] = marks
+        if done:
+            done(len(standard))
+
+    def mark_one(item):
+        """ Run the marker script for one question """
+        (q_id, qtid, qvars, guesses) = item
+        try:
+            marks = mark_q_script(qvars, markers[qtid], guesses, qtid)
+        except OaMarkerError:
+            L.warn("Marker Error, question %d while marking many!" % q_id)
+            return q_id, {}
+        if marks is None:
+            marks = mark_q_standard(qvars, guesses)
+        return q_id, marks
+
+    if scripted:
+        workers = 1
+        if MARKER_POOL:
+            workers = MARKER_POOL.size
+        threads = ThreadPool(workers)
+        try:
+            for (q_id, marks) in threads.imap_unordered(mark_one, scripted):
+                results[q_id] = marks
+                if done:
+                    done(1)
+        finally:
+            threads.close()
+            threads.join()
+    return results
+
+
 def is_now(start, end):
     """ Return True if now is in the given period"""
     return is_between(datetime.datetime.now(), start, end)
@@ -965,7 +1684,11 @@ def get_exam_q(exam, page, user_id):
     """
     qid = DB.get_exam_q_by_pos_student(exam, page, user_id)
     if qid is not False:
-        return int(qid)
+        qid = int(qid)
+        qinst = DB.get_q_instance(qid)
+        if qinst and not qinst.firstview:   # made in advance, first look
+            DB.set_q_viewtime(qid)
+        return qid
     qid = int(gen_exam_q(exam, page, user_id))
     try:
         qid = int(qid)
@@ -990,6 +1713,140 @@ def get_exam_qs(student, exam):
     return questions
 
 
+def provision_exam(exam_id, students=None):
+    """ Create everyone's assessment questions in the background, ahead of
+        it starting. See provision_exam_qs(), check on it with
+        get_provision_progress().
+        Returns False if they're already being created.
+    """
+    assert isinstance(exam_id, int)
+    job = DB.start_bg_job("provision", exam_id)
+    if not job:
+        return False
+    thread = threading.Thread(target=provision_exam_qs,
+                              args=(exam_id, students, job),
+                              name="provision-%d" % exam_id)
+    thread.start()
+    return True
+
+
+def get_provision_progress(exam_id):
+    """ How far along creating the assessment questions in advance is, or
+        how it went last time.
+        Returns None if it's never been done, or a dict as
+        provision_exam_qs() does.
+    """
+    assert isinstance(exam_id, int)
+    job = DB.get_bg_job("provision", exam_id)
+    if not job:
+        return None
+    return {'students': job['info'].get('students', 0),
+            'total': job['total'],
+            'done': job['done'],
+            'finished': job['finished'],
+            'error': job['error']}
+
+
+def provision_exam_qs(exam_id, students=None, job=None):
+    """ Assign and create every student's assessment questions in one go,
+        ahead of it starting, so opening each page at the start time doesn't
+        have to generate anything. students defaults to everyone in the
+        course's active groups. Questions they already have are kept, so it's
+        fine to run again (eg. after more enrolments).
+        The question html and images are generated first.
+        job is the background job already started for it, if any.
+        Returns:
+          { students: int    number of students
+            total: int       number of questions needed
+            done: int        how many have been created
+            finished: bool   True once all done (or given up)
+            error: string    why it gave up, or None
+          }
+    """
+    assert isinstance(exam_id, int)
+    progress = {'students': 0, 'total': 0, 'done': 0, 'finished': False,
+                'error': None}
+    if job is None:
+        job = DB.start_bg_job("provision", exam_id)
+        if not job:
+            progress['finished'] = True
+            progress['error'] = "Questions are already being prepared"
+            return progress
+    started = time.time()
+    try:
+        with DB.pinned_connection():
+            if students is None:
+                exam = Exams.get_exam_struct(exam_id)
+                students = set([])
+                for g_id in Groups.active_by_course(exam['cid']):
+                    students.update(Groups.Group(g_id=g_id).members())
+            students = sorted(set(students))
+            progress['students'] = len(students)
+            assigned = DB.get_exam_assigned(exam_id)
+            qtinfo = {}
+            wanted = {}
+            assignments = []
+            for position in range(1, Exams.get_num_questions(exam_id) + 1):
+                qtemplates = DB.get_exam_qts_in_pos(exam_id, position)
+                if not qtemplates:
+                    L.warn("No qtemplates in position %s of exam %s" %
+                           (position, exam_id))
+                    continue
+                for qt_id in qtemplates:
+                    if qt_id not in qtinfo:
+                        version = DB.get_qt_version(qt_id)
+                        qtinfo[qt_id] = (DB.get_qt_name(qt_id), version,
+                                         DB.get_qt_num_variations(qt_id, version))
+                for student in students:
+                    if (student, position) in assigned:
+                        continue
+                    # Chosen the same way as gen_exam_q and gen_q
+                    qt_id = qtemplates[random.randint(1, len(qtemplates)) - 1]
+                    (name, version, numvars) = qtinfo[qt_id]
+                    if numvars < 1:
+                        L.warn("No question variations (qtid=%d)" % qt_id)
+                        continue
+                    variation = random.randint(1, numvars)
+                    wanted.setdefault(qt_id, set([])).add(variation)
+                    assignments.append((student, position, qt_id, name,
+                                        variation, version))
+            progress['total'] = len(assignments)
+            DB.update_bg_job(job, total=progress['total'],
+                             info={'students': progress['students']})
+
+            for qt_id, variations in wanted.items():
+                _prerender_qt(qt_id, qtinfo[qt_id][1], variations)
+            with DB.transaction():
+                progress['done'] = DB.create_exam_qs(exam_id, assignments)
+        L.info("Created %d questions in advance for %d students in exam %s "
+               "in %.1fs" % (progress['done'], progress['students'], exam_id,
+                             time.time() - started))
+    except Exception as err:
+        L.error("Creating questions for exam %s failed: %s" % (exam_id, err))
+        progress['error'] = "%s" % err
+    finally:
+        progress['finished'] = True
+        DB.update_bg_job(job, done=progress['done'])
+        DB.finish_bg_job(job, progress['error'])
+    return progress
+
+
+def _total_marks(marks):
+    """ Add up the marks for all the parts of a marked question. """
+    parts = [int(var[1:])
+             for var in marks.keys()
+             if re.search("^A([0-9]+)$", var) > 0]
+    parts.sort()
+    total = 0.0
+    for part in parts:
+        try:
+            mark = float(marks['M%d' % part])
+        except (ValueError, TypeError, KeyError):
+            mark = 0
+        total += mark
+    return total
+
+
 def remark_exam(exam, student):
     """Re-mark the exam using the latest marking. """
     qtemplates = Exams.get_qts(exam)
@@ -1003,24 +1860,119 @@ def remark_exam(exam, student):
         except OaMarkerError:
             L.warn("Marker Error, question %d while re-marking exam %s for student %s!" % (question, exam, student))
             marks = {}
-        parts = [int(var[1:]) for var in marks.keys() if re.search("^A([0-9]+)$", var) > 0]
-        parts.sort()
-        total = 0.0
-        for part in parts:
-            if marks['C%d' % part] == 'Correct':
-                marks['C%d' % part] = "<b><font color='darkgreen'>Correct</font></b>"
-            try:
-                mark = float(marks['M%d' % part])
-            except (ValueError, TypeError, KeyError):
-                mark = 0
-            total += mark
+        total = _total_marks(marks)
+        DB.remove_q_stats(question)
         DB.update_q_score(question, total)
+        DB.add_q_stats(question)
         #        OaDB.setQuestionStatus(question, 3)    # 3 = marked
         examtotal += total
     Exams.save_score(exam, student, examtotal)
     return examtotal
 
 
+def remark_exam_all(exam_id, students=None):
+    """ Re-mark the assessment for everyone who has submitted it, using the
+        latest marking, in the background. eg. after fixing a marker script.
+        students can be a list of user ids (eg. a group's members) to just
+        re-mark theirs. Check on it with get_remark_progress()
+        Returns False if it's already being re-marked.
+    """
+    assert isinstance(exam_id, int)
+    job = DB.start_bg_job("remark", exam_id)
+    if not job:
+        return False
+    thread = threading.Thread(target=_remark_exam_all,
+                              args=(job, exam_id, students),
+                              name="remark-%d" % exam_id)
+    thread.start()
+    return True
+
+
+def get_remark_progress(exam_id):
+    """ How far along re-marking the assessment is, or how the last one went.
+        Returns None if it's never been re-marked, or a dict:
+          { total: int      number of questions being re-marked
+            done: int       how many are marked
+            students: int   number of students being re-marked
+            finished: bool  True once all done (or given up)
+            error: string   why it gave up, or None
+            changed: list   (student, old total, new total) for each
+                            student whose total changed
+          }
+    """
+    assert isinstance(exam_id, int)
+    job = DB.get_bg_job("remark", exam_id)
+    if not job:
+        return None
+    return {'total': job['total'],
+            'done': job['done'],
+            'students': job['info'].get('students', 0),
+            'finished': job['finished'],
+            'error': job['error'],
+            'changed': job['info'].get('changed', [])}
+
+
+def _remark_exam_all(job, exam_id, students):
+    """ Does the work for remark_exam_all. The questions and guesses are
+        all fetched at once, and the new scores saved in one transaction,
+        so nobody ends up half re-marked.
+    """
+    progress = {'done': 0, 'reported': time.time()}
+    info = {'students': 0, 'changed': []}
+    error = None
+    started = time.time()
+
+    def done(num):
+        """ Some more questions are marked, say so every few seconds """
+        progress['done'] += num
+        if time.time() - progress['reported'] > 2:
+            progress['reported'] = time.time()
+            DB.update_bg_job(job, done=progress['done'])
+
+    try:
+        with DB.pinned_connection():
+            qinsts = DB.get_exam_q_instances(exam_id, students)
+            # Only those that have been marked already
+            marked = set([qinst.student for qinst in qinsts if qinst.marktime])
+            qinsts = [qinst for qinst in qinsts if qinst.student in marked]
+            answers = DB.get_exam_guesses_before_marktime(exam_id, students)
+            info['students'] = len(marked)
+            DB.update_bg_job(job, total=len(qinsts), info=info)
+
+            results = mark_q_instances(qinsts, answers, done)
+
+            scores = {}
+            before = {}
+            after = {}
+            for qinst in qinsts:
+                total = _total_marks(results.get(qinst.id, {}))
+                scores[qinst.id] = total
+                try:
+                    before[qinst.student] = before.get(qinst.student, 0.0) + float(qinst.score)
+                except (TypeError, ValueError):
+                    pass
+                after[qinst.student] = after.get(qinst.student, 0.0) + total
+            with DB.transaction():
+                DB.remove_q_stats(scores.keys())
+                DB.update_q_scores(scores)
+                DB.add_q_stats(scores.keys())
+                for student in sorted(after.keys()):
+                    Exams.save_score(exam_id, student, after[student])
+            for student in sorted(after.keys()):
+                old = before.get(student, 0.0)
+                if not "%.1f" % old == "%.1f" % after[student]:
+                    info['changed'].append((student, old, after[student]))
+            DB.update_bg_job(job, done=progress['done'])
+        L.info("Re-marked exam %s, %d questions for %d students in %.1fs, %d totals changed" %
+               (exam_id, progress['done'], info['students'],
+                time.time() - started, len(info['changed'])))
+    except Exception as err:
+        L.error("Re-marking exam %s failed: %s" % (exam_id, err))
+        error = "%s" % err
+    finally:
+        DB.finish_bg_job(job, error, info)
+
+
 def remark_prac(question):
     """ Re-mark the practice question and store the score back
         in the questions table.
@@ -1030,18 +1982,10 @@ def remark_prac(question):
         marks = mark_q(question, answers)
     except OaMarkerError:
         return None
-    parts = [int(var[1:])
-             for var in marks.keys()
-             if re.search("^A([0-9]+)$", var) > 0]
-    parts.sort()
-    total = 0.0
-    for part in parts:
-        try:
-            mark = float(marks['M%d' % part])
-        except (ValueError, TypeError, KeyError):
-            mark = 0
-        total += mark
+    total = _total_marks(marks)
+    DB.remove_q_stats(question)
     DB.update_q_score(question, total)
+    DB.add_q_stats(question)
     DB.set_q_status(question, 3)    # 3 = marked
     return total
 
@@ -27,23 +27,41 @@ statichost = cp.get("web", "statichost")
 staticpath = cp.get("web", "staticpath")
 default = cp.get("web", "default")
 theme_path = cp.get("web", "theme_path")
+attachment_sendfile = cp.get("web", "attachment_sendfile").strip().lower()
+attachment_sendfile_prefix = cp.get("web", "attachment_sendfile_prefix")
 staticURL = os.path.join(statichost, staticpath)
 homedir = cp.get("app", "homedir")
 secretkey = cp.get("app", "secretkey")
 admin_list = cp.get("app", "email_admins")
 smtp_server = cp.get("app", "smtp_server")
+prerender_workers = cp.getint("app", "prerender_workers")
+question_image_format = cp.get("app", "question_image_format")
+marker_workers = cp.getint("app", "marker_workers")
+marker_timeout = cp.getfloat("app", "marker_timeout")
+marker_cpu_limit = cp.getint("app", "marker_cpu_limit")
+marker_memory_mb = cp.getint("app", "marker_memory_mb")
+mark_queue_workers = cp.getint("app", "mark_queue_workers")
+mark_queue_poll = cp.getfloat("app", "mark_queue_poll")
+mark_queue_stale = cp.getint("app", "mark_queue_stale")
 
 if len(admin_list):
     email_admins = admin_list
 else:
     email_admins = ()
 cachedir = cp.get("cache", "cachedir")
+cachedir_maxbytes = cp.getint("cache", "cachedir_max_mb") * 1024 * 1024
+cachedir_rescan = cp.getfloat("cache", "cachedir_rescan")
 
 dbhost = cp.get("db", "host")
 dbuname = cp.get("db", "uname")
 dbname = cp.get("db", "dbname")
 dbpass = cp.get("db", "pass")
 dbport = cp.get("db", "port")
+dbpool_size = cp.getint("db", "pool_size")
+dbpool_max = cp.getint("db", "pool_max")
+dbpool_overflow = cp.getint("db", "pool_overflow")
+dbpool_timeout = cp.getfloat("db", "pool_timeout")
+dbpool_recheck = cp.getfloat("db", "pool_recheck")
 
 oasisdbconnectstring = "host=%s port=%s dbname=%s user=%s password='%s'" % \
                        (dbhost, dbport, dbname, dbuname, dbpass)
@@ -54,6 +72,13 @@ if len(contact_url) < 3:
     contact_url = False
 enableMemcache = cp.getboolean("cache", "memcache_enable")
 uniqueKey = cp.get("cache", "cachekey")
+localcache_entries = cp.getint("cache", "local_cache_entries")
+localcache_bytes = cp.getint("cache", "local_cache_bytes")
+localcache_ttl = cp.getfloat("cache", "local_cache_ttl")
+localcache_namespaces = [ns.strip() for ns in
+                         cp.get("cache", "local_cache_namespaces").split(",")
+                         if ns.strip()]
+localcache_version_check = cp.getfloat("cache", "local_cache_version_check")
 logfile = cp.get("app", "logfile")
 profile_log = cp.get("app", "profile_log")
 feed_path = cp.get("app", "feed_path")
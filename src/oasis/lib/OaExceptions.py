@@ -11,3 +11,25 @@ class OaMarkerError(Exception):
     """
 
     pass
+
+
+class OaDbPoolTimeout(Exception):
+    """We waited too long for a database connection to become available.
+    """
+
+    pass
+
+
+class OaWorkerError(Exception):
+    """A worker process failed to do what was asked (it raised an error,
+       died, or hit one of its limits).
+    """
+
+    pass
+
+
+class OaWorkerTimeout(OaWorkerError):
+    """A worker process took too long, or none was available in time.
+    """
+
+    pass
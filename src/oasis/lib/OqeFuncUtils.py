@@ -8,6 +8,8 @@
 """Functions used by the OQE question editor
 """
 
+import ast
+
 
 def chrange(start, end):
     """Generates a range of characters from start to end
@@ -72,12 +74,152 @@ def inc_bool_val_list(boollist):
     return boollist
 
 
+# Boolean expressions compiled to work on truth tables,
+#   {expression: (code, names) or None if it has to be done with eval()}
+_BOOL_EQS = {}
+_BOOL_EQS_MAX = 500
+
+# Truth table rows are worked out 2**BOOL_CHUNK_BITS at a time, as bits of
+# a (long) integer
+BOOL_CHUNK_BITS = 16
+
+# Bitset patterns for the variables, {(bit, chunkbits): pattern}
+_BOOL_PATTERNS = {}
+
+# Name used in the compiled expressions for "all rows true"
+_BOOL_MASK = "__mask__"
+
+
+class _BoolBitsetTransformer(ast.NodeTransformer):
+    """ Turn a python boolean expression using "not", "and" and "or" into one
+        that works on integer bitsets, each bit is one row of a truth table.
+        Raises ValueError if there's anything else in it.
+    """
+
+    def __init__(self):
+        ast.NodeTransformer.__init__(self)
+        self.names = set([])
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_BoolOp(self, node):
+        if isinstance(node.op, ast.And):
+            op = ast.BitAnd
+        else:
+            op = ast.BitOr
+        values = [self.visit(value) for value in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = ast.BinOp(left=result, op=op(), right=value)
+        return ast.copy_location(result, node)
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, ast.Not):
+            raise ValueError("Unsupported operator")
+        result = ast.BinOp(left=ast.Name(id=_BOOL_MASK, ctx=ast.Load()),
+                           op=ast.BitXor(),
+                           right=self.visit(node.operand))
+        return ast.copy_location(result, node)
+
+    def visit_Name(self, node):
+        self.names.add(node.id)
+        return node
+
+    def visit_Num(self, node):
+        if node.n:
+            result = ast.Name(id=_BOOL_MASK, ctx=ast.Load())
+        else:
+            result = ast.Num(n=0)
+        return ast.copy_location(result, node)
+
+    def generic_visit(self, node):
+        raise ValueError("Unsupported expression")
+
+
+def _compile_bool_eq(eqstr):
+    """ Compile the boolean expression to work on truth table bitsets.
+        Returns (code, names), or None if it can't be, then it needs to be
+        done row by row with eval().
+    """
+    try:
+        return _BOOL_EQS[eqstr]
+    except KeyError:
+        pass
+    try:
+        transformer = _BoolBitsetTransformer()
+        tree = transformer.visit(ast.parse(eqstr, mode="eval"))
+        compiled = (compile(ast.fix_missing_locations(tree), "<bool>", "eval"),
+                    frozenset(transformer.names))
+    except (SyntaxError, TypeError, ValueError):
+        compiled = None
+    if len(_BOOL_EQS) >= _BOOL_EQS_MAX:
+        _BOOL_EQS.clear()
+    _BOOL_EQS[eqstr] = compiled
+    return compiled
+
+
+def _bool_pattern(bit, chunkbits):
+    """ The bitset for 2**chunkbits truth table rows where the variable is
+        true when the given bit of the row number is set.
+    """
+    try:
+        return _BOOL_PATTERNS[(bit, chunkbits)]
+    except KeyError:
+        pass
+    period = 1 << (bit + 1)
+    block = ((1 << (1 << bit)) - 1) << (1 << bit)   # 0s then 1s
+    repeat = ((1 << (1 << chunkbits)) - 1) // ((1 << period) - 1)
+    pattern = block * repeat
+    _BOOL_PATTERNS[(bit, chunkbits)] = pattern
+    return pattern
+
+
+def _bool_chunks(varlist):
+    """ Go through the truth table for the variables a chunk at a time.
+        Yields a dict of {name: bitset} for each chunk, including the mask
+        with all rows set.
+    """
+    numvars = len(varlist)
+    chunkbits = min(numvars, BOOL_CHUNK_BITS)
+    mask = (1 << (1 << chunkbits)) - 1
+    for chunk in range(1 << (numvars - chunkbits)):
+        values = {_BOOL_MASK: mask}
+        for pos, name in enumerate(varlist):
+            bit = numvars - pos - 1    # first variable changes slowest
+            if bit < chunkbits:
+                values[name] = _bool_pattern(bit, chunkbits)
+            elif (chunk >> (bit - chunkbits)) & 1:
+                values[name] = mask
+            else:
+                values[name] = 0
+        yield values
+
+
 def comp_bool_eqs(eq1str, eq2str, varlist):
     """ Will compare two boolean equations to see if they are the same.
         Assumes that the input strings are valid python expressions (i.e.
         use the operators 'not','and','or'). All variables
         in the equation must be specified in a list in 'varlist'.
     """
+    compiled1 = _compile_bool_eq(eq1str)
+    compiled2 = _compile_bool_eq(eq2str)
+    if not compiled1 or not compiled2 or _BOOL_MASK in varlist \
+            or not (compiled1[1] | compiled2[1]) <= set(varlist):
+        return _comp_bool_eqs_eval(eq1str, eq2str, varlist)
+    noglobals = {'__builtins__': {}}
+    for values in _bool_chunks(varlist):
+        if not eval(compiled1[0], noglobals, values) == \
+                eval(compiled2[0], noglobals, values):
+            return 0
+    return 1
+
+
+def _comp_bool_eqs_eval(eq1str, eq2str, varlist):
+    """ comp_bool_eqs() the slow way, calling eval() for each row of the
+        truth table. Used for anything _compile_bool_eq can't do.
+    """
     numvars = len(varlist)
     boolvals = []
     for i in range(numvars):
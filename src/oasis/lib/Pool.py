@@ -15,10 +15,22 @@
 
 import Queue
 import os
+import hashlib
+import tempfile
+import threading
+import time
+import cPickle
+import marshal
+import signal
+import multiprocessing
+from collections import OrderedDict
 import OaConfig
+from OaExceptions import OaDbPoolTimeout, OaWorkerError, OaWorkerTimeout
 from logging import getLogger
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, \
+    ISOLATION_LEVEL_READ_COMMITTED, \
+    TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
 import memcache
 
 try:
@@ -35,11 +47,81 @@ class DbConn(object):
     def __init__(self, connectstring):
 
         self.connectstring = connectstring
-        self.conn = psycopg2.connect(connectstring)
+        self.conn = None
+        self.broken = False
+        self.overflow = False
+        self.lastused = time.time()
+        self.connect()
+
+    def connect(self):
+        """ (Re)open the underlying connection. """
+        self.conn = psycopg2.connect(self.connectstring)
         self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         L.info("DB Encoding is %s" % self.conn.encoding)
         if not self.conn:
             L.warn("DB relogin failed!")
+        self.broken = False
+        self.lastused = time.time()
+
+    def close(self):
+        """ Close the underlying connection, ignoring any errors since
+            it's probably already broken if we're doing this.
+        """
+        try:
+            self.conn.close()
+        except BaseException:
+            pass
+
+    def is_usable(self, recheck=None):
+        """ Is the connection still fit for use?
+            Checks the local connection state, and if the connection has
+            been idle for longer than "recheck" seconds also checks that the
+            server is still talking to us.
+        """
+        if self.broken or not self.conn or self.conn.closed:
+            return False
+        status = self.conn.get_transaction_status()
+        if status not in (TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS):
+            return False
+        if recheck is not None and time.time() - self.lastused > recheck:
+            try:
+                cur = self.conn.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+            except psycopg2.Error as err:
+                L.warn("DB connection failed check, will reconnect. (%s)" % err)
+                return False
+        return True
+
+    def begin(self):
+        """ Stop autocommitting, statements from now on are part of a
+            transaction until commit() or rollback().
+        """
+        self.conn.set_isolation_level(ISOLATION_LEVEL_READ_COMMITTED)
+
+    def commit(self):
+        """ Commit the transaction and go back to autocommit. If the commit
+            fails, whatever is left of the transaction is rolled back.
+        """
+        try:
+            self.conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.broken = True
+            raise
+        finally:
+            if not self.broken:
+                # Harmless after a successful commit, and makes sure we're
+                # back in autocommit after a failed one.
+                self.rollback()
+
+    def rollback(self):
+        """ Abandon the transaction and go back to autocommit. """
+        try:
+            self.conn.rollback()
+            self.conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        except psycopg2.Error as err:
+            L.warn("DB rollback failed, will reconnect. (%s)" % err)
+            self.broken = True
 
     def run_sql(self, sql, params=None, quiet=False):
         """ Execute SQL commands over the connection. """
@@ -52,13 +134,18 @@ class DbConn(object):
                 rec = cur.execute(sql, params)
 
         except BaseException as err:
+            if isinstance(err, (psycopg2.OperationalError,
+                                psycopg2.InterfaceError)):
+                # Probably lost the server, the pool will reconnect us
+                self.broken = True
             if not quiet:
                 L.error("DB Error (%s) '%s' (%s)" % (err, sql, repr(params)))
                 raise
             return None
 
-        if (sql.split()[0].upper() in ("SELECT", "SHOW", "DESC", "DESCRIBE")
-                or "RETURNING" in sql.upper()):
+        # Anything that gives back rows (SELECT, WITH ... SELECT,
+        # ... RETURNING, SHOW, etc.) has a description.
+        if cur.description is not None:
             recset = cur.fetchall()
             cur.close()
             return recset
@@ -66,13 +153,51 @@ class DbConn(object):
             cur.close()
             return rec
 
+    def iter_sql(self, sql, params=None, batchsize=1000):
+        """ Execute a query with a server-side cursor, generating the rows
+            a batch at a time instead of fetching them all at once. The
+            cursor needs a transaction, which is rolled back when done.
+        """
+        self.begin()
+        try:
+            cur = self.conn.cursor("iter_sql")   # named = server-side
+            if not params:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batchsize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+            cur.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.broken = True
+            raise
+        except psycopg2.Error as err:
+            L.error("DB Error (%s) '%s' (%s)" % (err, sql, repr(params)))
+            raise
+        finally:
+            if not self.broken:
+                self.rollback()
+
 
 class DbPool(object):
     """ Manage a pool of DbConn.
         users should grab a database connection with start(), run sql
         commands with run_sql() and then release it back to the pool with
         finish(). 
-        Will initialise the pool with the given number of parallel connections.
+        Will initialise the pool with the given number of parallel connections,
+        and grow it as needed up to "maxsize". Under burst load up to
+        "overflow" extra connections may be opened, they are closed again
+        when handed back.
+
+        Connections are checked on the way out of the pool, and reconnected
+        if they've broken (eg. the database server was restarted).
+
+        If no connection becomes available within "timeout" seconds,
+        start() will raise OaDbPoolTimeout.
 
         example:
 
@@ -82,30 +207,194 @@ class DbPool(object):
         dbpool.finish(dbc)
     """
 
-    def __init__(self, connectstring, size):
-        self.connqueue = Queue.Queue(size)
+    def __init__(self, connectstring, size, maxsize=None, overflow=0,
+                 timeout=None, recheck=60):
+        if maxsize is None or maxsize < size:
+            maxsize = size
+        self.connectstring = connectstring
+        self.size = size
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.timeout = timeout
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        # Notified when a connection is handed back, or closed to make room
+        self.freed = threading.Condition(self.lock)
+        self.numopen = 0
+        self.counters = {
+            'checkouts': 0,      # number of times start() handed one out
+            'waits': 0,          # number of times start() had to wait
+            'waittime': 0.0,     # total seconds spent waiting
+            'maxwait': 0.0,      # longest single wait
+            'timeouts': 0,       # number of times we gave up waiting
+            'reconnects': 0,     # broken connections replaced
+            'overflows': 0,      # burst connections opened
+        }
+        self.connqueue = Queue.Queue()
         for _ in range(0, size):
             self.connqueue.put(DbConn(connectstring))
+            self.numopen += 1
 
-    def start(self):
+    def _open_extra(self):
+        """ Open another connection if we're allowed to, otherwise
+            return None.
+        """
+        with self.lock:
+            if self.numopen >= self.maxsize + self.overflow:
+                return None
+            overflow = self.numopen >= self.maxsize
+            self.numopen += 1
+        try:
+            dbc = DbConn(self.connectstring)
+        except psycopg2.Error:
+            with self.freed:
+                self.numopen -= 1
+                self.freed.notify()
+            raise
+        dbc.overflow = overflow
+        if overflow:
+            with self.lock:
+                self.counters['overflows'] += 1
+            L.info("DB Pool opening burst connection, %d open." % self.numopen)
+        return dbc
+
+    def _checkout(self, timeout):
+        """ Find a connection, waiting if we have to. Whenever one is handed
+            back, or closed so there's room to open another, we try again.
+        """
+        waitstart = None
+        while True:
+            try:
+                dbc = self.connqueue.get(False)
+                break
+            except Queue.Empty:
+                pass
+            dbc = self._open_extra()
+            if dbc:
+                break
+            now = time.time()
+            if waitstart is None:
+                L.info("DB Pool exhausted, waiting. (%d open)" % self.numopen)
+                waitstart = now
+            remaining = None
+            if timeout is not None:
+                remaining = waitstart + timeout - now
+                if remaining <= 0:
+                    with self.lock:
+                        self.counters['timeouts'] += 1
+                    L.error("DB Pool timed out after %s seconds." % timeout)
+                    raise OaDbPoolTimeout("No database connection available "
+                                          "after %s seconds." % timeout)
+            with self.freed:
+                if self.connqueue.empty() and \
+                        self.numopen >= self.maxsize + self.overflow:
+                    self.freed.wait(remaining)
+        if waitstart is None:
+            return dbc
+        waited = time.time() - waitstart
+        with self.lock:
+            self.counters['waits'] += 1
+            self.counters['waittime'] += waited
+            if waited > self.counters['maxwait']:
+                self.counters['maxwait'] = waited
+        return dbc
+
+    def _reconnect(self, dbc):
+        """ Replace the broken connection inside dbc with a fresh one. """
+        dbc.close()
+        dbc.connect()
+        with self.lock:
+            self.counters['reconnects'] += 1
+        L.warn("DB Pool reconnected a broken connection.")
+
+    def start(self, timeout=-1):
         """Fetch a db connection from the pool (will block until one becomes
-           available), and begin a transaction on it.
+           available, or the timeout is reached), and begin a transaction
+           on it.
         """
+        if timeout == -1:
+            timeout = self.timeout
         if self.connqueue.qsize() < 3:
             L.info("DB Pool getting low! %d" % self.connqueue.qsize())
-        dbc = self.connqueue.get(True)
+        dbc = self._checkout(timeout)
+        if not dbc.is_usable(self.recheck):
+            try:
+                self._reconnect(dbc)
+            except psycopg2.Error as err:
+                L.error("DB Pool unable to reconnect. (%s)" % err)
+                self._discard(dbc)
+                raise
+        with self.lock:
+            self.counters['checkouts'] += 1
         return dbc
 
+    def _discard(self, dbc):
+        """ Throw away the connection rather than return it to the pool. """
+        dbc.close()
+        with self.freed:
+            self.numopen -= 1
+            self.freed.notify()
+
     def finish(self, dbc):
         """Put the db connection back in the pool."""
-        # TODO: check for errors and reset connection if any
-        self.connqueue.put(dbc)
+        dbc.lastused = time.time()
+        if not (dbc.broken or dbc.conn.closed) and \
+                dbc.conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            L.warn("DB connection returned mid-transaction, rolling back.")
+            dbc.rollback()
+        if dbc.broken or dbc.conn.closed:
+            # Find out now rather than when someone next needs it
+            try:
+                self._reconnect(dbc)
+            except psycopg2.Error as err:
+                L.error("DB Pool unable to reconnect. (%s)" % err)
+                self._discard(dbc)
+                return
+        if dbc.overflow and self.connqueue.qsize() >= self.size:
+            self._discard(dbc)
+            return
+        with self.freed:
+            self.connqueue.put(dbc)
+            self.freed.notify()
+
+    def stats(self):
+        """ Return a dictionary of pool counters, for display/monitoring.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['open'] = self.numopen
+        stats['idle'] = self.connqueue.qsize()
+        stats['inuse'] = stats['open'] - stats['idle']
+        stats['size'] = self.size
+        stats['maxsize'] = self.maxsize
+        stats['overflow'] = self.overflow
+        if stats['waits']:
+            stats['avgwait'] = stats['waittime'] / stats['waits']
+        else:
+            stats['avgwait'] = 0.0
+        return stats
 
 
 class FileCache(object):
-    """Cache data in local files """
+    """ Cache data in local files.
+
+        Each item is stored in a file named after a hash of its key, spread
+        across subdirectories so no one directory gets too big. Files are
+        written to a temporary name and renamed into place, so a reader never
+        sees a half written file.
+
+        If "maxbytes" is set, the least recently used files (by access time,
+        which we set ourselves rather than rely on the filesystem) are
+        removed when the cache grows beyond it. The modification time is
+        left alone, so it's when the file was cached. Several processes can share the one cache
+        directory, we each keep a running estimate of its size and rescan it
+        every "rescan" seconds, or when the estimate goes over the limit.
+    """
 
-    def __init__(self, cachedir):
+    # Don't bother updating a file's "last used" time more often than this.
+    TOUCH_INTERVAL = 600
+
+    def __init__(self, cachedir, maxbytes=0, rescan=600):
 
         if not os.access(cachedir, os.W_OK):
             try:
@@ -113,61 +402,205 @@ class FileCache(object):
             except BaseException as err:
                 L.warn("Can't create file cache in %s (%s)" % (cachedir, err))
             if not os.access(cachedir, os.W_OK):
-                L.warn("Can't write to cache dir '%s' please check permissions.")
+                L.warn("Can't write to cache dir '%s' please check permissions." % cachedir)
         self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self.rescan = rescan
+        self.lock = threading.Lock()
+        self.sweeplock = threading.Lock()
+        self.size = 0          # estimated bytes on disk
+        self.lastscan = 0      # when we last looked at the whole directory
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'writes': 0,
+            'evictions': 0,     # files removed to keep under maxbytes
+            'evictedbytes': 0,
+            'errors': 0,
+        }
+
+    def _path(self, key):
+        """ The file an item is stored in."""
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        digest = hashlib.sha1(key).hexdigest()
+        return os.path.join(self.cachedir, digest[0:2], digest[2:4], digest)
+
+    def _count(self, counter, amount=1):
+        """ Increment one of the counters."""
+        with self.lock:
+            self.counters[counter] += amount
+
+    def _touch(self, path, stat):
+        """ Mark the file as recently used, for eviction."""
+        now = time.time()
+        if now - stat.st_atime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, stat.st_mtime))
+            except OSError:
+                pass
 
     def set(self, key, value):
         """ store item."""
+        path = self._path(key)
         if value is False:
             # We want to delete the item from the cache
             try:
-                os.unlink(os.path.join(self.cachedir, key, "DATA"))
+                size = os.stat(path).st_size
+                os.unlink(path)
+                with self.lock:
+                    self.size -= size
             except OSError:
                 # this usually happens when the file is already gone
                 pass
             return
-        if not os.access(os.path.join(self.cachedir, key), os.W_OK):
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
             try:
-                os.makedirs(os.path.join(self.cachedir, key))
-            except IOError:
-                L.error("Can't create cache in %s/%s" % (self.cachedir, key))
+                os.makedirs(dirname)
+            except OSError:
+                # probably another process got there first
+                if not os.path.isdir(dirname):
+                    L.error("Can't create cache in %s" % dirname)
+                    self._count('errors')
+                    return False
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "wb")
-            fptr.write(value)
-            fptr.close()
-        except IOError as err:
+            fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+        except (IOError, OSError) as err:
             L.error("File Cache Error. (%s)" % err)
+            self._count('errors')
             return False
+        try:
+            with os.fdopen(fd, "wb") as fptr:
+                fptr.write(value)
+            os.chmod(tmpname, 0644)
+            os.rename(tmpname, path)
+        except (IOError, OSError) as err:
+            L.error("File Cache Error. (%s)" % err)
+            self._count('errors')
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return False
+        with self.lock:
+            self.counters['writes'] += 1
+            self.size += len(value)
+            needsweep = (self.maxbytes and self.size > self.maxbytes) or \
+                time.time() - self.lastscan > self.rescan
+        if needsweep:
+            # Can take a while on a big cache, don't hold up the caller
+            sweeper = threading.Thread(target=self.sweep)
+            sweeper.daemon = True
+            sweeper.start()
         return True
 
     def get_filename(self, key):
         """ return the full path to the on-disk file """
+        path = self._path(key)
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "r")
-        except IOError:
+            stat = os.stat(path)
+        except OSError:
+            self._count('misses')
             return False, False
-        fptr.close()
-        return os.path.join(self.cachedir, key, "DATA"), True
+        self._count('hits')
+        self._touch(path, stat)
+        return path, True
 
     def get(self, key):
         """ fetch item. """
+        path = self._path(key)
         try:
-            fptr = open(os.path.join(self.cachedir, key, "DATA"), "r")
+            fptr = open(path, "rb")
         except IOError:
+            self._count('misses')
             return False, False
         try:
+            stat = os.fstat(fptr.fileno())
             data = fptr.read()
             fptr.close()
             if len(data) == 0:
-                if not key.contains("/image.gif"):  # many questions don't have one
+                if "/image.gif" not in key:  # many questions don't have one
                     L.error("file Cache EMPTY retrieval. (key=%s)" % (key,))
                 data = False
-        except IOError as err:
+        except (IOError, OSError) as err:
             # it's possible that something went wrong
             L.error("file Cache ERROR. (key=%s, exception=%s)" % (key, err))
+            self._count('errors')
             return False, False
+        self._count('hits')
+        self._touch(path, stat)
         return data, True
 
+    def sweep(self):
+        """ Look at everything in the cache directory to correct our idea of
+            its size, and remove the least recently used files if it's over
+            budget. Brings it down to 90% of maxbytes to give us some room.
+        """
+        if not self.sweeplock.acquire(False):
+            return  # someone else in this process is already at it
+        with self.lock:
+            self.lastscan = time.time()
+        try:
+            files = []
+            total = 0
+            now = time.time()
+            for dirpath, _, filenames in os.walk(self.cachedir):
+                for fname in filenames:
+                    path = os.path.join(dirpath, fname)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if fname.startswith(".tmp"):
+                        # Left behind by a crash part way through a write
+                        if now - stat.st_mtime > 3600:
+                            try:
+                                os.unlink(path)
+                            except OSError:
+                                pass
+                        continue
+                    total += stat.st_size
+                    files.append((stat.st_atime, stat.st_size, path))
+            evicted = 0
+            evictedbytes = 0
+            if self.maxbytes and total > self.maxbytes:
+                target = self.maxbytes * 0.9
+                files.sort()
+                for _, size, path in files:
+                    if total <= target:
+                        break
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        continue
+                    total -= size
+                    evicted += 1
+                    evictedbytes += size
+                L.info("File Cache evicted %d files (%d bytes)" %
+                       (evicted, evictedbytes))
+            with self.lock:
+                self.size = total
+                self.lastscan = time.time()
+                self.counters['evictions'] += evicted
+                self.counters['evictedbytes'] += evictedbytes
+        finally:
+            self.sweeplock.release()
+
+    def stats(self):
+        """ Return a dictionary of cache counters, for display/monitoring.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['bytes'] = self.size
+        stats['maxbytes'] = self.maxbytes
+        lookups = stats['hits'] + stats['misses']
+        if lookups:
+            stats['hitrate'] = float(stats['hits']) / lookups
+        else:
+            stats['hitrate'] = 0.0
+        return stats
+
 
 # noinspection PyUnusedLocal
 class FakeMCConn(object):
@@ -189,6 +622,22 @@ class FakeMCConn(object):
         """Do nothing."""
         return None
 
+    def get_multi(self, keys):
+        """Return nothing. """
+        return {}
+
+    def set_multi(self, mapping, expiry=None):
+        """Pretend to store items. """
+        return []
+
+    def delete_multi(self, keys):
+        """Do nothing."""
+        return None
+
+    def incr(self, key):
+        """Nothing to increment."""
+        return None
+
 
 class MCConn(object):
     """ Look after a connection to a memcached server.
@@ -245,6 +694,171 @@ class MCConn(object):
 
         return res
 
+    def get_multi(self, keys):
+        """ fetch several items in one go, returns {key: value} of those
+            that were found.
+        """
+        prefix = ("%s-" % uniqueKey).encode("utf-8")
+        keys = [key.encode("utf-8") for key in keys]
+        try:
+            res = self.conn.get_multi(keys, key_prefix=prefix)
+        except BaseException as err:
+            L.error("Memcache Error. (%s)" % err)
+            return {}
+
+        return res
+
+    def set_multi(self, mapping, expiry=None):
+        """ store several items in one go, returns a list of the keys that
+            couldn't be stored.
+        """
+        prefix = ("%s-" % uniqueKey).encode("utf-8")
+        mapping = dict((key.encode("utf-8"), value)
+                       for key, value in mapping.iteritems())
+        try:
+            if expiry:
+                res = self.conn.set_multi(mapping, expiry, key_prefix=prefix)
+            else:
+                res = self.conn.set_multi(mapping, key_prefix=prefix)
+            L.info("OaPool:MCConn:set_multi(%s, %s)" % (mapping.keys(), expiry))
+        except BaseException as err:
+            L.error("Memcache Error. (%s)" % err)
+            return mapping.keys()
+
+        return res
+
+    def delete_multi(self, keys):
+        """ remove several items."""
+        prefix = ("%s-" % uniqueKey).encode("utf-8")
+        keys = [key.encode("utf-8") for key in keys]
+        try:
+            res = self.conn.delete_multi(keys, key_prefix=prefix)
+        except IOError as err:
+            L.error("Memcache Error. (%s)" % err)
+            return False
+
+        return res
+
+    def incr(self, key):
+        """ Increment a counter, creating it if it's not there. Returns the
+            new value, or None on error.
+        """
+        key = "%s-%s" % (uniqueKey, key)
+        key = key.encode("utf-8")
+        try:
+            res = self.conn.incr(key)
+            if res is None:
+                # Start somewhere that won't repeat an earlier value if
+                # memcached has been restarted.
+                self.conn.add(key, str(int(time.time() * 1000)))
+                res = self.conn.incr(key)
+        except BaseException as err:
+            L.error("Memcache Error. (%s)" % err)
+            return None
+
+        return res
+
+
+class LocalCache(object):
+    """ A small in-process LRU cache, limited by number of entries and by
+        total (pickled) size, with a time to live on each item.
+        Values are stored pickled so callers can't modify the cached copy.
+        Each item can be given a "tag", a get() with a different tag
+        treats it as stale.
+    """
+
+    def __init__(self, maxentries, maxbytes, ttl):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.items = OrderedDict()  # key: (pickled, expires, tag)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+            'expired': 0,     # found, but past its time to live
+            'stale': 0,       # found, but its namespace has changed
+            'evictions': 0,   # pushed out to make room
+        }
+
+    def _remove(self, key):
+        """ Drop the item, lock must be held."""
+        item = self.items.pop(key, None)
+        if item:
+            self.size -= len(item[0])
+
+    def get(self, key, tag=None):
+        """ Return (value, found)"""
+        with self.lock:
+            item = self.items.pop(key, None)
+            if not item:
+                self.counters['misses'] += 1
+                return None, False
+            pickled, expires, itemtag = item
+            if expires < time.time():
+                self.size -= len(pickled)
+                self.counters['expired'] += 1
+                return None, False
+            if itemtag != tag:
+                self.size -= len(pickled)
+                self.counters['stale'] += 1
+                return None, False
+            self.items[key] = item  # move to the recently used end
+            self.counters['hits'] += 1
+        return cPickle.loads(pickled), True
+
+    def set(self, key, value, expiry=None, tag=None):
+        """ Store the item, for at most expiry seconds."""
+        ttl = self.ttl
+        if expiry and expiry < ttl:
+            ttl = expiry
+        try:
+            pickled = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError) as err:
+            L.warn("LocalCache can't store %s (%s)" % (key, err))
+            self.delete(key)
+            return
+        with self.lock:
+            self._remove(key)
+            if len(pickled) > self.maxbytes:
+                return
+            self.items[key] = (pickled, time.time() + ttl, tag)
+            self.size += len(pickled)
+            while len(self.items) > self.maxentries or \
+                    self.size > self.maxbytes:
+                oldest = next(iter(self.items))
+                self._remove(oldest)
+                self.counters['evictions'] += 1
+
+    def delete(self, key):
+        """ Forget the item."""
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        """ Forget everything."""
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return a dictionary of cache counters, for display/monitoring.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['entries'] = len(self.items)
+            stats['bytes'] = self.size
+        stats['maxentries'] = self.maxentries
+        stats['maxbytes'] = self.maxbytes
+        lookups = stats['hits'] + stats['misses'] + stats['expired'] + \
+            stats['stale']
+        if lookups:
+            stats['hitrate'] = float(stats['hits']) / lookups
+        else:
+            stats['hitrate'] = 0.0
+        return stats
+
 
 # nowadays memcache-client comes with its own pool, but this works and I haven't
 # had time to evaluate the memcache one.
@@ -252,9 +866,16 @@ class MCPool(object):
     """ Look after a pool of connections to the memcached. As well as reducing
         total number of connections used, libmemcache also doesn't appear to be
         threadsafe, so this gives us some protection.
+
+        If given a LocalCache, keys in the listed namespaces (the part of the
+        key before the first "-", eg. "qtemplate") are also kept in this
+        process. Each namespace has a version counter in memcached which is
+        bumped whenever one of its keys is deleted, so other processes notice
+        within "version_check" seconds and stop using their local copies.
     """
 
-    def __init__(self, connectstring, size):
+    def __init__(self, connectstring, size, local=None, namespaces=(),
+                 version_check=2):
         """Call with the connection string and a number of
            connections to put in the pool.
         """
@@ -269,14 +890,57 @@ class MCPool(object):
             except AttributeError:
                 mc = MCConn
             self.connqueue.put(mc(connectstring))
+        self.local = local
+        self.namespaces = frozenset(namespaces)
+        self.version_check = version_check
+        self.nsversions = {}  # namespace: (version, when we last checked)
+
+    @staticmethod
+    def _namespace(key):
+        """ The namespace a key belongs to."""
+        return key.split("-", 1)[0]
+
+    def _use_local(self, key):
+        """ Should this key be kept in the local cache?"""
+        return self.local is not None and \
+            self._namespace(key) in self.namespaces
+
+    def _ns_version(self, namespace):
+        """ Current version of the namespace, only asking memcached
+            every few seconds.
+        """
+        now = time.time()
+        version, checked = self.nsversions.get(namespace, (None, 0))
+        if now - checked < self.version_check:
+            return version
+        dbc = self.connqueue.get(True)
+        version = dbc.get("nsversion-%s" % namespace)
+        self.connqueue.put(dbc)
+        self.nsversions[namespace] = (version, now)
+        return version
+
+    def _bump_ns_version(self, namespace):
+        """ Tell every process their copies of the namespace are stale."""
+        dbc = self.connqueue.get(True)
+        version = dbc.incr("nsversion-%s" % namespace)
+        self.connqueue.put(dbc)
+        self.nsversions[namespace] = (version, time.time())
 
     def get(self, key):
         """Get an item from the cache. """
+        uselocal = self._use_local(key)
+        if uselocal:
+            tag = self._ns_version(self._namespace(key))
+            value, found = self.local.get(key, tag)
+            if found:
+                return value
         if self.connqueue.qsize() < 3:
             L.warn("Memcache Pool getting low! %d" % self.connqueue.qsize())
         dbc = self.connqueue.get(True)
         res = dbc.get(key)
         self.connqueue.put(dbc)
+        if uselocal and res is not None and res is not False:
+            self.local.set(key, res, tag=tag)
         return res
 
     def set(self, key, value, expiry=None):
@@ -284,6 +948,12 @@ class MCPool(object):
         dbc = self.connqueue.get(True)
         res = dbc.set(key, value, expiry)
         self.connqueue.put(dbc)
+        if self._use_local(key):
+            if res:
+                tag = self._ns_version(self._namespace(key))
+                self.local.set(key, value, expiry, tag=tag)
+            else:
+                self.local.delete(key)
         return res
 
     def delete(self, key):
@@ -291,4 +961,287 @@ class MCPool(object):
         dbc = self.connqueue.get(True)
         res = dbc.delete(key)
         self.connqueue.put(dbc)
+        if self._use_local(key):
+            self.local.delete(key)
+            self._bump_ns_version(self._namespace(key))
+        return res
+
+    def get_multi(self, keys):
+        """ Get several items from the cache with one round trip.
+            Returns {key: value} of the ones that were found.
+        """
+        found = {}
+        remote = []
+        tags = {}
+        for key in keys:
+            if self._use_local(key):
+                namespace = self._namespace(key)
+                if namespace not in tags:
+                    tags[namespace] = self._ns_version(namespace)
+                value, hit = self.local.get(key, tags[namespace])
+                if hit:
+                    found[key] = value
+                    continue
+            remote.append(key)
+        if not remote:
+            return found
+        dbc = self.connqueue.get(True)
+        res = dbc.get_multi(remote)
+        self.connqueue.put(dbc)
+        for key, value in res.iteritems():
+            if isinstance(key, str):
+                key = key.decode("utf-8")
+            found[key] = value
+            if self._use_local(key):
+                self.local.set(key, value, tag=tags[self._namespace(key)])
+        return found
+
+    def set_multi(self, mapping, expiry=None):
+        """ Put several items into the cache with one round trip.
+            Returns a list of keys that couldn't be stored.
+        """
+        if not mapping:
+            return []
+        dbc = self.connqueue.get(True)
+        failed = dbc.set_multi(mapping, expiry)
+        self.connqueue.put(dbc)
+        if self.local is not None:
+            failed = set(failed)
+            for key, value in mapping.iteritems():
+                if not self._use_local(key):
+                    continue
+                if key in failed or key.encode("utf-8") in failed:
+                    self.local.delete(key)
+                else:
+                    tag = self._ns_version(self._namespace(key))
+                    self.local.set(key, value, expiry, tag=tag)
+            failed = list(failed)
+        return failed
+
+    def delete_multi(self, keys):
+        """ Remove several items from the cache with one round trip."""
+        if not keys:
+            return True
+        dbc = self.connqueue.get(True)
+        res = dbc.delete_multi(keys)
+        self.connqueue.put(dbc)
+        namespaces = set()
+        for key in keys:
+            if self._use_local(key):
+                self.local.delete(key)
+                namespaces.add(self._namespace(key))
+        for namespace in namespaces:
+            self._bump_ns_version(namespace)
         return res
+
+    def stats(self):
+        """ Return a dictionary of local cache counters, or None if there
+            isn't a local cache.
+        """
+        if self.local is None:
+            return None
+        return self.local.stats()
+
+
+def _worker_main(conn, parentconn, func, cputime, memory):
+    """ Main loop of a WorkerPool process. Receives marshalled argument
+        tuples, replies with marshalled ("ok", result) or ("error", message)
+    """
+    parentconn.close()
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource and memory:
+        # Relative to what we've inherited from the web server process
+        try:
+            with open("/proc/self/statm") as statm:
+                size = int(statm.read().split()[0]) * resource.getpagesize()
+            resource.setrlimit(resource.RLIMIT_AS, (size + memory, size + memory))
+        except (IOError, ValueError, resource.error):
+            pass
+    parent = os.getppid()
+    while True:
+        try:
+            if not conn.poll(5):
+                if os.getppid() != parent:   # we've been orphaned
+                    break
+                continue
+            data = conn.recv_bytes()
+        except (EOFError, IOError):
+            break
+        if resource and cputime:
+            used = resource.getrusage(resource.RUSAGE_SELF)
+            soft = int(used.ru_utime + used.ru_stime + cputime) + 1
+            hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+            if hard != resource.RLIM_INFINITY:
+                soft = min(soft, hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+        try:
+            result = ("ok", func(*marshal.loads(data)))
+        except BaseException as err:
+            result = ("error", "%s: %s" % (type(err).__name__, err))
+        try:
+            reply = marshal.dumps(result)
+        except ValueError:
+            reply = marshal.dumps(("error", "Unable to send back result %r" %
+                                   (result[1],)))
+        try:
+            conn.send_bytes(reply)
+        except IOError:
+            break
+
+
+class _Worker(object):
+    """ One WorkerPool process and our end of the pipe to it. """
+
+    def __init__(self, func, cputime, memory):
+        (self.conn, child) = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=_worker_main,
+                                            args=(child, self.conn, func,
+                                                  cputime, memory))
+        self.proc.daemon = True
+        self.proc.start()
+        child.close()
+
+    def kill(self):
+        """ Get rid of the process, whatever it's doing. """
+        try:
+            os.kill(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.join(1)
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """ A pool of worker processes to run func(*args) away from the web server
+        threads (and the GIL), with limits on how long it may take.
+
+        The arguments and result are sent with marshal, so should be simple
+        types (numbers, strings, lists, dicts, ...) or code objects. Anything
+        else gives a ValueError from call().
+
+        "timeout" is the most (wall clock) seconds call() will wait, after
+        which the worker is killed and OaWorkerTimeout raised. "cputime"
+        (seconds per call) and "memory" (bytes, on top of what the process
+        started with) are enforced with rlimits, a worker exceeding them
+        dies and OaWorkerError is raised. Dead workers are replaced as
+        they're needed.
+
+        Processes are started when first needed rather than when the pool
+        is created, so a pool made at import time in a pre-forking web
+        server belongs to each web server process separately.
+
+        example:
+
+        pool = WorkerPool(do_something, 4, timeout=10, cputime=5)
+        result = pool.call(1, "two", {'three': 3})
+    """
+
+    def __init__(self, func, size, timeout=10, cputime=None, memory=None):
+        self.func = func
+        self.size = size
+        self.timeout = timeout
+        self.cputime = cputime
+        self.memory = memory
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.numworkers = 0
+        self.idle = Queue.Queue()
+        self.counters = {
+            'calls': 0,      # number of times call() was used
+            'timeouts': 0,   # calls that took too long
+            'errors': 0,     # calls that raised an error or killed the worker
+            'started': 0,    # worker processes started
+        }
+
+    def _forked(self):
+        """ If we're now in a different process to the one the pool was made
+            in, forget the inherited workers, they're not ours.
+        """
+        with self.lock:
+            if os.getpid() == self.pid:
+                return
+            self.pid = os.getpid()
+            self.numworkers = 0
+            self.idle = Queue.Queue()
+
+    def _checkout(self):
+        """ Find an idle worker, starting one if we're allowed to, otherwise
+            wait for one.
+        """
+        try:
+            return self.idle.get(False)
+        except Queue.Empty:
+            pass
+        with self.lock:
+            spawn = self.numworkers < self.size
+            if spawn:
+                self.numworkers += 1
+        if spawn:
+            try:
+                worker = _Worker(self.func, self.cputime, self.memory)
+            except (OSError, IOError):
+                with self.lock:
+                    self.numworkers -= 1
+                raise
+            with self.lock:
+                self.counters['started'] += 1
+            return worker
+        try:
+            return self.idle.get(True, self.timeout)
+        except Queue.Empty:
+            with self.lock:
+                self.counters['timeouts'] += 1
+            raise OaWorkerTimeout("No worker available after %s seconds." %
+                                  self.timeout)
+
+    def _discard(self, worker, counter):
+        """ Kill the worker, it'll be replaced when next needed. """
+        worker.kill()
+        with self.lock:
+            self.numworkers -= 1
+            self.counters[counter] += 1
+
+    def call(self, *args):
+        """ Run func(*args) in one of the worker processes and return the
+            result.
+        """
+        data = marshal.dumps(args)
+        self._forked()
+        worker = self._checkout()
+        with self.lock:
+            self.counters['calls'] += 1
+        try:
+            worker.conn.send_bytes(data)
+            if worker.conn.poll(self.timeout):
+                reply = worker.conn.recv_bytes()
+            else:
+                reply = None
+        except (EOFError, IOError, OSError) as err:
+            self._discard(worker, 'errors')
+            raise OaWorkerError("Worker process died, it may have hit its "
+                                "CPU or memory limit. (%s)" % err)
+        if reply is None:
+            self._discard(worker, 'timeouts')
+            raise OaWorkerTimeout("Worker took longer than %s seconds." %
+                                  self.timeout)
+        self.idle.put(worker)
+        (status, result) = marshal.loads(reply)
+        if status != "ok":
+            with self.lock:
+                self.counters['errors'] += 1
+            raise OaWorkerError(result)
+        return result
+
+    def stats(self):
+        """ Return a dictionary of pool counters, for display/monitoring.
+        """
+        with self.lock:
+            stats = self.counters.copy()
+            stats['workers'] = self.numworkers
+        stats['idle'] = self.idle.qsize()
+        stats['size'] = self.size
+        stats['timeout'] = self.timeout
+        return stats
@@ -11,12 +11,12 @@ from oasis.lib import General
 
 from oasis.lib.Permissions import check_perm
 from oasis.lib.OaExceptions import OaMarkerError
-from . import OaConfig, DB, Pool, Topics
+from . import DB, Topics
 from logging import getLogger
 
 L = getLogger("oasisqe")
 
-fileCache = Pool.FileCache(OaConfig.cachedir)
+fileCache = DB.fileCache
 
 
 def get_practice_q(qt_id, user_id):
@@ -73,41 +73,34 @@ def get_sorted_questions(course_id, topic_id, user_id=None):
     return questionlist
 
 
-def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
-    """ Return a list of questions, sorted by position. With
-        some statistics (may be expensive to calculate).
+def get_topic_stats(course_id, qt_ids, user_id):
+    """ Statistics for the practice page for several question templates
+        at once, from two queries rather than four per template.
+        Returns {qt_id: {'maxscore':, 'stats':, 'age':, 'ageseconds':,
+                         'classpercent':, 'indivpercent':}}
     """
-    def cmp_question_position(a, b):
-        """Order questions by the absolute value of their positions
-           since we use -'ve to indicate hidden.
-        """
-        return cmp(abs(a['position']), abs(b['position']))
-
-    questionlist = General.get_q_list(topic_id, user_id, numdone=False)
-    if not questionlist:
-        return []
-        # Filter out the questions without a positive position unless
-    # the user has prevew permission.
-    questions = [question for question in questionlist
-                 if question['position'] > 0]
-    questions.sort(cmp_question_position)
-    for question in questions:
-        try:
-            question['maxscore'] = DB.get_qt_maxscore(question['qtid'])
-        except KeyError:
-            question['maxscore'] = 0
-
-        stats_1 = DB.get_student_q_practice_stats(user_id, question['qtid'], 3)
+    assert isinstance(course_id, int)
+    assert isinstance(user_id, int)
+    classstats = DB.get_topic_stats_class(course_id, qt_ids)
+    userstats = DB.get_topic_stats_user(user_id, qt_ids, 3)
+    topicstats = {}
+    for qt_id in qt_ids:
+        stat = {}
+        classstat = classstats.get(qt_id, {})
+        maxscore = classstat.get('maxscore', 0)
+        stat['maxscore'] = maxscore
+        user_stats = userstats.get(qt_id)
+        stats_1 = user_stats and user_stats['recent']
         if stats_1:  # Last practices
             # Date of last practice
-            question['age'] = stats_1[(len(stats_1) - 1)]['age']
-            question['ageseconds'] = stats_1[(len(stats_1) - 1)]['ageseconds']
+            stat['age'] = stats_1[-1]['age']
+            stat['ageseconds'] = stats_1[-1]['ageseconds']
             # Fetch last three scores and rate them as good, average or poor
             for attempt in stats_1:
-                if question['maxscore'] > 0:
-                    attempt['pscore'] = "%d%%" % ((attempt['score'] / question['maxscore']) * 100,)
+                if maxscore > 0:
+                    attempt['pscore'] = "%d%%" % ((attempt['score'] / maxscore) * 100,)
                     attempt['rating'] = 2  # average
-                    if attempt['score'] == question['maxscore']:
+                    if attempt['score'] == maxscore:
                         attempt['rating'] = 3  # good
                     if attempt['score'] == 0:
                         attempt['rating'] = 1  # poor
@@ -116,28 +109,47 @@ def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
                     attempt['pscore'] = "%2.1f " % (attempt['score'],)
                     if attempt['score'] == 0:
                         attempt['rating'] = 1
-            question['stats'] = stats_1
+            stat['stats'] = stats_1
         else:
-            question['stats'] = None
-        stats_2 = DB.get_q_stats_class(course_id, question['qtid'])
-        if not stats_2:  # no stats, make some up
-            stats_2 = {'num': 0, 'max': 0, 'min': 0, 'avg': 0}
+            stat['stats'] = None
+        classmax = classstat.get('max')
+        if not classmax:
             percentage = 0
         else:
-            if stats_2['max'] == 0:
-                percentage = 0
-            else:
-                percentage = int(stats_2['avg'] / stats_2['max'] * 100)
-        question['classpercent'] = str(percentage) + "%"
-        user_stats = DB.get_prac_stats_user_qt(user_id, question['qtid'])
-        if not user_stats:
+            percentage = int(classstat['avg'] / classmax * 100)
+        stat['classpercent'] = str(percentage) + "%"
+        if not user_stats or not classmax:
             indivpercentage = 0
         else:
-            if stats_2['max'] == 0:
-                indivpercentage = 0
-            else:
-                indivpercentage = int(user_stats['avg'] / stats_2['max'] * 100)
-        question['indivpercent'] = str(indivpercentage) + "%"
+            indivpercentage = int(user_stats['avg'] / classmax * 100)
+        stat['indivpercent'] = str(indivpercentage) + "%"
+        topicstats[qt_id] = stat
+    return topicstats
+
+
+def get_sorted_qlist_wstats(course_id, topic_id, user_id=None):
+    """ Return a list of questions, sorted by position. With
+        some statistics (see get_topic_stats).
+    """
+    def cmp_question_position(a, b):
+        """Order questions by the absolute value of their positions
+           since we use -'ve to indicate hidden.
+        """
+        return cmp(abs(a['position']), abs(b['position']))
+
+    questionlist = General.get_q_list(topic_id, user_id, numdone=False)
+    if not questionlist:
+        return []
+    # Filter out the questions without a positive position unless
+    # the user has prevew permission.
+    questions = [question for question in questionlist
+                 if question['position'] > 0]
+    questions.sort(cmp_question_position)
+    topicstats = get_topic_stats(course_id,
+                                 [question['qtid'] for question in questions],
+                                 user_id)
+    for question in questions:
+        question.update(topicstats[question['qtid']])
     return questions
 
 
@@ -195,6 +207,7 @@ def get_next_prev(qt_id, topic_id):
 def mark_q(user_id, topic_id, q_id, request):
     """Mark the question and return the results"""
     answers = {}
+    guesses = {}
     for i in request.form.keys():
         part = re.search(r"^Q_(\d+)_ANS_(\d+)$", i)
         if part:
@@ -203,10 +216,12 @@ def mark_q(user_id, topic_id, q_id, request):
             if newqid == q_id:
                 value = request.form[i]
                 answers["G%d" % part] = value
-                DB.save_guess(newqid, part, value)
+                guesses[part] = value
             else:
                 L.warn("received guess for wrong question? (%d,%d,%d,%s)" %
                     (user_id, topic_id, q_id, request.form))
+    DB.save_guesses(q_id, guesses)
+    DB.remove_q_stats(q_id)    # in case it was marked before
     try:
         marks = General.mark_q(q_id, answers)
         DB.set_q_status(q_id, 3)    # 3 = marked
@@ -225,5 +240,6 @@ def mark_q(user_id, topic_id, q_id, request):
         if 'M%d' % (part,) in marks:
             total += float(marks['M%d' % (part,)])
     DB.update_q_score(q_id, total)    # 3 = marked
+    DB.add_q_stats(q_id)
     DB.set_q_status(q_id, 2)
     return q_body
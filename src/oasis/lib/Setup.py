@@ -8,7 +8,7 @@
 """
 
 from flask import flash
-from oasis.lib import DB, Topics, Courses, Courses2
+from oasis.lib import DB, Topics, Courses, Courses2, General
 import StringIO
 from oasis.lib import External
 from flask import send_file, abort
@@ -91,6 +91,7 @@ def do_topic_page_commands(request, topic_id, user_id):
                     newid = DB.copy_qt_all(qtid)
                     DB.add_qt_to_topic(newid, target_topic)
                     Topics.flush_num_qs(target_topic)
+                    General.prerender_qt(newid)
 
         if target_cmd == 'hide':
             for qtid in qtids:
@@ -3,7 +3,12 @@
     Functionality for importing and exporting spreadsheets.
 """
 
-from oasis.lib import Courses2, Exams, Users2
+import codecs
+import csv
+from cStringIO import StringIO
+from itertools import groupby
+
+from oasis.lib import Courses2, Exams
 from openpyxl.writer.excel import save_virtual_workbook
 from openpyxl.workbook import Workbook
 
@@ -11,27 +16,66 @@ from logging import getLogger
 
 L = getLogger("oasisqe")
 
-def exam_results_as_spreadsheet(course_id, group, exam_id):
-    """ Export the assessment results as a XLSX spreadsheet """
 
+def exam_results_rows(course_id, group, exam_id):
+    """ Generate the rows of the assessment results: a few heading rows,
+        then one for each student, sorted by family name. Students are read
+        from a single query and each row is made as it's needed.
+    """
     course = Courses2.get_course(course_id)
     exam = Exams.get_exam_struct(exam_id, course_id)
+    questions = Exams.get_qts_list(exam_id)
 
-    uids = set([])
-    totals = {}
+    yield [course['name'], course['title']]
+    yield ["Assessment:", exam['title']]
+    yield ["Group:", group.name]
+    yield ["", "", "", "", ""] + \
+          ["Q%s" % (qcount + 1,) for qcount in range(len(questions))] + \
+          ["Total"]
+
+    results = Exams.get_marks_with_users(group, exam_id)
+    for _, rows in groupby(results, key=lambda res: res[0]):
+        rows = list(rows)
+        scores = dict([(res[6], res[7]) for res in rows])
+        line = list(rows[0][1:6])   # uname, student_id, names, email
+        total = 0.0
+        for pos in questions:
+            score = ""
+            for qt in pos:
+                if qt['id'] in scores and scores[qt['id']] is not None:
+                    score = scores[qt['id']]
+                    total += score
+                    break
+            line.append(score)
+        line.append(total)
+        yield line
+
+
+def _csv_cell(value):
+    """ csv wants byte strings """
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
+
+
+def exam_results_as_csv(course_id, group, exam_id):
+    """ Generate the assessment results as CSV, a row at a time, so it can
+        be streamed out without building the whole file.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    yield codecs.BOM_UTF8     # so Excel knows it's UTF-8
+    for row in exam_results_rows(course_id, group, exam_id):
+        writer.writerow([_csv_cell(value) for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
 
-    results = Exams.get_marks(group, exam_id)
-    for user_id in results:
-        uids.add(user_id)
-        if user_id not in totals:
-            totals[user_id] = 0.0
-        for qt, val in results[user_id].iteritems():
-            totals[user_id] += val['score']
 
-    questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
+def exam_results_as_spreadsheet(course_id, group, exam_id):
+    """ Export the assessment results as a XLSX spreadsheet """
 
     wb = Workbook()
 
@@ -39,42 +83,11 @@ def exam_results_as_spreadsheet(course_id, group, exam_id):
 
     ws.title = "Results"
 
-    ws.cell(row=1, column=0).value = course['name']
-    ws.cell(row=1, column=1).value = course['title']
-    ws.cell(row=2, column=0).value = "Assessment:"
-    ws.cell(row=2, column=1).value = exam['title']
-    ws.cell(row=3, column=0).value = "Group:"
-    ws.cell(row=3, column=1).value = group.name
-
-    col = 5
-    qcount = 1
-    for _ in questions:
-        ws.cell(row=4, column=col).value = "Q%s" % qcount
-        qcount += 1
-        col += 1
-
-    ws.cell(row=4, column=col).value = "Total"
-
-    row = 5
-    sortusers = users.keys()
-    sortusers.sort(key=lambda us: users[us]['familyname'])
-
-    for user_id in sortusers:
-        result = results[user_id]
-        ws.cell(row=row, column=0).value = users[user_id]['uname']
-        ws.cell(row=row, column=1).value = users[user_id]['student_id']
-        ws.cell(row=row, column=2).value = users[user_id]['familyname']
-        ws.cell(row=row, column=3).value = users[user_id]['givenname']
-        ws.cell(row=row, column=4).value = users[user_id]['email']
-        col = 5
-
-        for pos in questions:
-            for qt in pos:
-                if qt['id'] in result:
-                    ws.cell(row=row, column=col).value = result[qt['id']]['score']
-                    col += 1
-
-        ws.cell(row=row, column=col).value = totals[user_id]
-        row += 1
+    rownum = 1
+    for row in exam_results_rows(course_id, group, exam_id):
+        for col, value in enumerate(row):
+            if not value == "":
+                ws.cell(row=rownum, column=col).value = value
+        rownum += 1
 
     return save_virtual_workbook(wb)
@@ -9,152 +9,205 @@
     other components to use.
 """
 
+import hashlib
 from datetime import datetime, timedelta
 import DB
 
 
-def prac_q_count(year, month, day, hour, qtemplate):
-    """ Fetch the practice count for the given time/qtemplate or return
-        False if not found. Can be used when deciding if to INSERT or UPDATE.
-        Note: may return 0 if count is zero, is not same as not exist (False)
+# The marktime up to which practices have been counted into
+# stats_prac_q_course is kept in the config table under this name.
+WATERMARK = "statspracmarktime"
+
+# Time series longer than this are put into bigger buckets (week, month,
+# year) until they fit.
+MAX_POINTS = 400
+
+
+def get_prac_watermark(lock=False):
+    """ Return the marktime practices have been counted up to, or None if
+        they haven't been. If lock is set (inside a transaction), nobody
+        else can move it until the transaction is done.
     """
-    sql = """SELECT "qtemplate", "hour", "day", "month", "year", "number", "when"
-                FROM stats_prac_q_course
-                 WHERE hour=%s
-                 AND month=%s
-                 AND day=%s
-                 AND year=%s
-                 AND qtemplate=%s;"""
-    params = (hour, month, day, year, qtemplate)
-    res = DB.run_sql(sql, params)
-    if not res or len(res) == 0:
-        return False
-    return int(res[0][0])
-
-
-def add_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
-    """ Insert a practice count for the given time/qtemplate """
-    sql = """INSERT INTO stats_prac_q_course ("qtemplate", "hour", "day",
-                                              "month", "year", "number",
-                                              "when", "avgscore")
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s);"""
-    params = (qtemplate,  hour, day,
-              month, year, count,
-              datetime(year=year, hour=hour, day=day, month=month), avgscore)
-    DB.run_sql(sql, params)
-
-
-def update_prac_q_count(year, month, day, hour, qtemplate, count, avgscore):
-    """ Insert a practice count for the given time/qtemplate """
-    sql = """UPDATE stats_prac_q_course SET "number"=%s, "avgscore"=%s
-                 WHERE hour=%s
-                 AND month=%s
-                 AND day=%s
-                 AND year=%s
-                 AND qtemplate=%s;"""
-    params = (count, avgscore, hour, month, day, year, qtemplate)
-    DB.run_sql(sql, params)
-
-
-def populate_prac_q_count(start=None, end=None):
-    """  Go through the questions from start to end date and count the number of
-         questions practiced. Store the results in stats_prac_q_course
-         If start not given, go back to the start of the database. If end not
-         given go until now.
+    sql = """SELECT CAST("value" AS timestamp)
+             FROM config
+             WHERE "name" = %s"""
+    if lock:
+        # There has to be a row to lock, even the first time. An empty one
+        # means not counted yet.
+        DB.run_sql("""INSERT INTO config ("name", "value")
+                      VALUES (%s, NULL)
+                      ON CONFLICT ("name") DO NOTHING;""", (WATERMARK,))
+        sql += " FOR UPDATE"
+    res = DB.run_sql(sql + ";", (WATERMARK,))
+    if not res:
+        return None
+    return res[0][0]
+
+
+def set_prac_watermark(when):
+    """ Record that practices have been counted up to the given marktime. """
+    sql = """INSERT INTO config ("name", "value")
+             VALUES (%s, CAST(CAST(%s AS timestamp) AS text))
+             ON CONFLICT ("name") DO UPDATE SET "value" = EXCLUDED."value";"""
+    DB.run_sql(sql, (WATERMARK, when))
+
+
+def populate_prac_q_count(start, end):
+    """ Count the practice questions marked after start, up to and including
+        end, and add them to the hourly totals in stats_prac_q_course, and
+        the daily ones (for each qtemplate, and the whole system as
+        qtemplate 0) in stats_prac_daily. Does not keep track of what has
+        been counted already, see update_prac_stats() for that.
+    """
+    sql = """INSERT INTO stats_prac_q_course ("qtemplate", "when", "hour",
+                                              "day", "month", "year",
+                                              "number", "avgscore")
+             SELECT qtemplate,
+                    date_trunc('hour', marktime),
+                    CAST(EXTRACT(HOUR FROM marktime) AS integer),
+                    CAST(EXTRACT(DAY FROM marktime) AS integer),
+                    CAST(EXTRACT(MONTH FROM marktime) AS integer),
+                    CAST(EXTRACT(YEAR FROM marktime) AS integer),
+                    COUNT(question),
+                    AVG(score)
+             FROM questions
+             WHERE (exam = '0' OR exam IS NULL)
+               AND qtemplate IS NOT NULL
+               AND marktime > %s
+               AND marktime <= %s
+             GROUP BY qtemplate, date_trunc('hour', marktime),
+                      EXTRACT(HOUR FROM marktime), EXTRACT(DAY FROM marktime),
+                      EXTRACT(MONTH FROM marktime), EXTRACT(YEAR FROM marktime)
+             ON CONFLICT ("qtemplate", "year", "month", "day", "hour")
+             DO UPDATE SET
+                 "number" = COALESCE(stats_prac_q_course."number", 0) + EXCLUDED."number",
+                 "avgscore" = (COALESCE(stats_prac_q_course."avgscore", 0)
+                               * COALESCE(stats_prac_q_course."number", 0)
+                               + COALESCE(EXCLUDED."avgscore", 0) * EXCLUDED."number")
+                              / (COALESCE(stats_prac_q_course."number", 0) + EXCLUDED."number");"""
+    DB.run_sql(sql, (start, end))
+    sql = """INSERT INTO stats_prac_daily ("qtemplate", "day", "number")
+             SELECT COALESCE(qtemplate, 0), CAST(marktime AS date), COUNT(question)
+             FROM questions
+             WHERE (exam = '0' OR exam IS NULL)
+               AND qtemplate IS NOT NULL
+               AND marktime > %s
+               AND marktime <= %s
+             GROUP BY GROUPING SETS ((qtemplate, CAST(marktime AS date)),
+                                     (CAST(marktime AS date)))
+             ON CONFLICT ("qtemplate", "day")
+             DO UPDATE SET "number" = stats_prac_daily."number" + EXCLUDED."number";"""
+    DB.run_sql(sql, (start, end))
+
+
+def update_prac_stats(chunk=timedelta(days=7), settle=timedelta(minutes=5)):
+    """ Count the practices marked since last time, a chunk of marktimes at
+        a time. Each chunk is committed along with the new watermark, so if
+        it's stopped part way it can just be run again to carry on.
+        Anything marked in the last few (settle) minutes is left for next
+        time, in case its score isn't saved yet.
+        Returns how many chunks were done.
+    """
+    res = DB.run_sql("SELECT LOCALTIMESTAMP;")
+    until = res[0][0] - settle
+    done = 0
+    with DB.pinned_connection():
+        while True:
+            with DB.transaction():
+                start = get_prac_watermark(lock=True)
+                if start is None:
+                    # Never counted (or counted by the old daily job), so
+                    # recount the last two weeks. Should cover most temporary
+                    # outages since the old job ran.
+                    start = until - timedelta(days=14)
+                    start = start.replace(hour=0, minute=0, second=0,
+                                          microsecond=0)
+                    DB.run_sql("""DELETE FROM stats_prac_q_course
+                                  WHERE "when" >= %s;""", (start,))
+                    DB.run_sql("""DELETE FROM stats_prac_daily
+                                  WHERE "day" >= %s;""", (start.date(),))
+                if start >= until:
+                    break
+                # Skip straight over any quiet periods
+                res = DB.run_sql("""SELECT MIN(marktime) FROM questions
+                                    WHERE marktime > %s AND marktime <= %s;""",
+                                 (start, until))
+                if not res or res[0][0] is None:
+                    end = until
+                else:
+                    end = min(res[0][0] + chunk, until)
+                populate_prac_q_count(start, end)
+                set_prac_watermark(end)
+            done += 1
+    return done
+
+
+def _bucket_size(start_day, end_day, maxpoints=MAX_POINTS):
+    """ The smallest of day, week, month or year that will give no more
+        than maxpoints buckets over the period.
+    """
+    days = (end_day - start_day).days + 1
+    if days <= maxpoints:
+        return "day"
+    if days / 7 + 1 <= maxpoints:
+        return "week"
+    if (end_day.year - start_day.year) * 12 + end_day.month - start_day.month + 1 <= maxpoints:
+        return "month"
+    return "year"
+
+
+def prac_counts_etag(start_time, end_time, qt_id=0, maxpoints=MAX_POINTS):
+    """ A tag that changes whenever prac_counts() for these arguments
+        would give something different. That's only when more practices
+        are counted, so we use the watermark.
     """
-    if not end:
-        end = datetime.now()
-    if not start:
-        start = datetime(2000, 1, 1)
-
-    sql = """ SELECT COUNT(question) AS practices,
-                EXTRACT (YEAR FROM marktime) as year,
-                     EXTRACT (MONTH FROM marktime) as month,
-                     EXTRACT (DAY FROM marktime) as day,
-                     EXTRACT (HOUR FROM marktime) as hour,
-                     qtemplate AS qtemplate,
-                     AVG(score) AS avgscore
-              FROM questions
-              WHERE (exam = '0' or exam is null)
-              AND marktime >= %s
-              AND marktime <= %s
-              GROUP BY
-                     EXTRACT (YEAR FROM marktime),
-                     EXTRACT (MONTH FROM marktime),
-                     EXTRACT (DAY FROM marktime),
-                     EXTRACT (HOUR FROM marktime),
-                     qtemplate;
-                     """
-    params = (start, end)
+    key = "%s %s %s %s %s" % (get_prac_watermark(), qt_id,
+                              start_time.date(), end_time.date(), maxpoints)
+    return hashlib.sha1(key).hexdigest()
+
+
+def prac_counts(start_time, end_time, qt_id=0, maxpoints=MAX_POINTS):
+    """ Return a list of [date, count] of practices of the given qtemplate
+        (or the whole system if 0) over the time period. Days are put
+        together into weeks, months or years so there are no more than
+        maxpoints of them, each dated by its first day. Empty buckets are
+        included, but if there was no practice at all, returns [].
+        Cached until more practices are counted.
+    """
+    key = "pracstats-%s" % prac_counts_etag(start_time, end_time, qt_id, maxpoints)
+    obj = DB.MC.get(key)
+    if obj is not None:
+        return obj
+    start_day = start_time.date()
+    end_day = end_time.date()
+    bucket = _bucket_size(start_day, end_day, maxpoints)
+    sql = """SELECT to_char(b.bucket, 'YYYY-MM-DD'), COALESCE(c.number, 0)
+             FROM generate_series(date_trunc(%s, CAST(%s AS timestamp)),
+                                  CAST(%s AS timestamp),
+                                  CAST('1 ' || %s AS interval)) AS b(bucket)
+             LEFT JOIN (SELECT date_trunc(%s, CAST("day" AS timestamp)) AS bucket,
+                               SUM("number") AS number
+                        FROM stats_prac_daily
+                        WHERE "qtemplate" = %s
+                          AND "day" >= %s
+                          AND "day" <= %s
+                        GROUP BY 1) AS c ON c.bucket = b.bucket
+             ORDER BY b.bucket;"""
+    params = (bucket, start_day, end_day, bucket,
+              bucket, qt_id, start_day, end_day)
     res = DB.run_sql(sql, params)
-    if not res:
-        return False
-    for row in res:
-        data = {
-            'count': int(row[0]),
-            'year': int(row[1]),
-            'month': int(row[2]),
-            'day': int(row[3]),
-            'hour': int(row[4]),
-            'qtemplate': int(row[5]),
-            'avgscore': float(row[6])
-        }
-        exist_count = prac_q_count(data['year'],
-                                   data['month'],
-                                   data['day'],
-                                   data['hour'],
-                                   data['qtemplate'])
-        if exist_count is False:  # could be 0
-            add_prac_q_count(data['year'],
-                             data['month'],
-                             data['day'],
-                             data['hour'],
-                             data['qtemplate'],
-                             data['count'],
-                             data['avgscore'])
-        else:
-            update_prac_q_count(data['year'],
-                                data['month'],
-                                data['day'],
-                                data['hour'],
-                                data['qtemplate'],
-                                data['count'],
-                                data['avgscore'])
+    data = []
+    if res and sum([int(row[1]) for row in res]):
+        data = [(row[0], int(row[1])) for row in res]
+    DB.MC.set(key, data, 86400)
+    return data
 
 
 def daily_prac_q_count(start_time, end_time, qt_id):
     """ Return a list of daily count of practices for the given qtemplate
         over the time period
     """
-    sql = """SELECT "year", "month", "day", sum("number")
-             FROM "stats_prac_q_course"
-             WHERE "qtemplate"=%s
-               AND "when" >= %s
-               AND "when" <= %s
-             GROUP BY "year","month","day"
-             ORDER BY "year","month","day" ASC;"""
-    params = (qt_id, start_time, end_time)
-    res = DB.run_sql(sql, params)
-    if not res:
-        res = []
-    data = []
-    first = True
-    for row in res:
-        if first:
-            # if the data doesn't start with a value,
-            # set a 0 entry so graphs scale correctly
-            if not (int(row[1]) == start_time.month
-                    and int(row[2]) == start_time.day
-                    and int(row[0] == start_time.year)):
-                data.append(("%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day), 0))
-            first = False
-
-        dt = datetime.strptime("%04d-%02d-%02d" % (int(row[0]), int(row[1]), int(row[2])), "%Y-%m-%d")
-        data.append((dt.strftime("%Y-%m-%d"), int(row[3])))
-
-    if len(res) >= 1 and not data[-1][0] == "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day):
-        data.append(("%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day), 0))
-    return data
+    return prac_counts(start_time, end_time, qt_id)
 #
 #
 # def daily_prac_q_scores(start_time, end_time, qt_id):
@@ -194,51 +247,25 @@ def daily_prac_q_count(start_time, end_time, qt_id):
 
 def daily_prac_load(start_time, end_time):
     """ Return a list of daily counts of practices for the whole system """
-    sql = """SELECT "year", "month", "day", sum("number") from "stats_prac_q_course"
-             WHERE "when" >= %s
-               AND "when" <= %s
-             GROUP BY "year","month","day"
-             ORDER BY "year","month","day" ASC;"""
-    params = (start_time, end_time)
-    res = DB.run_sql(sql, params)
-    if not res:
-        res = []
-    data = []
-    first = True
-    for row in res:
-        if first:
-            # if the data doesn't start with any values, set a 0 entry,
-            # so graphs scale correctly
-            if not (int(row[1]) == start_time.month
-                    and int(row[2]) == start_time.day
-                    and int(row[0] == start_time.year)):
-                data.append(("%04d-%02d-%02d" % (start_time.year, start_time.month, start_time.day), 0))
-            first = False
-        dt = datetime.strptime("%04d-%02d-%02d" % (int(row[0]), int(row[1]), int(row[2])), "%Y-%m-%d")
-        data.append((dt.strftime("%Y-%m-%d"), row[3]))
-    if len(res) >= 1 and not data[-1][0] == "%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day):
-
-        data.append(("%04d-%02d-%02d" % (end_time.year, end_time.month, end_time.day), 0))
-    return data
+    return prac_counts(start_time, end_time)
 
 
 def do_daily_stats_update():
-    """ To be run daily. Will update stats for the last few days to now.
-        Do the last two weeks, should cover most temporary outages
+    """ To be run daily (or more often). Will count anything practiced
+        since last time.
     """
-
-    now = datetime.now()
-    twoweek = timedelta(days=14)
-    st = now-twoweek
-    populate_prac_q_count(start=st)
+    update_prac_stats()
 
 
 def do_initial_stats_update():
     """ To be run once, on upgrade from a system that didn't do this.
-        Will update stats from the beginning of the database, to now.
-        May take a while.
+        Will count stats from the beginning of the database, to now.
+        May take a while, but if it's interrupted the next
+        do_daily_stats_update() will carry on from where it got to.
     """
-
-    now = datetime.now()
-    st = datetime(1990, 1, 1)
-    populate_prac_q_count(start=st, end=now)
+    start = datetime(1990, 1, 1)
+    with DB.transaction():
+        DB.run_sql("DELETE FROM stats_prac_q_course;")
+        DB.run_sql("DELETE FROM stats_prac_daily;")
+        set_prac_watermark(start)
+    update_prac_stats()
@@ -26,6 +26,21 @@ def create(course_id, name, vis, pos=1):
     return 0
 
 
+def _topic_from_row(row):
+    """ Turn a row from the topics table into a topic dictionary."""
+    topic = {
+        'id': row[0],
+        'course': row[1],
+        'title': row[2],
+        'visibility': row[3],
+        'position': row[4],
+        'archived': row[5]
+    }
+    if topic['position'] is None or topic['position'] is "None":
+        topic['position'] = 0
+    return topic
+
+
 def get_topic(topic_id):
     """ Fetch a dictionary of topic values"""
     key = "topic-%s-record" % topic_id
@@ -39,21 +54,39 @@ def get_topic(topic_id):
     ret = run_sql(sql, params)
     if not ret:
         raise KeyError("Unable to find topic %s" % topic_id)
-    row = ret[0]
-    topic = {
-        'id': row[0],
-        'course': row[1],
-        'title': row[2],
-        'visibility': row[3],
-        'position': row[4],
-        'archived': row[5]
-    }
-    if topic['position'] is None or topic['position'] is "None":
-        topic['position'] = 0
+    topic = _topic_from_row(ret[0])
     MC.set(key, json.dumps(topic))
     return topic
 
 
+def get_topic_multi(topic_ids):
+    """ Fetch the topic dictionaries for several topics at once.
+        Returns {topic_id: topic}, topics that don't exist are left out.
+    """
+    keys = dict(("topic-%s-record" % topic_id, topic_id)
+                for topic_id in topic_ids)
+    topics = {}
+    for key, obj in MC.get_multi(keys.keys()).iteritems():
+        if obj:
+            topics[keys[key]] = json.loads(obj)
+    missing = [topic_id for topic_id in topic_ids if topic_id not in topics]
+    if not missing:
+        return topics
+    sql = """SELECT topic, course, title, visibility, position, archived
+             FROM topics
+             WHERE topic IN %s;"""
+    params = (tuple(missing),)
+    ret = run_sql(sql, params)
+    tocache = {}
+    if ret:
+        for row in ret:
+            topic = _topic_from_row(row)
+            topics[topic['id']] = topic
+            tocache["topic-%s-record" % topic['id']] = json.dumps(topic)
+    MC.set_multi(tocache)
+    return topics
+
+
 def get_name(topic_id):
     """Fetch the name of a topic."""
     return get_topic(topic_id)['title']
@@ -146,6 +179,36 @@ def get_num_qs(topic_id):
         raise IOError("Database connection failed")
 
 
+def get_num_qs_multi(topic_ids):
+    """ How many questions are in each of the given topics.
+        Returns {topic_id: number}
+    """
+    keys = dict(("topic-%s-numquestions" % topic_id, topic_id)
+                for topic_id in topic_ids)
+    nums = {}
+    for key, obj in MC.get_multi(keys.keys()).iteritems():
+        if obj:
+            nums[keys[key]] = int(obj)
+    missing = [topic_id for topic_id in topic_ids if topic_id not in nums]
+    if not missing:
+        return nums
+    sql = """SELECT topic, COUNT(DISTINCT position)
+             FROM questiontopics
+             WHERE topic IN %s
+              AND position > 0
+             GROUP BY topic;"""
+    params = (tuple(missing),)
+    ret = run_sql(sql, params)
+    for topic_id in missing:
+        nums[topic_id] = 0
+    if ret:
+        for row in ret:
+            nums[int(row[0])] = int(row[1])
+    MC.set_multi(dict(("topic-%s-numquestions" % topic_id, nums[topic_id])
+                      for topic_id in missing), 180)  # 3 minute cache
+    return nums
+
+
 def get_qts(topic_id):
     """ Return a dictionary of the QTemplates in the given Topic, keyed by qtid.
         qtemplates[qtid] = {'id', 'position', 'owner', 'name', 'description',
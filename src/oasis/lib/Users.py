@@ -49,6 +49,43 @@ def incr_version():
     return -1
 
 
+def _user_rec_from_row(row):
+    """ Turn a row from the users table into a user record."""
+    if row[1]:
+        uname = unicode(row[1], 'utf-8')
+    else:
+        uname = u""
+    if row[2]:
+        givenname = unicode(row[2], 'utf-8')
+    else:
+        givenname = u""
+    if row[3]:
+        familyname = unicode(row[3], 'utf-8')
+    else:
+        familyname = u""
+    user_rec = {'id': row[0],
+                'uname': uname,
+                'givenname': givenname,
+                'familyname': familyname,
+                'fullname': u"%s %s" % (givenname, familyname),
+                'student_id': row[4],
+                'acctstatus': row[5],
+                'email': row[6],
+                'expiry': row[7],
+                'source': row[8],
+                'confirmed': row[9]}
+    if row[9] is True \
+            or row[9] == "true" \
+            or row[9] == "TRUE" \
+            or row[9] == "" \
+            or row[9] is None:
+
+        user_rec['confirmed'] = True
+    else:
+        user_rec['confirmed'] = False
+    return user_rec
+
+
 def get_user_record(user_id):
     """ Fetch info about the user
         returns  {'id', 'uname', 'givenname', 'lastname', 'fullname'}
@@ -65,43 +102,43 @@ def get_user_record(user_id):
     params = (user_id,)
     ret = run_sql(sql, params)
     if ret:
-        row = ret[0]
-        if row[1]:
-            uname = unicode(row[1], 'utf-8')
-        else:
-            uname = u""
-        if row[2]:
-            givenname = unicode(row[2], 'utf-8')
-        else:
-            givenname = u""
-        if row[3]:
-            familyname = unicode(row[3], 'utf-8')
-        else:
-            familyname = u""
-        user_rec = {'id': user_id,
-                    'uname': uname,
-                    'givenname': givenname,
-                    'familyname': familyname,
-                    'fullname': u"%s %s" % (givenname, familyname),
-                    'student_id': ret[0][4],
-                    'acctstatus': ret[0][5],
-                    'email': ret[0][6],
-                    'expiry': ret[0][7],
-                    'source': ret[0][8],
-                    'confirmed': ret[0][9]}
-        if ret[0][9] is True \
-                or ret[0][9] == "true" \
-                or ret[0][9] == "TRUE" \
-                or ret[0][9] == "" \
-                or ret[0][9] is None:
-
-            user_rec['confirmed'] = True
-        else:
-            user_rec['confirmed'] = False
+        user_rec = _user_rec_from_row(ret[0])
+        user_rec['id'] = user_id
         MC.set(key, json.dumps(user_rec))
         return user_rec
 
 
+def get_user_record_multi(user_ids):
+    """ Fetch info about several users at once.
+        returns  {user_id: {'id', 'uname', 'givenname', 'lastname',
+                            'fullname'}}
+        Users that aren't found are left out.
+    """
+    keys = dict(("user-%s-record" % (user_id,), user_id)
+                for user_id in user_ids)
+    users = {}
+    for key, obj in MC.get_multi(keys.keys()).iteritems():
+        if obj:
+            users[keys[key]] = json.loads(obj)
+    missing = [user_id for user_id in user_ids if user_id not in users]
+    if not missing:
+        return users
+    sql = """SELECT id, uname, givenname, familyname, student_id,
+                    acctstatus, email, expiry, source, confirmed
+                    FROM users
+                    WHERE id IN %s"""
+    params = (tuple(missing),)
+    ret = run_sql(sql, params)
+    tocache = {}
+    if ret:
+        for row in ret:
+            user_rec = _user_rec_from_row(row)
+            users[user_rec['id']] = user_rec
+            tocache["user-%s-record" % (user_rec['id'],)] = json.dumps(user_rec)
+    MC.set_multi(tocache)
+    return users
+
+
 def set_password(user_id, clearpass):
     """ Updates a users password. """
     hashed = bcrypt.hashpw(clearpass, bcrypt.gensalt(log_rounds=10))
@@ -51,6 +51,20 @@ def get_user(user_id):
     return USERS[user_id]
 
 
+def get_user_multi(user_ids):
+    """ Return a dict of user dicts (as get_user) for several users at once.
+        {user_id: {'id', 'uname', 'givenname', 'familyname', 'fullname'}}
+    """
+
+    reload_users()
+    missing = [user_id for user_id in user_ids if user_id not in USERS]
+    if missing:
+        USERS.update(Users.get_user_record_multi(missing))
+
+    return dict((user_id, USERS[user_id])
+                for user_id in user_ids if user_id in USERS)
+
+
 uid_by_uname = Users.uid_by_uname
 verify_pass = Users.verify_password
 create = Users.create
@@ -69,8 +69,7 @@ def q_log(qid, priority, facility, mesg):
     """function for question scripts (marker, render, generator, etc) to
        use to log messages. """
     qid = int(qid)
-    version = DB.get_q_version(qid)
-    variation = DB.get_q_variation(qid)
-    qtid = DB.get_q_parent(qid)
+    qinst = DB.get_q_instance(qid)
+    qtid = qinst.qtemplate
     owner = DB.get_qt_owner(qtid)
-    audit(3, owner, qtid, "qlogger", "version=%s,variation=%s,priority=%s,facility=%s,message=%s" % (version, variation, priority, facility, mesg))
+    audit(3, owner, qtid, "qlogger", "version=%s,variation=%s,priority=%s,facility=%s,message=%s" % (qinst.version, qinst.variation, priority, facility, mesg))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+""" Rough timings for the practice topic statistics page, old per-question
+    queries against the topic-level ones.
+
+    Not a test, run by hand against a scratch database:
+
+        python -m oasis.tests.bench_practice_stats [NUMROWS]
+
+    Everything happens in TEMP tables on one pinned connection, which hide
+    the real questions, qtemplates, usergroups, groupcourses, stats_q_course
+    and stats_q_counted tables for that session only, so nothing in the
+    database is changed.
+"""
+
+import sys
+import time
+
+from oasis.lib import DB, Practice
+
+COURSE = 1
+BASEQT = 1000000    # well clear of real template ids, for the maxscore cache
+
+
+def make_tables(numrows, numqts=30, numstudents=2000, numgroups=10):
+    """ Fill the temp tables. Rows are spread over 10 times as many
+        templates as one topic has, and students over 2 courses.
+    """
+    DB.run_sql("""CREATE TEMP TABLE qtemplates (
+                      qtemplate integer PRIMARY KEY,
+                      scoremax real);""")
+    DB.run_sql("""INSERT INTO qtemplates
+                  SELECT %s + n, 3.0
+                  FROM generate_series(0, %s) AS n;""",
+               (BASEQT, numqts * 10))
+    DB.run_sql("""CREATE TEMP TABLE groupcourses (
+                      groupid integer,
+                      course integer);""")
+    DB.run_sql("""INSERT INTO groupcourses
+                  SELECT n, 1 + n %% 2
+                  FROM generate_series(1, %s) AS n;""", (numgroups,))
+    DB.run_sql("""CREATE TEMP TABLE usergroups (
+                      userid integer,
+                      groupid integer);""")
+    DB.run_sql("""INSERT INTO usergroups
+                  SELECT n, 1 + n %% %s
+                  FROM generate_series(1, %s) AS n;""",
+               (numgroups, numstudents))
+    DB.run_sql("""CREATE TEMP TABLE questions (
+                      question integer PRIMARY KEY,
+                      qtemplate integer,
+                      student integer,
+                      status integer,
+                      exam integer,
+                      score real,
+                      firstview timestamp,
+                      marktime timestamp);""")
+    DB.run_sql("""INSERT INTO questions
+                  SELECT n,
+                         %s + n %% %s,
+                         1 + (n * 7919) %% %s,
+                         3,
+                         CASE WHEN n %% 10 = 0 THEN 1 ELSE 0 END,
+                         (n %% 4)::real,
+                         NOW() - (n %% 900000) * INTERVAL '1 second'
+                               - INTERVAL '5 minutes',
+                         NOW() - (n %% 900000) * INTERVAL '1 second'
+                  FROM generate_series(1, %s) AS n;""",
+               (BASEQT, numqts * 10, numstudents, numrows))
+    DB.run_sql("CREATE INDEX ON questions (qtemplate);")
+    DB.run_sql("CREATE INDEX ON questions (student);")
+    DB.run_sql("ANALYZE qtemplates;")
+    DB.run_sql("ANALYZE groupcourses;")
+    DB.run_sql("ANALYZE usergroups;")
+    DB.run_sql("ANALYZE questions;")
+    DB.run_sql("""CREATE TEMP TABLE stats_q_course (
+                      course integer NOT NULL,
+                      qtemplate integer NOT NULL,
+                      "month" date NOT NULL,
+                      "number" integer NOT NULL,
+                      total numeric NOT NULL,
+                      totalsq numeric NOT NULL,
+                      minscore real,
+                      maxscore real,
+                      PRIMARY KEY (course, qtemplate, "month"));""")
+    DB.run_sql("""CREATE TEMP TABLE stats_q_counted (
+                      question integer NOT NULL,
+                      course integer NOT NULL,
+                      qtemplate integer NOT NULL,
+                      "month" date NOT NULL,
+                      score real NOT NULL,
+                      PRIMARY KEY (question, course));""")
+
+
+def old_stats(qt_ids, user_id):
+    """ What get_sorted_qlist_wstats used to ask for, per question. """
+    for qt_id in qt_ids:
+        DB.get_qt_maxscore(qt_id)
+        DB.get_student_q_practice_stats(user_id, qt_id, 3)
+        DB.get_q_stats_class(COURSE, qt_id)
+        DB.get_prac_stats_user_qt(user_id, qt_id)
+
+
+def run(numrows=1000000, numqts=30, repeat=5):
+
+    with DB.pinned_connection():
+        start = time.time()
+        make_tables(numrows, numqts)
+        print "%d questions rows built in %.1fs" % (numrows, time.time() - start)
+        start = time.time()
+        made = DB.rebuild_q_stats()
+        print "%d stats_q_course rows rebuilt in %.1fs" % (made, time.time() - start)
+
+        qt_ids = range(BASEQT, BASEQT + numqts)
+        user_id = 3
+        for name, func in (("4 queries per question", old_stats),
+                           ("topic level, 2 queries",
+                            lambda q, u: Practice.get_topic_stats(COURSE, q, u))):
+            func(qt_ids, user_id)    # warm up
+            start = time.time()
+            for _ in range(repeat):
+                func(qt_ids, user_id)
+            print "%s: %.3fs per %d question topic" % (
+                name, (time.time() - start) / repeat, numqts)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+""" Rough timings for generating and rendering question instance HTML.
+
+    Not a test, run by hand:   python -m oasis.tests.bench_qengine
+"""
+
+import re
+import timeit
+import time
+from StringIO import StringIO
+
+from PIL import Image
+
+from oasis.lib import General
+
+
+def make_template(numvars, numanswers):
+    """ Build a big qtemplate.html and a matching set of variables. """
+    qvars = {}
+    html = ["<p>Question <IMG SRC></p>"]
+    for i in range(numvars):
+        qvars["v%d" % i] = i * 3
+        html.append("<p>Value %d is <VAL v%d>, again <VAL v%d></p>" % (i, i, i))
+    for i in range(1, numanswers + 1):
+        if i % 3 == 0:
+            html.append("<ANSWER%d MULTIF v1,v2,v3,v4>" % i)
+        elif i % 3 == 1:
+            html.append("<ANSWER%d SELECT v1,v2,v3>" % i)
+        else:
+            html.append("<ANSWER%d 10>" % i)
+    return qvars, "\n".join(html)
+
+
+def old_gen_q_html(qvars, html):
+    """ The regex and replace() passes gen_q_html used before CompiledQHTML,
+        kept here to compare against.
+    """
+    html = html.replace("<IMG SRC>", '<IMG SRC="$IMAGES$image.gif" />')
+    rx_answern = re.compile(r'<ANSWER([0-9]+) ([0-9]+)>')
+    html = re.sub(rx_answern,
+                  (lambda x:
+                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' SIZE='%s' VALUE="VAL_%s"/>""" %
+                   (x.group(1), x.group(2), x.group(1))), html)
+    rx_answern = re.compile(r'<ANSWER([0-9]+)>')
+    html = re.sub(rx_answern,
+                  (lambda x:
+                   """<INPUT class='auto_save' TYPE='text' NAME='ANS_%s' VALUE="VAL_%s"/>""" %
+                   (x.group(1), x.group(1))), html)
+    rx_answern = re.compile(r'<ANSWER([0-9]+) TEXT>')
+    html = re.sub(rx_answern,
+                  (lambda x:
+                   """<TEXTAREA class='auto_save' NAME='ANS_%s' ROWS=6 COLS=100>VAL_%s</TEXTAREA>""" %
+                   (x.group(1), x.group(1))), html)
+    for handler in (General.handle_multi_f, General.handle_multi,
+                    General.handle_multi_v, General.handle_listbox):
+        for i in range(1, 49):
+            (match, repl) = handler(html, i, qvars)
+            if match:
+                html = html.replace(match, repl)
+    for v in qvars.keys():
+        html = html.replace("<VAL %s>" % (v,),
+                            '%s' % (qvars[v]))
+        html = html.replace("<IMG SRC %s>" % (v,),
+                            '<IMG SRC="$STATIC$%s" />' % (qvars[v]))
+        html = html.replace("<ATT SRC %s>" % (v,),
+                            '<A HREF="$STATIC$%s" TARGET="_new">%s(View in New Window)</a>' % (qvars[v], qvars[v]))
+    return html
+
+
+def old_fill_q_guesses(out, guesses):
+    """ The nested replace() loops render_q_html used before fill_q_guesses,
+        kept here to compare against.
+    """
+    htmlesc = General.htmlesc
+    for guess in guesses.keys():
+        if guesses[guess] == None:
+            guesses[guess] = ""
+        if guesses[guess] == "None":
+            guesses[guess] = ""
+    if guesses:
+        for ques in range(25, 0, -1):
+            if ("G%d" % ques) in guesses:
+                out = out.replace("VAL_%d" % ques, htmlesc(guesses["G%d" % ques]))
+                for part in range(50, 0, -1):
+                    if guesses["G%d" % ques] == "%s.0" % part or guesses["G%d" % ques] == "%s" % part:
+                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
+                                          "SELECTED")
+                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
+                                          "CHECKED")
+                    else:
+                        out = out.replace("Oa_SEL_%d_%d" % (ques, part),
+                                          "")
+                        out = out.replace("Oa_CHK_%d_%d" % (ques, part),
+                                          "")
+            else:
+                out = out.replace("VAL_%d" % (ques,), "")
+    for ques in range(25, 0, -1):
+        out = out.replace("VAL_%d" % (ques,), "")
+    return out
+
+
+def run_guesses(numparts=25, repeat=200):
+    """ Time filling in guesses, old nested loops versus single pass. """
+    qvars, html = make_template(200, numparts)
+    html = General.gen_q_html(qvars, html)
+    guesses = dict(("G%d" % i, "%d" % (i % 3 + 1)) for i in range(1, numparts + 1))
+
+    old = timeit.timeit(lambda: old_fill_q_guesses(html, dict(guesses)),
+                        number=repeat)
+    new = timeit.timeit(lambda: General.fill_q_guesses(html, guesses),
+                        number=repeat)
+    print "%d parts, %d bytes of html" % (numparts, len(html))
+    print "  nested replace: %.3fms each" % (old * 1000 / repeat)
+    print "  single pass:    %.3fms each" % (new * 1000 / repeat)
+
+
+def run_images(numvariations=1000, workers=4):
+    """ Time drawing question images, one at a time as gen_q_image does,
+        versus a batch with cached fonts and base image.
+    """
+    base = StringIO()
+    Image.new("RGB", (400, 300), "white").save(base, "GIF")
+    base = base.getvalue()
+    jobs = []
+    for var in range(1, numvariations + 1):
+        qvars = {}
+        for i in range(1, 6):
+            qvars["X%d" % i] = 20 * i
+            qvars["Y%d" % i] = 40 * i
+            qvars["Z%d" % i] = "%s.%d" % (var, i)
+        jobs.append((var, qvars, False, True))
+
+    sample = jobs[:max(1, numvariations / 10)]
+
+    def uncached():
+        for job in sample:
+            General._FONTS.clear()
+            General.gen_q_image(job[1], base)
+
+    def batch(num, imgformat):
+        General.QIMAGE_FORMAT = imgformat
+        start = time.time()
+        list(General.render_variations(1, 1, None, base, jobs, workers=num))
+        return time.time() - start
+
+    onebyone = timeit.timeit(lambda: uncached(), number=1) * len(jobs) / len(sample)
+    print "%d image variations" % numvariations
+    print "  one at a time (est): %.2fs" % onebyone
+    for imgformat in ("GIF", "PNG"):
+        print "  %s, this process:  %.2fs" % (imgformat, batch(0, imgformat))
+        print "  %s, %d workers:     %.2fs" % (imgformat, workers,
+                                              batch(workers, imgformat))
+
+
+def run_marking(numitems=20000):
+    """ Time marking a cohort's answers one at a time versus as a batch. """
+    items = []
+    for i in range(numitems):
+        qvars = {"A1": "%d.5" % (i % 50), "A2": "7", "A3": "1.2e3"}
+        answers = {"G1": "%d.51" % (i % 50), "G2": "7", "G3": "1200"}
+        items.append((qvars, answers))
+
+    start = time.time()
+    for qvars, answers in items:
+        General.mark_q_standard(qvars, answers)
+    onebyone = time.time() - start
+    start = time.time()
+    General.mark_q_standard_batch(items)
+    batch = time.time() - start
+    print "%d answers marked" % numitems
+    print "  one at a time: %.2fs" % onebyone
+    print "  batch:         %.2fs" % batch
+
+
+def run(numvars=500, numanswers=40, repeat=20):
+    """ Time the old gen_q_html, versus generation from scratch, versus
+        from a compiled template.
+    """
+    qvars, html = make_template(numvars, numanswers)
+    compiled = General.CompiledQHTML(html)
+
+    old = timeit.timeit(lambda: old_gen_q_html(qvars, html), number=repeat)
+    scratch = timeit.timeit(lambda: General.gen_q_html(qvars, html),
+                            number=repeat)
+    reuse = timeit.timeit(lambda: compiled.render(qvars), number=repeat)
+    print "%d vars, %d answers, %d variations" % (numvars, numanswers, repeat)
+    print "  old gen_q_html:   %.2fms each" % (old * 1000 / repeat)
+    print "  compile + render: %.2fms each" % (scratch * 1000 / repeat)
+    print "  render only:      %.2fms each" % (reuse * 1000 / repeat)
+
+
+if __name__ == "__main__":
+    for nv in (50, 500, 2000):
+        run(numvars=nv)
+    run_guesses()
+    run_images()
+    run_marking()
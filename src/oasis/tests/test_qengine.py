@@ -8,8 +8,15 @@
 # code from all over the place :)
 
 import datetime
+import email.utils
+import random
+import threading
+import time
 
-from oasis.lib import General
+import psycopg2
+
+from oasis.lib import General, OqeFuncUtils, OqeSmartmarkFuncs, DB, Pool, Exams
+from oasis.lib.OaExceptions import OaDbPoolTimeout
 
 
 def test_instance_generate_simple_answer():
@@ -160,6 +167,596 @@ def test_instance_generate_variable():
     assert res == html
 
 
+def test_instance_generate_compiled():
+    """ Compile a template once and generate several variations from it,
+        make sure each comes out the same as generating from scratch.
+
+        No side effects.
+    """
+
+    tmpl = "<VAL A> <ANSWER1 MULTIF A,B> <VAL Z> <ANSWER60> <IMG SRC B>"
+    compiled = General.CompiledQHTML(tmpl)
+    for qvars in ({"A": 1, "B": 2}, {"A": "x", "B": "y"}, {}):
+        assert compiled.render(qvars) == General.gen_q_html(qvars, tmpl)
+
+    res = compiled.render({"A": 3, "B": "b.png"})
+    assert res.startswith("3 <table")
+    assert "<VAL Z>" in res
+    assert "NAME='ANS_60'" in res
+    assert res.endswith('<IMG SRC="$STATIC$b.png" />')
+
+
+def test_instance_fill_guesses():
+    """ Fill in previous guesses on the rendered form.
+
+        No side effects.
+    """
+
+    tmpl = """<INPUT VALUE="VAL_1"/><INPUT VALUE="VAL_10"/><INPUT VALUE="VAL_2"/>"""
+    guesses = {"G1": "a&b", "G10": "7", "G2": None}
+    html = """<INPUT VALUE="a&amp;b"/><INPUT VALUE="7"/><INPUT VALUE=""/>"""
+    assert General.fill_q_guesses(tmpl, guesses) == html
+
+    tmpl = "<OPTION Oa_SEL_30_2><OPTION Oa_SEL_30_12><INPUT Oa_CHK_3_1><INPUT Oa_CHK_4_1>"
+    guesses = {"G30": "12", "G3": "1.0"}
+    html = "<OPTION ><OPTION SELECTED><INPUT CHECKED><INPUT >"
+    assert General.fill_q_guesses(tmpl, guesses) == html
+
+
+def test_mark_standard_batch():
+    """ Batch marking should give exactly the same results as marking each
+        question on its own. Try lots of random, often silly, answers.
+
+        No side effects.
+    """
+
+    rand = random.Random(2046)
+    numbers = ["0", "1", "-1", "2.5", "1e3", "3.14159", "-0.001", "100000",
+               "1,5", " 7 ", "2 x 10^3", "1.5*10^(-2)", ",5", "NaN", "nan",
+               "inf", "-Infinity", "1e308", "abc", "Fred", "", None]
+
+    def value():
+        if rand.random() < 0.5:
+            return rand.choice(numbers)
+        return "%s" % (rand.uniform(-1000, 1000),)
+
+    items = []
+    for _ in range(2000):
+        qvars = {}
+        answers = {}
+        for part in range(1, rand.randint(1, 6)):
+            qvars["A%d" % part] = rand.choice([value(), rand.uniform(-50, 50)])
+            if rand.random() < 0.8:
+                qvars["T%d" % part] = rand.choice(["0", "1", "5", "-5", "50",
+                                                   "x", 10, 0.5])
+            if rand.random() < 0.9:
+                if rand.random() < 0.3:
+                    answers["G%d" % part] = "%s" % qvars["A%d" % part]
+                else:
+                    answers["G%d" % part] = value()
+        items.append((qvars, answers))
+
+    batch = General.mark_q_standard_batch(items)
+    assert len(batch) == len(items)
+    for (qvars, answers), marks in zip(items, batch):
+        assert marks == General.mark_q_standard(qvars, answers)
+
+
+def test_marker_script_log():
+    """ Anything a marker script log()s is handed back rather than written
+        to the database, since it may be running in a worker process.
+
+        No side effects.
+    """
+    script = ("M1 = 1.0\n"
+              "C1 = 'Correct'\n"
+              "log(OaQID)('info', 'Got %s' % G1)\n")
+    qvars = {'A1': "5", 'T1': "0", 'OaQID': 12}
+    (marks, error, logged) = General.run_marker_script(qvars, script,
+                                                       {'G1': "5"})
+    assert error is None
+    assert marks['M1'] == 1.0
+    assert logged == [(12, 'info', 'Got 5.0')]
+
+
+def test_comp_bool_eqs():
+    """ Comparing boolean equations by truth table should give the same
+        answers as evaluating each row the slow way.
+
+        No side effects.
+    """
+
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("a&b", "b & a") == 1
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("!(a+b)", "!a&!b") == 1
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("a+b", "a&b") == 0
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("a+1", "b+!b") == 1
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("a&&b", "a&b") == -1
+    assert OqeSmartmarkFuncs.comp_raw_bool_eqs("a$b", "a&b") == -1
+
+    # Big enough to need several chunks, differing only in the last row
+    names = ["v%d" % i for i in range(OqeFuncUtils.BOOL_CHUNK_BITS + 3)]
+    eqn = " and ".join(names)
+    assert OqeFuncUtils.comp_bool_eqs(eqn, "0", names) == 0
+    assert OqeFuncUtils.comp_bool_eqs(eqn, "not (%s)" % " or ".join(
+        ["not %s" % name for name in names]), names) == 1
+
+    rand = random.Random(2047)
+
+    def expr(names, depth):
+        if depth == 0 or rand.random() < 0.3:
+            return rand.choice(names + ["0", "1"])
+        if rand.random() < 0.2:
+            return "not %s" % expr(names, depth - 1)
+        op = rand.choice([" and ", " or "])
+        return "(%s)" % op.join([expr(names, depth - 1)
+                                 for _ in range(rand.randint(2, 3))])
+
+    for _ in range(300):
+        names = ["a", "b", "c", "d", "e"][:rand.randint(1, 5)]
+        eq1 = expr(names, 4)
+        if rand.random() < 0.3:
+            eq2 = eq1.replace(" and ", " & ", 1)  # sometimes unsupported
+        else:
+            eq2 = expr(names, 4)
+        assert OqeFuncUtils.comp_bool_eqs(eq1, eq2, names) == \
+            OqeFuncUtils._comp_bool_eqs_eval(eq1, eq2, names)
+
+
+class FakeCursor(object):
+    """ Just enough of a psycopg2 cursor to hand back some rows. """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.description = None
+        self.fetched = 0
+
+    def execute(self, sql, params=None):
+        self.description = [("col",)]
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchmany(self, size):
+        rows = self.rows[self.fetched:self.fetched + size]
+        self.fetched += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConn(object):
+    """ Just enough of a psycopg2 connection to make FakeCursors, commit or
+        roll back, and sit in a DbPool.
+    """
+    encoding = "UTF8"
+
+    def __init__(self, rows, commit_error=None):
+        self.rows = rows
+        self.commit_error = commit_error
+        self.isolation_level = None
+        self.rolledback = False
+        self.closed = 0
+        self.cursors = []
+
+    def close(self):
+        self.closed = 1
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self, name=None):
+        self.cursors.append(name)
+        return FakeCursor(self.rows)
+
+    def commit(self):
+        if self.commit_error:
+            raise self.commit_error
+
+    def rollback(self):
+        self.rolledback = True
+
+    def set_isolation_level(self, level):
+        self.isolation_level = level
+
+
+def test_topic_stats_rows():
+    """ The topic statistics queries start with WITH, make sure their
+        rows actually come back through run_sql and get used.
+
+        No side effects.
+    """
+    dbc = Pool.DbConn.__new__(Pool.DbConn)
+    dbc.broken = False
+
+    def run_sql(sql, params=None, quiet=False):
+        return dbc.run_sql(sql, params, quiet)
+
+    old_run_sql = DB.run_sql
+    DB.run_sql = run_sql
+    try:
+        dbc.conn = FakeConn([(5, 3.0, 4, 1.5, 0.5, 3.0, 0.0),
+                             (6, 2.0, None, None, None, None, None)])
+        stats = DB.get_topic_stats_class(1, [5, 6])
+        assert stats[5] == {'maxscore': 3.0, 'count': 4, 'avg': 1.5,
+                            'stddev': 0.5, 'max': 3.0, 'min': 0.0}
+        assert stats[6]['maxscore'] == 2.0
+        assert stats[6]['count'] is None
+
+        dbc.conn = FakeConn([(5, 2, 3.0, 1.0, 2.0, 3.0, 101, 50),
+                             (5, 2, 3.0, 1.0, 2.0, 1.0, 102, 20),
+                             (6, 1, 0.0, 0.0, 0.0, None, None, None)])
+        stats = DB.get_topic_stats_user(3, [5, 6])
+        assert stats[5]['num'] == 2
+        assert [att['question'] for att in stats[5]['recent']] == [101, 102]
+        assert stats[5]['recent'][1]['ageseconds'] == 20
+        assert stats[6]['recent'] == []
+    finally:
+        DB.run_sql = old_run_sql
+
+
+def test_commit_failure():
+    """ A failed commit should still leave the connection rolled back and
+        in autocommit, ready for the next user.
+
+        No side effects.
+    """
+    dbc = Pool.DbConn.__new__(Pool.DbConn)
+    dbc.broken = False
+    dbc.conn = FakeConn([], commit_error=psycopg2.IntegrityError())
+    dbc.begin()
+    try:
+        dbc.commit()
+    except psycopg2.IntegrityError:
+        pass
+    else:
+        assert False, "commit error was swallowed"
+    assert dbc.conn.rolledback
+    assert dbc.conn.isolation_level == Pool.ISOLATION_LEVEL_AUTOCOMMIT
+    assert not dbc.broken
+
+    dbc.conn = FakeConn([], commit_error=psycopg2.OperationalError())
+    try:
+        dbc.commit()
+    except psycopg2.OperationalError:
+        pass
+    assert dbc.broken
+
+    dbc.broken = False
+    dbc.conn = FakeConn([])
+    dbc.begin()
+    dbc.commit()
+    assert dbc.conn.isolation_level == Pool.ISOLATION_LEVEL_AUTOCOMMIT
+
+
+def test_iter_sql():
+    """ iter_sql should hand back every row, from a server-side (named)
+        cursor, and leave the connection rolled back and in autocommit
+        whether or not all the rows were read.
+
+        No side effects.
+    """
+    rows = [(i, "row %d" % i) for i in range(2500)]
+    dbc = Pool.DbConn.__new__(Pool.DbConn)
+    dbc.broken = False
+    dbc.conn = FakeConn(rows)
+    assert list(dbc.iter_sql("SELECT ...;", (1,), batchsize=1000)) == rows
+    assert dbc.conn.cursors == ["iter_sql"]
+    assert dbc.conn.rolledback
+    assert dbc.conn.isolation_level == Pool.ISOLATION_LEVEL_AUTOCOMMIT
+
+    dbc.conn = FakeConn(rows)
+    gen = dbc.iter_sql("SELECT ...;", batchsize=100)
+    assert gen.next() == rows[0]
+    assert dbc.conn.isolation_level == Pool.ISOLATION_LEVEL_READ_COMMITTED
+    gen.close()
+    assert dbc.conn.rolledback
+    assert dbc.conn.isolation_level == Pool.ISOLATION_LEVEL_AUTOCOMMIT
+
+
+def test_pool_wait():
+    """ Someone waiting for a database connection should get one when
+        another is handed back, or when one is thrown away and there's
+        room to open a new one. Otherwise they give up after the timeout.
+
+        No side effects.
+    """
+    old_connect = Pool.psycopg2.connect
+    Pool.psycopg2.connect = lambda connectstring: FakeConn([])
+    try:
+        pool = Pool.DbPool("fake", 1, timeout=5)
+        got = []
+        dbc = pool.start()
+        waiter = threading.Thread(target=lambda: got.append(pool.start()))
+        waiter.start()
+        time.sleep(0.2)
+        assert not got
+        pool._discard(dbc)
+        waiter.join(2)
+        assert got and got[0] is not dbc
+
+        waiter = threading.Thread(target=lambda: got.append(pool.start()))
+        waiter.start()
+        time.sleep(0.2)
+        pool.finish(got[0])
+        waiter.join(2)
+        assert len(got) == 2 and got[1] is got[0]
+
+        try:
+            pool.start(timeout=0.2)
+        except OaDbPoolTimeout:
+            pass
+        else:
+            assert False, "pool didn't time out"
+        stats = pool.stats()
+        assert stats['open'] == 1
+        assert stats['timeouts'] == 1
+        assert stats['waits'] == 2
+    finally:
+        Pool.psycopg2.connect = old_connect
+
+
+class BrokenMC(object):
+    """ A memcache connection that can't reach the server. """
+
+    def get(self, key):
+        return False
+
+    def set(self, key, obj, expiry=None):
+        return False
+
+
+def test_qt_version_mc_error():
+    """ A memcache error is a miss, not a version of False.
+
+        No side effects.
+    """
+    old_mc, old_run_sql = DB.MC, DB.run_sql
+    DB.MC = BrokenMC()
+    DB.run_sql = lambda sql, params=None, quiet=False: [(3,)]
+    try:
+        assert DB.get_qt_version(5) == 3
+    finally:
+        DB.MC, DB.run_sql = old_mc, old_run_sql
+
+
+class RecordingMC(object):
+    """ A memcache connection that remembers what was deleted. """
+
+    def __init__(self):
+        self.deleted = []
+
+    def get(self, key):
+        return None
+
+    def set(self, key, obj, expiry=None):
+        return True
+
+    def delete(self, key):
+        self.deleted.append(key)
+
+
+class FakePool(object):
+    """ Hands out the same DbConn every time. """
+
+    def __init__(self, dbc):
+        self.dbc = dbc
+
+    def start(self):
+        return self.dbc
+
+    def finish(self, dbc):
+        pass
+
+
+def test_q_instance_forget_after_commit():
+    """ A question changed inside a transaction should only be dropped
+        from the cache once it's committed, and not at all if it's rolled
+        back.
+
+        No side effects.
+    """
+    dbc = Pool.DbConn.__new__(Pool.DbConn)
+    dbc.broken = False
+    dbc.conn = FakeConn([])
+    old_mc, old_pool = DB.MC, DB.dbpool
+    DB.MC = RecordingMC()
+    DB.dbpool = FakePool(dbc)
+    try:
+        with DB.transaction():
+            DB.update_q_score(5, 2.0)
+            DB.set_q_status(6, 3)
+            assert DB.MC.deleted == []
+        assert sorted(DB.MC.deleted) == ["question-5-instance",
+                                         "question-6-instance"]
+
+        DB.MC.deleted = []
+        try:
+            with DB.transaction():
+                DB.update_q_score(5, 1.0)
+                raise ValueError()
+        except ValueError:
+            pass
+        assert DB.MC.deleted == []
+
+        DB.update_q_score(5, 1.0)
+        assert DB.MC.deleted == ["question-5-instance"]
+    finally:
+        DB.MC, DB.dbpool = old_mc, old_pool
+
+
+class FakeMarkQueue(object):
+    """ Just enough of the markqueue table for the marking queue's queries.
+        Time (in seconds) only moves on when we say.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.now = 0
+
+    def waiting(self, exam, student):
+        return [job for job in self.jobs
+                if (job['exam'], job['student']) == (exam, student)
+                and job['status'] < 2]
+
+    def run_sql(self, sql, params=None, quiet=False):
+        sql = " ".join(sql.split())
+        if sql.startswith("INSERT INTO markqueue"):
+            (exam, student) = params
+            if self.waiting(exam, student):
+                return []
+            self.jobs.append({'job': len(self.jobs) + 1, 'exam': exam,
+                              'student': student, 'status': 0,
+                              'attempts': 0, 'started': None, 'error': None})
+            return [(len(self.jobs),)]
+        if sql.startswith("SELECT job FROM markqueue"):
+            return [(job['job'],) for job in self.waiting(*params)]
+        if "error='Gave up'" in sql:
+            (attempts, stale) = params
+            for job in self.jobs:
+                if job['status'] == 1 and job['attempts'] >= attempts \
+                        and job['started'] < self.now - stale:
+                    job['status'] = 3
+                    job['error'] = 'Gave up'
+            return []
+        if sql.startswith("UPDATE markqueue SET status=1"):
+            (stale, attempts) = params
+            for job in self.jobs:
+                if (job['status'] == 0 or (job['status'] == 1 and
+                                           job['started'] < self.now - stale)) \
+                        and job['attempts'] < attempts:
+                    job['status'] = 1
+                    job['started'] = self.now
+                    job['attempts'] += 1
+                    return [(job['job'], job['exam'], job['student'])]
+            return []
+        if sql.startswith("UPDATE markqueue SET status=%s"):
+            (status, error, jobid) = params
+            self.jobs[jobid - 1]['status'] = status
+            self.jobs[jobid - 1]['error'] = error
+            return []
+        assert False, "unexpected SQL: %s" % sql
+
+
+def test_marking_queue():
+    """ Queued assessments are handed out once each, in order, and a
+        second submission doesn't queue it twice.
+
+        No side effects.
+    """
+    queue = FakeMarkQueue()
+    old_run_sql = Exams.run_sql
+    Exams.run_sql = queue.run_sql
+    try:
+        assert Exams.queue_marking(1, 10) == 1
+        assert Exams.queue_marking(1, 10) == 1
+        assert Exams.queue_marking(1, 11) == 2
+        assert Exams.claim_marking_job() == (1, 1, 10)
+        assert Exams.queue_marking(1, 10) == 1   # still being marked
+        assert Exams.claim_marking_job() == (2, 1, 11)
+        assert Exams.claim_marking_job() is None
+
+        Exams.finish_marking_job(1)
+        Exams.finish_marking_job(2, "Marker Error")
+        assert queue.jobs[0]['status'] == 2
+        assert queue.jobs[1]['status'] == 3
+        assert queue.jobs[1]['error'] == "Marker Error"
+        queue.now += 3600
+        assert Exams.claim_marking_job() is None
+
+        assert Exams.queue_marking(1, 10) == 3   # marked, so a new one
+    finally:
+        Exams.run_sql = old_run_sql
+
+
+def test_marking_queue_give_up():
+    """ A job whose marker disappears is handed out again once it's stale,
+        and given up on after 3 attempts.
+
+        No side effects.
+    """
+    queue = FakeMarkQueue()
+    old_run_sql = Exams.run_sql
+    Exams.run_sql = queue.run_sql
+    try:
+        Exams.queue_marking(2, 20)
+        assert Exams.claim_marking_job() == (1, 2, 20)
+        queue.now += 60
+        assert Exams.claim_marking_job() is None   # not stale yet
+        for attempt in (2, 3):
+            queue.now += 601
+            assert Exams.claim_marking_job() == (1, 2, 20)
+            assert queue.jobs[0]['attempts'] == attempt
+        queue.now += 601
+        assert Exams.claim_marking_job() is None
+        assert queue.jobs[0]['status'] == 3
+        assert queue.jobs[0]['error'] == 'Gave up'
+    finally:
+        Exams.run_sql = old_run_sql
+
+
+def test_byte_range():
+    """ Range requests for attachments: one range, from the start, the end,
+        or the last N bytes. Ones we can't satisfy give False (416), and
+        anything we don't handle, or an If-Range that doesn't match, gets the
+        whole thing.
+
+        No side effects.
+    """
+    from oasis import app, views_misc
+    etag = '"abc"'
+
+    def byte_range(headers, size=1000):
+        with app.test_request_context(headers=headers):
+            return views_misc._byte_range(size, etag)
+
+    assert byte_range({}) is None
+    assert byte_range({'Range': 'bytes=0-99'}) == (0, 99)
+    assert byte_range({'Range': 'bytes=900-'}) == (900, 999)
+    assert byte_range({'Range': 'bytes=500-5000'}) == (500, 999)
+    assert byte_range({'Range': 'bytes=-100'}) == (900, 999)
+    assert byte_range({'Range': 'bytes=-5000'}) == (0, 999)
+    assert byte_range({'Range': 'bytes=1000-'}) is False
+    assert byte_range({'Range': 'bytes=50-10'}) is False
+    assert byte_range({'Range': 'bytes=-10'}, size=0) is False
+    assert byte_range({'Range': 'bytes=-'}) is None
+    assert byte_range({'Range': 'bytes=0-1,5-9'}) is None
+    assert byte_range({'Range': 'lines=0-9'}) is None
+    assert byte_range({'Range': 'bytes=0-99', 'If-Range': '"abc"'}) == (0, 99)
+    assert byte_range({'Range': 'bytes=0-99', 'If-Range': '"old"'}) is None
+    assert byte_range({'Range': 'bytes=0-99', 'If-Range': 'W/"abc"'}) is None
+
+
+def test_not_modified():
+    """ Conditional GETs for attachments, by ETag (weak ones are fine) or
+        modification time. If-None-Match wins if both are sent.
+
+        No side effects.
+    """
+    from oasis import app, views_misc
+    etag = '"abc"'
+    mtime = 1400000000
+
+    def not_modified(headers):
+        with app.test_request_context(headers=headers):
+            return views_misc._not_modified(etag, mtime)
+
+    assert not not_modified({})
+    assert not_modified({'If-None-Match': '"abc"'})
+    assert not_modified({'If-None-Match': 'W/"abc"'})
+    assert not_modified({'If-None-Match': '"old", "abc"'})
+    assert not_modified({'If-None-Match': '*'})
+    assert not not_modified({'If-None-Match': '"old"'})
+    assert not_modified(
+        {'If-Modified-Since': email.utils.formatdate(mtime, usegmt=True)})
+    assert not not_modified(
+        {'If-Modified-Since': email.utils.formatdate(mtime - 10, usegmt=True)})
+    assert not not_modified({'If-Modified-Since': 'yesterday'})
+    assert not not_modified(
+        {'If-None-Match': '"old"',
+         'If-Modified-Since': email.utils.formatdate(mtime, usegmt=True)})
+
+
 def test_html_esc():
     """ Check that our HTML escaping works ok. ( & -> &amp;  etc)
     """
@@ -18,7 +18,7 @@ from logging import getLogger
 from oasis.lib import Courses, Courses2, Setup, Periods, Feeds, External, UFeeds
 
 MYPATH = os.path.dirname(__file__)
-from .lib import DB, Groups
+from .lib import DB, Groups, General
 from oasis import app, require_perm
 
 L = getLogger("oasisqe")
@@ -58,7 +58,12 @@ def admin_sysstats():
         "admin_sysstats.html",
         courses=Setup.get_sorted_courselist(),
         db_version=db_version,
-        db_sizes=db_sizes
+        db_sizes=db_sizes,
+        db_pool=DB.dbpool.stats(),
+        local_cache=DB.MC.stats(),
+        file_cache=DB.fileCache.stats(),
+        scripts=General.get_script_timings(),
+        marker_pool=General.MARKER_POOL and General.MARKER_POOL.stats()
     )
 
 
@@ -11,7 +11,7 @@ import os
 import datetime
 
 
-from flask import session, abort, jsonify, request
+from flask import session, abort, jsonify, request, Response
 from oasis.lib import Exams, API, Stats
 
 MYPATH = os.path.dirname(__file__)
@@ -24,6 +24,24 @@ from oasis import app, authenticated, require_perm
 
 L = getLogger("oasisqe")
 
+# Dashboards poll the stats, but they only change when the daily job runs.
+STATS_CACHE_CONTROL = "private, max-age=300"
+
+
+def _prac_counts_response(start_time, end_time, qt_id=0):
+    """ JSON practice counts for the graphs. They're tagged so a browser
+        that already has them only gets a 304, without working them out.
+    """
+    etag = Stats.prac_counts_etag(start_time, end_time, qt_id)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = jsonify(result=Stats.prac_counts(start_time, end_time, qt_id))
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = STATS_CACHE_CONTROL
+    return response
+
+
 @app.route("/api/exam/<int:course_id>/<int:exam_id>/qtemplates")
 @authenticated
 def api_exam_qtemplates(course_id, exam_id):
@@ -59,8 +77,7 @@ def api_stats_qtemplates_year(qt_id, year):
     start_time = datetime.datetime(year=year, month=1, day=1, hour=0)
     end_time = datetime.datetime(year=year, month=12, day=31, hour=23)
 
-    counts = Stats.daily_prac_q_count(start_time, end_time, qt_id)
-    return jsonify(result=counts)
+    return _prac_counts_response(start_time, end_time, qt_id)
 
 #
 # @app.route("/api/stats/practice/qtemplate/<int:qt_id>/<int:year>/scores")
@@ -106,8 +123,7 @@ def api_stats_qtemplates_3month(qt_id):
     end_time = now+days3
     start_time = now-month3
 
-    counts = Stats.daily_prac_q_count(start_time, end_time, qt_id)
-    return jsonify(result=counts)
+    return _prac_counts_response(start_time, end_time, qt_id)
 
 
 @app.route("/api/stats/practice/3months")
@@ -123,8 +139,7 @@ def api_stats_practice_load():
     end_time = now+days3
     start_time = now-month3
 
-    counts = Stats.daily_prac_load(start_time, end_time)
-    return jsonify(result=counts)
+    return _prac_counts_response(start_time, end_time)
 
 
 @app.route("/api/stats/practice/<int:year>")
@@ -136,8 +151,22 @@ def api_stats_practice_load_year(year):
     start_time = datetime.datetime(year=year, month=1, day=1, hour=0)
     end_time = datetime.datetime(year=year, month=12, day=31, hour=23)
 
-    counts = Stats.daily_prac_load(start_time, end_time)
-    return jsonify(result=counts)
+    return _prac_counts_response(start_time, end_time)
+
+
+# noinspection PyUnusedLocal
+@app.route("/api/exam/<int:course_id>/<int:exam_id>/marking")
+@authenticated
+def api_exam_marking(course_id, exam_id):
+    """ How marking the user's submitted assessment is going, for the
+        "await results" page to poll.
+    """
+    user_id = session['user_id']
+    status = Exams.get_user_status(user_id, exam_id)
+    job = Exams.get_marking_job(exam_id, user_id)
+    if job:
+        del job['job']
+    return jsonify(result={'marked': status >= 5, 'job': job})
 
 
 # noinspection PyUnusedLocal
@@ -138,23 +138,25 @@ def assess_assessmentpage(course_id, exam_id, page):
         Exams.touchuserexam(exam_id, user_id)
 
     form = request.form
+    guesses = {}
     for field in form.keys():
         qinfo = re.search(r"^Q_(\d+)_ANS_(\d+)$", field)
         if qinfo:
             q_id = int(qinfo.groups()[0])
             part = int(qinfo.groups()[1])
-            value = form[field]
-            timeremain = Exams.get_end_time(exam_id, user_id) - time.time()
-            if timeremain < -30:
-                flash("Time Exceeded, automatically submitting...")
-                return redirect(url_for("assess_submit",
-                                        course_id=course_id,
-                                        exam_id=exam_id))
-
-            if status < 6:
-                DB.save_guess(q_id, part, value)
-        else:
-            pass
+            guesses.setdefault(q_id, {})[part] = form[field]
+
+    if guesses:
+        timeremain = Exams.get_end_time(exam_id, user_id) - time.time()
+        if timeremain < -30:
+            flash("Time Exceeded, automatically submitting...")
+            return redirect(url_for("assess_submit",
+                                    course_id=course_id,
+                                    exam_id=exam_id))
+
+        if status < 4:   # not once it's submitted
+            for q_id, parts in guesses.items():
+                DB.save_guesses(q_id, parts)
 
     Exams.touchuserexam(exam_id, user_id)
 
@@ -261,12 +263,18 @@ def assess_submit(course_id, exam_id):
 
     exam = Exams.get_exam_struct(exam_id, course_id)
     status = Exams.get_user_status(user_id, exam_id)
-    if status < 5:
-        marked = Assess.mark_exam(user_id, exam_id)
+    resubmit = status < 4
+    if status == 4:
+        # Submitted but not marked, queue it again if the marking job has
+        # gone missing or failed.
+        marking = Exams.get_marking_job(exam_id, user_id)
+        resubmit = not marking or marking['status'] == 3
+    if resubmit:
+        marked = Assess.submit_exam(user_id, exam_id)
         if not marked:
             flash("There was a problem marking the assessment,")
 
-    if exam["instant"] == 2:
+    if exam["instant"] == 2 or Exams.get_user_status(user_id, exam_id) < 5:
         return redirect(url_for("assess_awaitresults",
                                 course_id=course_id,
                                 exam_id=exam_id))
@@ -299,12 +307,16 @@ def assess_awaitresults(course_id, exam_id):
                 'guesses': [{'part': k[1:], 'guess': guesses[k]} for k in keys],
                 'pos': position
             })
+    marking = Exams.get_marking_job(exam_id, user_id)
+    if marking and marking['status'] < 2:
+        Assess.start_markers()
     return render_template(
         "assess_awaitresults.html",
         course=course,
         exam=exam,
         questions=questions,
-        pages=range(1, numquestions + 1)
+        pages=range(1, numquestions + 1),
+        marking=marking
     )
 
 
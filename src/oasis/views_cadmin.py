@@ -7,10 +7,11 @@
 """
 
 import os
+import re
 from datetime import datetime
 
 from flask import render_template, session, request, redirect, \
-    abort, url_for, flash, make_response
+    abort, url_for, flash, Response
 from logging import getLogger
 from oasis.lib import OaConfig, Users2, DB, Topics, Permissions, \
     Exams, Courses, Courses2, Setup, CourseAdmin, Groups, General, Assess, \
@@ -46,6 +47,9 @@ def cadmin_top(course_id):
              for exam_id in Courses.get_exams(course_id, prev_years=False)]
 
     exams.sort(key=lambda y: y['start_epoch'], reverse=True)
+    for exam in exams:
+        if not exam['past']:
+            exam['provision'] = General.get_provision_progress(exam['id'])
     groups = Courses.get_groups(course_id)
     choosegroups = [group
                     for group in Groups.all_groups()
@@ -318,9 +322,10 @@ def cadmin_exam_results(course_id, exam_id):
                 totals[user_id] += val['score']
 
     questions = Exams.get_qts_list(exam_id)
-    users = {}
-    for uid in uids:
-        users[uid] = Users2.get_user(uid)
+    remark = General.get_remark_progress(exam_id)
+    if remark:
+        uids.update([change[0] for change in remark['changed']])
+    users = Users2.get_user_multi(list(uids))
     return render_template(
         "cadmin_examresults.html",
         course=course,
@@ -330,10 +335,39 @@ def cadmin_exam_results(course_id, exam_id):
         users=users,
         questions=questions,
         when=datetime.now().strftime("%H:%m, %a %d %b %Y"),
-        totals=totals
+        totals=totals,
+        remark=remark
     )
 
 
+@app.route("/cadmin/<int:course_id>/exam/<int:exam_id>/remark", methods=['POST', ])
+@require_course_perm(("coursecoord", "courseadmin", "altermarks"))
+def cadmin_exam_remark(course_id, exam_id):
+    """ Re-mark everyone's assessment (or just a group's) using the latest
+        marking, eg. after a marker script is fixed.
+    """
+    exam = Exams.get_exam_struct(exam_id, course_id)
+    if not exam:
+        abort(404)
+
+    if not int(exam['cid']) == int(course_id):
+        flash("Assessment %s does not belong to this course." % int(exam_id))
+        return redirect(url_for('cadmin_top', course_id=course_id))
+
+    students = None
+    group_id = request.form.get('group_id')
+    if group_id:
+        group = Groups.Group(g_id=int(group_id))
+        students = group.members()
+    if General.remark_exam_all(exam_id, students):
+        flash("Re-marking started, reload this page to see how it's going.")
+    else:
+        flash("Assessment is already being re-marked.")
+    return redirect(url_for('cadmin_exam_results',
+                            course_id=course_id,
+                            exam_id=exam_id))
+
+
 @app.route("/cadmin/<int:course_id>/exam/<int:exam_id>/<int:group_id>/export.csv")
 @require_course_perm(("coursecoord", "courseadmin", "viewmarks"))
 def cadmin_export_csv(course_id, exam_id, group_id):
@@ -351,16 +385,41 @@ def cadmin_export_csv(course_id, exam_id, group_id):
         return redirect(url_for('cadmin_top', course_id=course_id))
 
     group = Groups.Group(g_id=group_id)
-    output = Spreadsheets.exam_results_as_spreadsheet(course_id, group, exam_id)
-    ctitle = course.title
-    etitle = exam.title
-    response = make_response(output)
-    response.headers.add('Content-Type', "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet; charset=utf-8")
-    response.headers.add('Content-Disposition', 'attachment; filename="OASIS_%s_%s_Results.xlsx"' % (ctitle, etitle))
+    # Streamed out as it's made, big classes can take a while.
+    output = Spreadsheets.exam_results_as_csv(course_id, group, exam_id)
+    fname = "OASIS_%s_%s_Results.csv" % (course['name'], exam['title'])
+    fname = re.sub(r"[^A-Za-z0-9_.-]+", "_", fname)
+    response = Response(output, mimetype="text/csv")
+    response.headers.add('Content-Disposition', 'attachment; filename="%s"' % fname)
 
     return response
 
 
+@app.route("/cadmin/<int:course_id>/exam/<int:exam_id>/prepare", methods=['POST', ])
+@require_course_perm(("examcreate", "coursecoord", "courseadmin"))
+def cadmin_exam_prepare(course_id, exam_id):
+    """ Create all the students' questions for the assessment now, so there's
+        less to do when it starts.
+    """
+    exam = Exams.get_exam_struct(exam_id, course_id)
+    if not exam:
+        abort(404)
+
+    if not int(exam['cid']) == int(course_id):
+        flash("Assessment %s does not belong to this course." % int(exam_id))
+        return redirect(url_for('cadmin_top', course_id=course_id))
+
+    if not exam['future']:
+        flash("Assessment %s has already started." % exam['title'])
+        return redirect(url_for('cadmin_top', course_id=course_id))
+
+    if General.provision_exam(exam_id):
+        flash("Preparing questions for %s, reload this page to see how it's going." % exam['title'])
+    else:
+        flash("Questions for %s are already being prepared." % exam['title'])
+    return redirect(url_for('cadmin_top', course_id=course_id))
+
+
 @app.route("/cadmin/<int:course_id>/exam/<int:exam_id>/view/<int:student_uid>")
 @require_course_perm(("coursecoord", "courseadmin", "viewmarks"))
 def cadmin_exam_viewmarked(course_id, exam_id, student_uid):
@@ -512,7 +571,8 @@ def cadmin_editgroup(course_id, group_id):
     if not course:
         abort(404)
     ulist = group.members()
-    members = [Users2.get_user(uid) for uid in ulist]
+    users = Users2.get_user_multi(ulist)
+    members = [users[uid] for uid in ulist if uid in users]
     return render_template("courseadmin_editgroup.html",
                            course=course,
                            group=group,
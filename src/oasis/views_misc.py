@@ -8,8 +8,9 @@
 """
 
 import os
+import re
 import StringIO
-import datetime
+import email.utils
 
 from flask import render_template, session, \
     request, redirect, abort, url_for, flash, \
@@ -17,56 +18,193 @@ from flask import render_template, session, \
 from logging import getLogger
 
 from .lib import Users2, DB, Topics, \
-    Courses2, Attach, QEditor
+    Courses2, Attach, QEditor, OaConfig, General
 
 MYPATH = os.path.dirname(__file__)
 
 from .lib.Audit import audit
 from .lib.Permissions import check_perm
+from .lib.OaExceptions import OaDbPoolTimeout
 
 from oasis import app, authenticated
 
 L = getLogger("oasisqe")
 
+# Attachment URLs include the version, so what's behind them never changes.
+# Only attachments of embedded questions, which anyone can see, may be kept
+# by shared caches.
+ATT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+ATT_CACHE_CONTROL_PUBLIC = "public, max-age=31536000, immutable"
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _etag_matches(header, etag, weak=True):
+    """ Does the If-None-Match or If-Range header list our etag?
+        If-Range needs a strong match (weak=False), so W/ tags don't count.
+    """
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+def _not_modified(etag, mtime):
+    """ Does the browser already have the current copy? """
+    if "If-None-Match" in request.headers:
+        return _etag_matches(request.headers["If-None-Match"], etag)
+    since = request.headers.get("If-Modified-Since")
+    if since:
+        parsed = email.utils.parsedate_tz(since)
+        if parsed and int(mtime) <= email.utils.mktime_tz(parsed):
+            return True
+    return False
+
+
+def _byte_range(size, etag):
+    """ Return the (start, end) the browser asked for, inclusive, None for
+        the whole thing, or False if it can't be satisfied.
+        Only a single range is supported, anything else gets everything.
+    """
+    header = request.headers.get("Range")
+    if not header:
+        return None
+    if "If-Range" in request.headers and \
+            not _etag_matches(request.headers["If-Range"], etag, weak=False):
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:  # the last N bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        start = int(first)
+        end = size - 1
+        if last:
+            end = min(int(last), size - 1)
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _file_chunks(filename, start, length, chunksize=65536):
+    """ Generate the contents of part of the file. """
+    with open(filename, "rb") as fptr:
+        fptr.seek(start)
+        while length > 0:
+            data = fptr.read(min(chunksize, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def _send_attachment(hashval, mtype, public=False):
+    """ Send the attachment contents with the given hash. Since they're
+        stored by hash, it makes a good strong ETag. If public is set,
+        shared caches may keep a copy.
+    """
+    etag = '"%s"' % hashval
+    if public:
+        cache_control = ATT_CACHE_CONTROL_PUBLIC
+    else:
+        cache_control = ATT_CACHE_CONTROL
+    headers = {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    filename = DB.get_attach_fname(hashval)
+    if not filename:
+        abort(404)
+    stat = os.stat(filename)
+    headers["Last-Modified"] = email.utils.formatdate(stat.st_mtime,
+                                                      usegmt=True)
+    if _not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+
+    if OaConfig.attachment_sendfile == "apache":
+        headers["X-Sendfile"] = filename
+        return Response("", mimetype=mtype, headers=headers)
+    if OaConfig.attachment_sendfile == "nginx":
+        relpath = os.path.relpath(filename, DB.fileCache.cachedir)
+        headers["X-Accel-Redirect"] = os.path.join(
+            OaConfig.attachment_sendfile_prefix, relpath)
+        return Response("", mimetype=mtype, headers=headers)
+
+    size = stat.st_size
+    byterange = _byte_range(size, etag)
+    if byterange is False:
+        headers["Content-Range"] = "bytes */%d" % size
+        return Response(status=416, headers=headers)
+    if byterange is None:
+        start, end, status = 0, size - 1, 200
+    else:
+        start, end = byterange
+        status = 206
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+    length = end - start + 1
+    headers["Content-Length"] = str(length)
+    return Response(_file_chunks(filename, start, length),
+                    status=status,
+                    mimetype=mtype,
+                    headers=headers,
+                    direct_passthrough=True)
+
+
+def _check_att_access(qt_id):
+    """ Embedded questions can be seen by anyone, otherwise they need to
+        be logged in. Returns (login, public), login is a redirect if they
+        need to log in first, public is True if it's embedded.
+    """
+    embed_id = DB.get_qt_embedid(qt_id)
+    if embed_id is None:
+        abort(404)
+    if len(embed_id) < 1:  # if it's not embedded, check auth
+        if 'user_id' not in session:
+            session['redirect'] = request.path
+            return redirect(url_for('index')), False
+        return None, False
+    return None, True
+
+
 # Does its own auth because it may be used in embedded questions
 @app.route("/att/qatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
 def attachment_question(qt_id, version, variation, fname):
     """ Serve the given question attachment """
-    qtemplate = DB.get_qtemplate(qt_id)
-    if len(qtemplate['embed_id']) < 1:  # if it's not embedded, check auth
-        if 'user_id' not in session:
-            session['redirect'] = request.path
-            return redirect(url_for('index'))
+    (login, public) = _check_att_access(qt_id)
+    if login:
+        return login
     if Attach.is_restricted(fname):
         abort(403)
-    (mtype, fname) = Attach.q_att_details(qt_id, version, variation, fname)
+    (mtype, hashval) = Attach.q_att_ref(qt_id, version, variation, fname)
     if not mtype:
         abort(404)
-
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response = send_file(fname, mtype)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    return response
+    return _send_attachment(hashval, mtype, public)
 
 
 @app.route("/att/qtatt/<int:qt_id>/<int:version>/<int:variation>/<fname>")
 # Does its own auth because it may be used in embedded questions
 def attachment_qtemplate(qt_id, version, variation, fname):
     """ Serve the given question attachment """
-    qtemplate = DB.get_qtemplate(qt_id)
-    if len(qtemplate['embed_id']) < 1:  # if it's not embedded, check auth
-        if 'user_id' not in session:
-            session['redirect'] = request.path
-            return redirect(url_for('index'))
-    (mtype, filename) = Attach.q_att_details(qt_id, version, variation, fname)
+    (login, public) = _check_att_access(qt_id)
+    if login:
+        return login
     if Attach.is_restricted(fname):
         abort(403)
+    (mtype, hashval) = Attach.q_att_ref(qt_id, version, variation, fname)
     if not mtype:
         abort(404)
-    expiry_time = datetime.datetime.utcnow() + datetime.timedelta(10)
-    response = send_file(filename, mtype)
-    response.headers["Expires"] = expiry_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    return response
+    return _send_attachment(hashval, mtype, public)
 
 
 @app.route("/logout")
@@ -93,6 +231,18 @@ def custom_401(error):
                     {'WWW-Authenticate': 'Basic realm="Login Required"'})
 
 
+@app.errorhandler(OaDbPoolTimeout)
+def db_pool_timeout(error):
+    """ We're too busy to get a database connection. Ask them to try again
+        shortly rather than giving them an internal server error.
+    """
+    L.error("Request %s gave up waiting for the database: %s" %
+            (request.path, error))
+    return Response('The server is very busy, please try again in a moment.',
+                    503,
+                    {'Retry-After': '5'})
+
+
 @app.route("/login/webauth/flush")
 def logout_and_flush():
     """ Called vi AJAX so the user doesn't see the interaction.
@@ -190,7 +340,8 @@ def qedit_raw_edit(topic_id, qt_id):
         topic=topic,
         html=html,
         attachments=attachments,
-        qtemplate=qtemplate
+        qtemplate=qtemplate,
+        prerender=General.get_prerender_progress(qt_id)
     )
 
 
@@ -318,6 +469,8 @@ def qedit_raw_save(topic_id, qt_id):
             DB.create_qt_att(qt_id, newname, mtype, data, version)
             L.info("File '%s' uploaded by %s" % (newname, session['username']))
 
+    # Get all the variations ready before students start asking for them
+    General.prerender_qt(qt_id, version)
     flash("Question changes saved")
     return redirect(url_for("qedit_raw_edit", topic_id=topic_id, qt_id=qt_id))
 